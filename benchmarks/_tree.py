@@ -0,0 +1,120 @@
+"""
+Synthetic drive trees for benchmarks.
+"""
+
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+import random
+import string
+
+from wcpan.drive.core.types import ChangeAction, Node
+
+
+_ID_CHARS = string.ascii_letters + string.digits
+_EPOCH = datetime(2015, 1, 1, tzinfo=UTC)
+_MIME_TYPES = {
+    "file": ("application/pdf", "text/plain", "application/zip"),
+    "image": ("image/jpeg", "image/png"),
+    "video": ("video/mp4", "video/x-matroska"),
+}
+
+
+@dataclass(frozen=True, kw_only=True)
+class TreeShape:
+    nodes: int = 100_000
+    depth: int = 8
+    fan_out: int = 20
+    # fraction of children which are directories
+    directories: float = 0.2
+    # relative weights of plain files, images and videos
+    files: float = 6.0
+    images: float = 3.0
+    videos: float = 1.0
+    trashed: float = 0.01
+
+
+@dataclass(frozen=True)
+class Tree:
+    root: Node
+    directories: list[Node]
+    files: list[Node]
+
+
+def generate_tree(shape: TreeShape, *, seed: int = 0) -> Tree:
+    """
+    Build a tree breadth-first until it has `shape.nodes` nodes or is
+    `shape.depth` levels deep.
+    """
+    rng = random.Random(seed)
+    root = _make_node(rng, None, "directory", trashed=False)
+    directories: list[Node] = []
+    files: list[Node] = []
+    kinds = ("file", "image", "video")
+    weights = (shape.files, shape.images, shape.videos)
+
+    level = [root]
+    count = 1
+    for _ in range(shape.depth):
+        next_level: list[Node] = []
+        for parent in level:
+            for _ in range(shape.fan_out):
+                if count >= shape.nodes:
+                    break
+                trashed = rng.random() < shape.trashed
+                if rng.random() < shape.directories:
+                    node = _make_node(rng, parent.id, "directory", trashed=trashed)
+                    directories.append(node)
+                    next_level.append(node)
+                else:
+                    kind = rng.choices(kinds, weights)[0]
+                    node = _make_node(rng, parent.id, kind, trashed=trashed)
+                    files.append(node)
+                count += 1
+        if not next_level:
+            break
+        level = next_level
+    return Tree(root=root, directories=directories, files=files)
+
+
+def iter_change_batches(tree: Tree, batch_size: int) -> Iterator[list[ChangeAction]]:
+    """
+    Changes that create the tree, parents first.
+    """
+    batch: list[ChangeAction] = []
+    for node in tree.directories + tree.files:
+        batch.append((False, node))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _make_node(
+    rng: random.Random, parent_id: str | None, kind: str, *, trashed: bool
+) -> Node:
+    id_ = "".join(rng.choices(_ID_CHARS, k=33))
+    ctime = _EPOCH + timedelta(seconds=rng.randrange(10 * 365 * 86400))
+    mtime = ctime + timedelta(seconds=rng.randrange(86400))
+    is_directory = kind == "directory"
+    is_image = kind == "image"
+    is_video = kind == "video"
+    return Node(
+        id=id_,
+        parent_id=parent_id,
+        name="" if parent_id is None else f"{kind}-{id_[:12]}",
+        is_directory=is_directory,
+        is_trashed=trashed,
+        ctime=ctime,
+        mtime=mtime,
+        mime_type="" if is_directory else rng.choice(_MIME_TYPES[kind]),
+        hash="" if is_directory else "".join(rng.choices(_ID_CHARS, k=32)),
+        size=0 if is_directory else rng.randrange(1 << 30),
+        is_image=is_image,
+        is_video=is_video,
+        width=rng.choice((1280, 1920, 3840)) if is_image or is_video else 0,
+        height=rng.choice((720, 1080, 2160)) if is_image or is_video else 0,
+        ms_duration=rng.randrange(1, 3_600_000) if is_video else 0,
+        private=None,
+    )
@@ -0,0 +1,155 @@
+"""
+Measure how long `initialize` takes to migrate a large snapshot from the
+oldest schema it can upgrade, and compare file size and lookup latency of
+the old and the current layout.
+
+    python3 -m benchmarks.migration --nodes 1000000
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from collections.abc import Callable
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import random
+import string
+
+from wcpan.drive.sqlite._outer import initialize
+from wcpan.drive.sqlite._sql import (
+    CURRENT_SCHEMA_VERSION,
+    SQL_CREATE_TABLES_V5,
+    SQL_SELECT_CHILDREN_BY_ID,
+    SQL_SELECT_NODE_BY_ID,
+)
+
+
+# lookups in the layout of version 5, to compare with the current one
+SQL_JOIN_TABLES_V5 = """
+SELECT nodes.id, nodes.name, nodes.trashed, nodes.created, nodes.updated,
+    parents.parent_id, files.mime_type, files.hash, files.size,
+    images.width, images.height, audios.ms_duration, extras.json
+FROM nodes
+LEFT JOIN parents ON nodes.id = parents.id
+LEFT JOIN files ON nodes.id = files.id
+LEFT JOIN images ON nodes.id = images.id
+LEFT JOIN audios ON nodes.id = audios.id
+LEFT JOIN extras ON nodes.id = extras.id
+"""
+SQL_SELECT_NODE_BY_ID_V5 = SQL_JOIN_TABLES_V5 + "WHERE nodes.id = ?;"
+SQL_SELECT_CHILDREN_BY_ID_V5 = SQL_JOIN_TABLES_V5 + "WHERE parents.parent_id = ?;"
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100_000)
+    parser.add_argument("--fan-out", type=int, default=100)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        dsn = str(Path(tmp) / "snapshot.sqlite")
+        ids, directories = create_v5_snapshot(dsn, args.nodes, args.fan_out)
+        size_before = Path(dsn).stat().st_size
+        sample_ids = random.sample(ids, min(args.lookups, len(ids)))
+        sample_dirs = random.sample(directories, min(args.lookups, len(directories)))
+
+        with connect(dsn) as db:
+            by_id_before = _measure(
+                lambda _: db.execute(SQL_SELECT_NODE_BY_ID_V5, (_,)).fetchall(),
+                sample_ids,
+            )
+            children_before = _measure(
+                lambda _: db.execute(SQL_SELECT_CHILDREN_BY_ID_V5, (_,)).fetchall(),
+                sample_dirs,
+            )
+        db.close()
+
+        begin = perf_counter()
+        initialize(dsn)
+        elapsed = perf_counter() - begin
+
+        # freed pages are only given back to the file system by VACUUM
+        with connect(dsn) as db:
+            db.execute("VACUUM;")
+        db.close()
+        size_after = Path(dsn).stat().st_size
+
+        with connect(dsn) as db:
+            by_id_after = _measure(
+                lambda _: db.execute(SQL_SELECT_NODE_BY_ID, (_,)).fetchall(),
+                sample_ids,
+            )
+            children_after = _measure(
+                lambda _: db.execute(SQL_SELECT_CHILDREN_BY_ID, (_,)).fetchall(),
+                sample_dirs,
+            )
+        db.close()
+
+    report = {
+        "benchmark": "migration",
+        "nodes": args.nodes,
+        "from_version": 5,
+        "to_version": CURRENT_SCHEMA_VERSION,
+        "seconds": elapsed,
+        "size_before": size_before,
+        "size_after": size_after,
+        "get_node_by_id_seconds_before": by_id_before,
+        "get_node_by_id_seconds_after": by_id_after,
+        "get_children_by_id_seconds_before": children_before,
+        "get_children_by_id_seconds_after": children_after,
+    }
+    print(json.dumps(report))
+
+
+def create_v5_snapshot(
+    dsn: str, count: int, fan_out: int
+) -> tuple[list[str], list[str]]:
+    with connect(dsn) as db:
+        for sql in SQL_CREATE_TABLES_V5:
+            db.execute(sql)
+
+        ids = [_random_id() for _ in range(count)]
+        directories = ids[: max(1, count // fan_out)]
+        db.execute("INSERT INTO metadata VALUES ('root_id', ?);", (ids[0],))
+        db.executemany(
+            "INSERT INTO nodes VALUES (?, ?, ?, ?, ?);",
+            ((_, _[:16], False, 0, 0) for _ in ids),
+        )
+        db.executemany(
+            "INSERT INTO parents VALUES (?, ?);",
+            ((_, random.choice(directories)) for _ in ids[1:]),
+        )
+        db.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?);",
+            ((_, "video/mp4", _, 1024) for _ in ids[len(directories) :]),
+        )
+        db.executemany(
+            "INSERT INTO images VALUES (?, ?, ?);",
+            ((_, 1920, 1080) for _ in ids[len(directories) :]),
+        )
+        db.executemany(
+            "INSERT INTO audios VALUES (?, ?);",
+            ((_, 60_000) for _ in ids[len(directories) :]),
+        )
+    db.close()
+    return ids, directories
+
+
+def _measure(fn: Callable[[str], object], samples: list[str]) -> float:
+    """
+    Mean seconds per call.
+    """
+    begin = perf_counter()
+    for sample in samples:
+        fn(sample)
+    return (perf_counter() - begin) / len(samples)
+
+
+def _random_id() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=33))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Measure every snapshot service method, the sharded searches and every `lib`
+function against a synthetic tree, and print latency percentiles and
+throughput as JSON.
+
+    python3 -m benchmarks.service --nodes 1000000 --fan-out 50 > after.json
+"""
+
+from argparse import ArgumentParser
+from asyncio import create_task, run
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import replace
+from datetime import datetime, timedelta, UTC
+from pathlib import Path, PurePath
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import random
+
+from wcpan.drive.core.types import Node
+from wcpan.drive.sqlite import lib
+from wcpan.drive.sqlite._outer import apply_changes, initialize, set_root, walk
+from wcpan.drive.sqlite._service import SqliteSnapshotService, create_service
+from wcpan.drive.sqlite._shard import create_sharded_service
+
+from ._tree import Tree, TreeShape, generate_tree, iter_change_batches
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100_000)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--fan-out", type=int, default=20)
+    parser.add_argument("--directories", type=float, default=0.2)
+    parser.add_argument("--images", type=float, default=3.0)
+    parser.add_argument("--videos", type=float, default=1.0)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    shape = TreeShape(
+        nodes=args.nodes,
+        depth=args.depth,
+        fan_out=args.fan_out,
+        directories=args.directories,
+        images=args.images,
+        videos=args.videos,
+    )
+    tree = generate_tree(shape, seed=args.seed)
+    with TemporaryDirectory() as tmp:
+        dsn = str(Path(tmp) / "snapshot.sqlite")
+        begin = perf_counter()
+        build_snapshot(dsn, tree)
+        build_seconds = perf_counter() - begin
+
+        results = run(
+            measure_all(dsn, tree, samples=args.samples, rng=random.Random(args.seed))
+        )
+        size = Path(dsn).stat().st_size
+
+    report = {
+        "benchmark": "service",
+        "shape": vars(shape),
+        "nodes": 1 + len(tree.directories) + len(tree.files),
+        "size": size,
+        "build_seconds": build_seconds,
+        # how much slower walking is through the service than in-process
+        "walk_overhead": results["walk_tree"]["p50"]
+        / results["walk_tree.in_process"]["p50"],
+        "results": results,
+    }
+    print(json.dumps(report))
+
+
+def build_snapshot(dsn: str, tree: Tree, *, batch_size: int = 10_000) -> None:
+    initialize(dsn)
+    set_root(dsn, tree.root)
+    for index, batch in enumerate(iter_change_batches(tree, batch_size)):
+        apply_changes(dsn, batch, str(index))
+
+
+async def measure_all(
+    dsn: str, tree: Tree, *, samples: int, rng: random.Random
+) -> dict[str, dict[str, float]]:
+    directories = [tree.root] + tree.directories
+    nodes = directories + tree.files
+
+    def some_nodes(k: int = samples):
+        return rng.choices(nodes, k=k)
+
+    def some_directories(k: int = samples):
+        return rng.choices(directories, k=k)
+
+    def some_files(k: int = samples):
+        return rng.choices(tree.files, k=k)
+
+    results: dict[str, dict[str, float]] = {}
+
+    async def measure(
+        name: str, fn: Callable[[object], Awaitable[object]], inputs: list
+    ):
+        results[name] = await _measure(fn, inputs)
+
+    # the state before the writes below, to diff against
+    baseline = f"{dsn}.baseline"
+    lib.export_snapshot(dsn, baseline)
+
+    async with create_service(dsn=dsn, journal=True) as ss:
+        # paths are resolved once, outside the measurements
+        paths = [await ss.resolve_path_by_id(_.id) for _ in some_nodes()]
+        named = [_ for _ in some_nodes() if _.parent_id]
+
+        await measure(
+            "get_current_cursor", lambda _: ss.get_current_cursor(), [None] * samples
+        )
+        await measure("get_root", lambda _: ss.get_root(), [None] * samples)
+        await measure("get_node_by_id", lambda _: ss.get_node_by_id(_.id), some_nodes())
+        await measure(
+            "get_node_by_path",
+            lambda _: ss.get_node_by_path(PurePath(_)),
+            [_ for _ in paths if _],
+        )
+        await measure(
+            "resolve_path_by_id",
+            lambda _: ss.resolve_path_by_id(_.id),
+            some_nodes(),
+        )
+        await measure(
+            "get_child_by_name",
+            lambda _: ss.get_child_by_name(_.name, _.parent_id),
+            named,
+        )
+        await measure(
+            "get_children_by_id",
+            lambda _: ss.get_children_by_id(_.id),
+            some_directories(),
+        )
+        await measure(
+            "get_nodes_by_ids",
+            lambda _: ss.get_nodes_by_ids([n.id for n in _]),
+            [some_nodes(100) for _ in range(samples // 10 or 1)],
+        )
+        await measure(
+            "get_children_by_ids",
+            lambda _: ss.get_children_by_ids([n.id for n in _]),
+            [some_directories(100) for _ in range(samples // 10 or 1)],
+        )
+        await measure(
+            "walk",
+            lambda _: _drain(ss.walk(_.id)),
+            some_directories(samples // 20 or 1),
+        )
+        await measure("walk_tree", lambda _: _drain(ss.walk(_.id)), [tree.root] * 3)
+        await measure("get_trashed_nodes", lambda _: ss.get_trashed_nodes(), [None] * 5)
+        await measure(
+            "find_nodes_by_regex",
+            lambda _: ss.find_nodes_by_regex(_),
+            [r"image-\w{2}x", r"^video-", r"\.pdf$", r"[0-9]{4}"],
+        )
+        await measure(
+            "find_nodes_by_hash",
+            lambda _: ss.find_nodes_by_hash(_.hash),
+            some_files(),
+        )
+        await measure(
+            "find_media",
+            lambda _: _drain(ss.find_media(_, limit=1000)),
+            ["image", "video"] * 3,
+        )
+        await measure("get_statistics", lambda _: ss.get_statistics(), [None] * 5)
+        await measure("snapshot", lambda _: _read_snapshot(ss), [None] * samples)
+        await measure(
+            "apply_changes",
+            lambda _: ss.apply_changes([(False, _)], "bench"),
+            [_touch(_) for _ in some_nodes()],
+        )
+        await measure(
+            "ingest",
+            lambda _: _ingest(ss, _),
+            [[_touch(n, i + 2) for n in some_nodes(1000)] for i in range(5)],
+        )
+        events = ss.subscribe(block=True)
+        await measure(
+            "subscribe",
+            lambda _: _notify(ss, events, _),
+            [_touch(_, 10) for _ in some_nodes()],
+        )
+        await events.aclose()
+        await measure("set_root", lambda _: ss.set_root(tree.root), [None] * samples)
+        await measure("get_change_seq", lambda _: ss.get_change_seq(), [None] * samples)
+        await measure(
+            "iter_changes_since",
+            lambda _: _drain(ss.iter_changes_since(0)),
+            [None] * 3,
+        )
+        await measure("compact_changes", lambda _: ss.compact_changes(), [None] * 3)
+        seq = await ss.get_change_seq()
+        await measure(
+            "trim_changes",
+            lambda _: ss.trim_changes(_),
+            [seq * (i + 1) // 3 for i in range(3)],
+        )
+        await measure("maintain", lambda _: ss.maintain(), [None] * 3)
+
+    # one shard of live nodes and one of the baseline
+    async with create_sharded_service(
+        dsns={"live": dsn, "baseline": baseline}
+    ) as sharded:
+        await measure(
+            "sharded.find_nodes_by_regex",
+            lambda _: _drain(sharded.find_nodes_by_regex(_)),
+            [r"image-\w{2}x", r"^video-", r"\.pdf$", r"[0-9]{4}"],
+        )
+        await measure(
+            "sharded.find_nodes_by_hash",
+            lambda _: _drain(sharded.find_nodes_by_hash(_.hash)),
+            some_files(),
+        )
+
+    # the same walk without a worker, to tell the cost of streaming apart
+    results["walk_tree.in_process"] = _measure_sync(
+        lambda _: sum(1 for _ in walk(dsn, tree.root.id)), [None] * 3
+    )
+
+    begin = datetime(2015, 1, 1, tzinfo=UTC)
+    end = datetime.now(UTC)
+    results["lib.get_uploaded_size"] = _measure_sync(
+        lambda _: lib.get_uploaded_size(dsn, begin, end), [None] * 5
+    )
+    results["lib.get_uploaded_size_histogram"] = _measure_sync(
+        lambda _: lib.get_uploaded_size_histogram(
+            dsn, begin, end, bucket=_, group_by_mime_type=True
+        ),
+        ["hour", "day", "month"],
+    )
+    results["lib.get_statistics"] = _measure_sync(
+        lambda _: lib.get_statistics(dsn), [None] * 5
+    )
+    results["lib.find_orphan_nodes"] = _measure_sync(
+        lambda _: lib.find_orphan_nodes(dsn), [None] * 5
+    )
+    results["lib.find_multiple_parents_nodes"] = _measure_sync(
+        lambda _: lib.find_multiple_parents_nodes(dsn), [None] * 5
+    )
+    results["lib.diff_snapshots"] = _measure_sync(
+        lambda _: sum(1 for _ in lib.diff_snapshots(baseline, dsn)), [None] * 3
+    )
+    results["lib.export_snapshot"] = _measure_sync(
+        lambda _: lib.export_snapshot(dsn, _), [f"{dsn}.export{i}" for i in range(3)]
+    )
+    results["lib.import_snapshot"] = _measure_sync(
+        lambda _: lib.import_snapshot(baseline, _), [f"{dsn}.import"] * 3
+    )
+    return results
+
+
+async def _measure(fn: Callable[[object], Awaitable[object]], inputs: list) -> dict:
+    latencies: list[float] = []
+    begin = perf_counter()
+    for input_ in inputs:
+        start = perf_counter()
+        await fn(input_)
+        latencies.append(perf_counter() - start)
+    return _summarize(latencies, perf_counter() - begin)
+
+
+def _measure_sync(fn: Callable[[object], object], inputs: list) -> dict:
+    latencies: list[float] = []
+    begin = perf_counter()
+    for input_ in inputs:
+        start = perf_counter()
+        fn(input_)
+        latencies.append(perf_counter() - start)
+    return _summarize(latencies, perf_counter() - begin)
+
+
+def _summarize(latencies: list[float], total: float) -> dict[str, float]:
+    latencies.sort()
+    return {
+        "calls": len(latencies),
+        "per_second": len(latencies) / total if total else 0.0,
+        "p50": _percentile(latencies, 0.5),
+        "p90": _percentile(latencies, 0.9),
+        "p99": _percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def _percentile(ordered: list[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _drain(it: AsyncIterator[object]) -> None:
+    async for _ in it:
+        pass
+
+
+async def _read_snapshot(ss: SqliteSnapshotService) -> None:
+    async with ss.snapshot() as view:
+        await view.get_current_cursor()
+
+
+async def _ingest(ss: SqliteSnapshotService, nodes: list[Node]) -> None:
+    async with ss.ingest(chunk_size=250) as ingest:
+        for index in range(0, len(nodes), 100):
+            chunk = nodes[index : index + 100]
+            await ingest.feed([(False, _) for _ in chunk], "bench")
+
+
+async def _notify(
+    ss: SqliteSnapshotService, events: AsyncIterator[list[str]], node: Node
+) -> None:
+    # from a write to its subscriber being told
+    received = create_task(anext(events))
+    await ss.apply_changes([(False, node)], "bench")
+    await received
+
+
+def _touch(node: Node, seconds: int = 1) -> Node:
+    return replace(node, mtime=node.mtime + timedelta(seconds=seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
+import json
 import random
 import string
 from collections.abc import Iterator
 from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime, UTC
 from pathlib import Path
+from sqlite3 import Cursor
 from tempfile import TemporaryDirectory
 
 from wcpan.drive.core.types import Node
 
+from wcpan.drive.sqlite._lib import read_only
 from wcpan.drive.sqlite._outer import initialize, set_root
 
 
@@ -152,3 +156,130 @@ def create_sandbox() -> Iterator[tuple[str, Node]]:
         root = random_root()
         set_root(dsn, root)
         yield dsn, root
+
+
+def insert_v5_node(query: Cursor, node: Node) -> None:
+    query.execute(
+        "INSERT INTO nodes VALUES (?, ?, ?, ?, ?);",
+        (
+            node.id,
+            node.name,
+            node.is_trashed,
+            int(node.ctime.timestamp() * 1_000_000),
+            int(node.mtime.timestamp() * 1_000_000),
+        ),
+    )
+    if not node.is_directory:
+        query.execute(
+            "INSERT INTO files VALUES (?, ?, ?, ?);",
+            (node.id, node.mime_type, node.hash, node.size),
+        )
+    if node.parent_id:
+        query.execute("INSERT INTO parents VALUES (?, ?);", (node.id, node.parent_id))
+    if node.is_image or node.is_video:
+        query.execute(
+            "INSERT INTO images VALUES (?, ?, ?);", (node.id, node.width, node.height)
+        )
+    if node.is_video:
+        query.execute("INSERT INTO audios VALUES (?, ?);", (node.id, node.ms_duration))
+    if node.private:
+        query.execute(
+            "INSERT INTO extras VALUES (?, ?);", (node.id, json.dumps(node.private))
+        )
+
+
+def make_root(id: str) -> Node:
+    now = datetime.now(UTC)
+    return Node(
+        id=id,
+        parent_id=None,
+        name="",
+        is_directory=True,
+        is_trashed=False,
+        ctime=now,
+        mtime=now,
+        mime_type="",
+        hash="",
+        size=0,
+        is_image=False,
+        is_video=False,
+        width=0,
+        height=0,
+        ms_duration=0,
+        private=None,
+    )
+
+
+def make_dir(id: str, parent_id: str, name: str) -> Node:
+    now = datetime.now(UTC)
+    return Node(
+        id=id,
+        parent_id=parent_id,
+        name=name,
+        is_directory=True,
+        is_trashed=False,
+        ctime=now,
+        mtime=now,
+        mime_type="",
+        hash="",
+        size=0,
+        is_image=False,
+        is_video=False,
+        width=0,
+        height=0,
+        ms_duration=0,
+        private=None,
+    )
+
+
+def make_file(id: str, parent_id: str, name: str) -> Node:
+    now = datetime.now(UTC)
+    return Node(
+        id=id,
+        parent_id=parent_id,
+        name=name,
+        is_directory=False,
+        is_trashed=False,
+        ctime=now,
+        mtime=now,
+        mime_type="application/octet-stream",
+        hash="__hash__",
+        size=42,
+        is_image=False,
+        is_video=False,
+        width=0,
+        height=0,
+        ms_duration=0,
+        private=None,
+    )
+
+
+def make_image(id: str, parent_id: str, width: int) -> Node:
+    return replace(
+        make_file(id, parent_id, f"{id}.png"),
+        mime_type="image/png",
+        is_image=True,
+        width=width,
+        height=1,
+    )
+
+
+def make_video(id: str, parent_id: str, ms_duration: int) -> Node:
+    return replace(
+        make_file(id, parent_id, f"{id}.mp4"),
+        mime_type="video/mp4",
+        is_video=True,
+        width=1,
+        height=1,
+        ms_duration=ms_duration,
+    )
+
+
+# A read which only ends when it is interrupted.
+def count_forever(dsn: str) -> int:
+    with read_only(dsn) as query:
+        query.execute(
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+            "SELECT COUNT(*) FROM (SELECT x FROM c LIMIT 1000000000000);"
+        )
+        return query.fetchone()[0]
@@ -1,7 +1,14 @@
+import json
+from dataclasses import replace
+from sqlite3 import Cursor
 from unittest import TestCase
 
 from wcpan.drive.sqlite._lib import read_only, read_write
-from wcpan.drive.sqlite._inner import inner_insert_node, inner_get_node_by_id
+from wcpan.drive.sqlite._inner import (
+    inner_delete_node_by_id,
+    inner_insert_node,
+    inner_get_node_by_id,
+)
 
 from ._lib import create_sandbox, random_dir, random_file, random_image, random_video
 
@@ -53,3 +60,104 @@ class SerializationTest(TestCase):
             rv = inner_get_node_by_id(query, expected.id)
 
         self.assertEqual(rv, expected)
+
+
+class ExtrasTest(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+
+    def testShared(self):
+        a = replace(random_file(self._root.id), private={"x": "1", "y": "2"})
+        b = replace(random_file(self._root.id), private={"y": "2", "x": "1"})
+
+        with read_write(self._dsn) as query:
+            inner_insert_node(query, a)
+            inner_insert_node(query, b)
+
+        with read_only(self._dsn) as query:
+            self.assertEqual(inner_get_node_by_id(query, a.id), a)
+            self.assertEqual(inner_get_node_by_id(query, b.id), b)
+            self.assertEqual(self._refs(query, a.private), 2)
+
+    def testNotShared(self):
+        a = replace(random_file(self._root.id), private={"x": ["1"]})
+        b = replace(random_file(self._root.id), private={"x": ["1"]})
+
+        with read_write(self._dsn) as query:
+            inner_insert_node(query, a)
+            inner_insert_node(query, b)
+
+        with read_only(self._dsn) as query:
+            rv = inner_get_node_by_id(query, a.id)
+            assert rv and rv.private
+            rv.private["x"].append("2")
+            rv.private["y"] = "3"
+            self.assertEqual(inner_get_node_by_id(query, a.id), a)
+            self.assertEqual(inner_get_node_by_id(query, b.id), b)
+
+    def testRelease(self):
+        a = replace(random_file(self._root.id), private={"x": "1"})
+        b = replace(random_file(self._root.id), private={"x": "1"})
+
+        with read_write(self._dsn) as query:
+            inner_insert_node(query, a)
+            inner_insert_node(query, b)
+            inner_delete_node_by_id(query, a.id)
+
+        with read_only(self._dsn) as query:
+            self.assertEqual(self._refs(query, a.private), 1)
+
+        with read_write(self._dsn) as query:
+            inner_insert_node(query, replace(b, private=None))
+
+        with read_only(self._dsn) as query:
+            self.assertEqual(self._refs(query, a.private), 0)
+
+    def _refs(self, query: Cursor, private: dict[str, str] | None) -> int:
+        query.execute(
+            "SELECT refs FROM extras WHERE json = ?;",
+            (json.dumps(private, separators=(",", ":"), sort_keys=True),),
+        )
+        rv = query.fetchone()
+        return rv["refs"] if rv else 0
+
+
+class ChangeDetectionTest(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+
+    def testUnchanged(self):
+        node = random_video(self._root.id)
+
+        with read_write(self._dsn) as query:
+            self.assertTrue(inner_insert_node(query, node))
+            self.assertFalse(inner_insert_node(query, node))
+
+    def testChanged(self):
+        a = random_dir(self._root.id)
+        b = random_dir(self._root.id)
+        node = random_file(a.id)
+        changes = [
+            replace(node, name="renamed"),
+            replace(node, parent_id=b.id),
+            replace(node, private={"x": "1"}),
+            replace(node, private=None),
+        ]
+
+        with read_write(self._dsn) as query:
+            inner_insert_node(query, a)
+            inner_insert_node(query, b)
+            inner_insert_node(query, node)
+
+        for expected in changes:
+            with read_write(self._dsn) as query:
+                self.assertTrue(inner_insert_node(query, expected))
+
+            with read_only(self._dsn) as query:
+                rv = inner_get_node_by_id(query, expected.id)
+
+            self.assertEqual(rv, expected)
+
+    def testDeleteMissing(self):
+        with read_write(self._dsn) as query:
+            self.assertFalse(inner_delete_node_by_id(query, "missing"))
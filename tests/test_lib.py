@@ -1,4 +1,5 @@
-from asyncio import TaskGroup
+from asyncio import CancelledError, TaskGroup, create_task, sleep, timeout
+from collections.abc import Iterator
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import Manager, get_context
 from threading import Event
@@ -6,7 +7,15 @@ from sqlite3 import Cursor
 from tempfile import NamedTemporaryFile
 from unittest import IsolatedAsyncioTestCase, skip
 
-from wcpan.drive.sqlite._lib import read_write, read_only, OffMainProcess
+from wcpan.drive.sqlite._lib import (
+    CancelFlags,
+    OffMainProcess,
+    read_only,
+    read_write,
+    share_cancel_flags,
+)
+
+from ._lib import count_forever
 
 
 class TransactionTestCase(IsolatedAsyncioTestCase):
@@ -75,6 +84,87 @@ class TransactionTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv, 1)
 
 
+class CancelTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        file = self.enterContext(NamedTemporaryFile())
+        self._dsn = file.name
+        self._flags = flags = CancelFlags(4)
+        # one worker, so a stuck call would block the next one
+        self._pool = self.enterContext(
+            ProcessPoolExecutor(
+                max_workers=1,
+                initializer=share_cancel_flags,
+                initargs=(flags.shared,),
+            )
+        )
+        self._bg = OffMainProcess(
+            dsn=self._dsn, pool=self._pool, cancel=flags, timeout=0.5
+        )
+        with read_write(self._dsn) as query:
+            _prepare(query)
+
+    async def testTimeout(self):
+        with self.assertRaises(TimeoutError):
+            await self._bg(count_forever)
+
+        # the worker has been freed
+        async with timeout(5):
+            rv = await self._bg(_sync_select, "alice", None)
+        self.assertEqual(rv, 1)
+
+    async def testSlotsReleased(self):
+        for _ in range(2):
+            with self.assertRaises(TimeoutError):
+                await self._bg(count_forever)
+
+        # more calls than slots
+        async with timeout(5):
+            for _ in range(8):
+                rv = await self._bg(_sync_select, "alice", None)
+                self.assertEqual(rv, 1)
+        self.assertEqual(sorted(self._flags._free), [0, 1, 2, 3])
+
+    async def testCancel(self):
+        task = create_task(self._bg(count_forever))
+        await sleep(0.1)
+        task.cancel()
+        with self.assertRaises(CancelledError):
+            await task
+
+        async with timeout(5):
+            rv = await self._bg(_sync_select, "alice", None)
+        self.assertEqual(rv, 1)
+
+    async def testStreamTimeout(self):
+        # before the first item
+        with self.assertRaises(TimeoutError):
+            async for _ in self._bg.stream(_stream_forever):
+                pass
+
+        async with timeout(5):
+            rv = await self._bg(_sync_select, "alice", None)
+        self.assertEqual(rv, 1)
+        self.assertEqual(sorted(self._flags._free), [0, 1, 2, 3])
+
+    async def testStreamCancel(self):
+        async def consume():
+            return [_ async for _ in self._bg.stream(_stream_forever)]
+
+        task = create_task(consume())
+        await sleep(0.1)
+        task.cancel()
+        with self.assertRaises(CancelledError):
+            await task
+
+        async with timeout(5):
+            rv = await self._bg(_sync_select, "alice", None)
+        self.assertEqual(rv, 1)
+
+
+def _stream_forever(dsn: str) -> Iterator[int]:
+    yield count_forever(dsn)
+
+
 def _prepare(query: Cursor):
     query.execute(
         """
@@ -109,10 +199,11 @@ def _inner_select(query: Cursor, name: str) -> int | None:
     return rv["id"]
 
 
-def _sync_select(dsn: str, name: str, event: Event) -> int | None:
+def _sync_select(dsn: str, name: str, event: Event | None) -> int | None:
     with read_only(dsn, timeout=0) as query:
         rv = _inner_select(query, name)
-        event.wait()
+        if event:
+            event.wait()
         return rv
 
 
@@ -0,0 +1,317 @@
+from dataclasses import replace
+from datetime import datetime, UTC
+from contextlib import closing
+from pathlib import Path
+from sqlite3 import connect
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from unittest import TestCase
+
+from wcpan.drive.sqlite.exceptions import SqliteSnapshotError
+from wcpan.drive.sqlite._lib import immutable_dsn, read_only, read_write
+from wcpan.drive.sqlite._inner import (
+    inner_delete_node_by_id,
+    inner_get_node_by_id,
+    inner_get_schema_version,
+    inner_insert_node,
+)
+from wcpan.drive.sqlite._outer import (
+    apply_changes,
+    diff_snapshots,
+    export_snapshot,
+    find_orphan_nodes,
+    get_change_seq,
+    get_current_cursor,
+    get_root,
+    get_uploaded_size,
+    get_uploaded_size_histogram,
+    import_snapshot,
+    initialize,
+    walk,
+)
+from wcpan.drive.sqlite._sql import (
+    CURRENT_SCHEMA_VERSION,
+    SQL_CREATE_TABLES_V5,
+    SQL_MIGRATIONS,
+)
+
+from ._lib import (
+    create_sandbox,
+    insert_v5_node,
+    random_dir,
+    random_file,
+    random_image,
+    random_root,
+    random_video,
+)
+
+
+class DiffSnapshotsTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn_a, self._root = self.enterContext(create_sandbox())
+        self._dsn_b, _ = self.enterContext(create_sandbox())
+        # both snapshots start with the same root
+        with read_write(self._dsn_b) as query:
+            inner_delete_node_by_id(query, _.id)
+            inner_insert_node(query, self._root)
+
+    def testSame(self):
+        a = random_dir(self._root.id)
+        self._insert(self._dsn_a, a)
+        self._insert(self._dsn_b, a)
+
+        rv = list(diff_snapshots(self._dsn_a, self._dsn_b))
+        self.assertEqual(rv, [])
+
+    def testDiff(self):
+        kept = random_dir(self._root.id)
+        removed = random_file(kept.id)
+        changed = random_video(kept.id)
+        added = random_file(self._root.id)
+        self._insert(self._dsn_a, kept, removed, changed)
+        renamed = replace(changed, name="renamed", parent_id=self._root.id)
+        self._insert(self._dsn_b, kept, renamed, added)
+
+        rv = list(diff_snapshots(self._dsn_a, self._dsn_b))
+        self.assertEqual(
+            rv,
+            [
+                ("removed", removed),
+                ("added", added),
+                ("changed", renamed),
+            ],
+        )
+
+    def testMovedOrPrivate(self):
+        a = random_dir(self._root.id)
+        b = random_dir(self._root.id)
+        moved = random_file(a.id)
+        private = random_file(a.id)
+        self._insert(self._dsn_a, a, b, moved, private)
+        moved = replace(moved, parent_id=b.id)
+        private = replace(private, private={"x": 1})
+        self._insert(self._dsn_b, a, b, moved, private)
+
+        rv = list(diff_snapshots(self._dsn_a, self._dsn_b))
+        self.assertEqual(rv, [("changed", moved), ("changed", private)])
+
+    def testMultipleParents(self):
+        a = random_dir(self._root.id)
+        b = random_dir(self._root.id)
+        c = random_file(a.id)
+        for dsn in (self._dsn_a, self._dsn_b):
+            self._insert(dsn, a, b, c)
+            with read_write(dsn) as query:
+                query.execute(
+                    "INSERT INTO parents (key, parent_key) "
+                    "SELECT x.key, y.key FROM ids AS x, ids AS y "
+                    "WHERE x.id = ? AND y.id = ?;",
+                    (c.id, b.id),
+                )
+
+        rv = list(diff_snapshots(self._dsn_a, self._dsn_b))
+        self.assertEqual(rv, [])
+
+    def testParentRemoved(self):
+        a = random_dir(self._root.id)
+        b = random_dir(self._root.id)
+        c = random_file(a.id)
+        for dsn in (self._dsn_a, self._dsn_b):
+            self._insert(dsn, a, b, c)
+        # only A has the second parent
+        with read_write(self._dsn_a) as query:
+            query.execute(
+                "INSERT INTO parents (key, parent_key) "
+                "SELECT x.key, y.key FROM ids AS x, ids AS y "
+                "WHERE x.id = ? AND y.id = ?;",
+                (c.id, b.id),
+            )
+
+        rv = list(diff_snapshots(self._dsn_a, self._dsn_b))
+        self.assertEqual(rv, [("changed", c)])
+        rv = list(diff_snapshots(self._dsn_b, self._dsn_a))
+        self.assertEqual([(kind, _.id) for kind, _ in rv], [("changed", c.id)])
+
+    def _insert(self, dsn: str, *nodes):
+        with read_write(dsn) as query:
+            for node in nodes:
+                inner_insert_node(query, node)
+
+
+class ApplyChangesTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+
+    def testSkipUnchanged(self):
+        a = random_dir(self._root.id)
+        b = random_file(a.id)
+
+        rv = apply_changes(self._dsn, [(False, a), (False, b)], "1", journal=True)
+        self.assertEqual(rv, {"written": 2, "skipped": 0})
+
+        b = replace(b, name="renamed")
+        changes = [(False, a), (False, b), (True, "missing")]
+        rv = apply_changes(self._dsn, changes, "2", journal=True)
+        self.assertEqual(rv, {"written": 1, "skipped": 2})
+
+        # only real changes are journaled
+        self.assertEqual(get_change_seq(self._dsn), 3)
+
+
+class WalkTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+
+    def testLargeDirectory(self):
+        a = random_dir(self._root.id)
+        files = [random_file(a.id) for _ in range(10)]
+        with read_write(self._dsn) as query:
+            for node in [a, *files]:
+                inner_insert_node(query, node)
+
+        rv = list(walk(self._dsn, self._root.id, chunk_size=2))
+        self.assertTrue(all(rv))
+        entries = [_ for chunk in rv for _ in chunk]
+        self.assertEqual([len(f) for _, _, f in entries], [0, 10])
+
+
+class UploadedSizeHistogramTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+
+    def _add(self, ctime: datetime, size: int, mime_type: str) -> None:
+        node = replace(
+            random_file(self._root.id), ctime=ctime, size=size, mime_type=mime_type
+        )
+        apply_changes(self._dsn, [(False, node)], "1")
+
+    def testBuckets(self):
+        self._add(datetime(2020, 1, 1, 1, tzinfo=UTC), 1, "text/plain")
+        self._add(datetime(2020, 1, 1, 23, tzinfo=UTC), 2, "image/png")
+        self._add(datetime(2020, 1, 3, tzinfo=UTC), 4, "text/plain")
+        self._add(datetime(2020, 2, 1, tzinfo=UTC), 8, "text/plain")
+        begin = datetime(2020, 1, 1, tzinfo=UTC)
+        end = datetime(2020, 2, 1, tzinfo=UTC)
+
+        rv = get_uploaded_size_histogram(self._dsn, begin, end)
+        self.assertEqual(
+            rv,
+            [
+                {
+                    "begin": datetime(2020, 1, 1, tzinfo=UTC),
+                    "mime_type": None,
+                    "size": 3,
+                },
+                {
+                    "begin": datetime(2020, 1, 3, tzinfo=UTC),
+                    "mime_type": None,
+                    "size": 4,
+                },
+            ],
+        )
+
+        rv = get_uploaded_size_histogram(self._dsn, begin, end, bucket="month")
+        self.assertEqual(
+            [_["size"] for _ in rv], [get_uploaded_size(self._dsn, begin, end)]
+        )
+
+        rv = get_uploaded_size_histogram(
+            self._dsn, begin, end, bucket="hour", group_by_mime_type=True
+        )
+        self.assertEqual(
+            [(_["begin"].hour, _["mime_type"], _["size"]) for _ in rv],
+            [(1, "text/plain", 1), (23, "image/png", 2), (0, "text/plain", 4)],
+        )
+
+
+class ExportImportTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn, self._root = self.enterContext(create_sandbox())
+        self._tmp = self.enterContext(TemporaryDirectory())
+
+    def testRoundTrip(self):
+        a = random_dir(self._root.id)
+        b = random_file(a.id)
+        apply_changes(self._dsn, [(False, a), (False, b)], "1")
+        dest = str(Path(self._tmp) / "export.sqlite")
+
+        export_snapshot(self._dsn, dest)
+        target = str(Path(self._tmp) / "imported.sqlite")
+        import_snapshot(dest, target)
+
+        self.assertEqual(list(diff_snapshots(self._dsn, target)), [])
+        self.assertEqual(get_current_cursor(target), "1")
+        self.assertEqual(get_root(target), self._root)
+
+    def testImmutable(self):
+        a = random_dir(self._root.id)
+        apply_changes(self._dsn, [(False, a)], "1")
+        dest = str(Path(self._tmp) / "export.sqlite")
+        export_snapshot(self._dsn, dest)
+
+        dsn = immutable_dsn(dest)
+        self.assertEqual(get_root(dsn), self._root)
+        self.assertEqual(find_orphan_nodes(dsn), [self._root])
+
+    def testNotSnapshot(self):
+        src = str(Path(self._tmp) / "empty.sqlite")
+        with closing(connect(src)) as db:
+            db.execute("CREATE TABLE t (x);")
+        with self.assertRaises(SqliteSnapshotError):
+            import_snapshot(src, str(Path(self._tmp) / "imported.sqlite"))
+
+
+class MigrationTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn = self.enterContext(NamedTemporaryFile()).name
+
+    def testFresh(self):
+        initialize(self._dsn)
+
+        self.assertEqual(self._version(), CURRENT_SCHEMA_VERSION)
+
+    def testUpgrade(self):
+        root = random_root()
+        nodes = [
+            root,
+            random_dir(root.id),
+            random_file(root.id),
+            random_image(root.id),
+            random_video(root.id),
+        ]
+        with read_write(self._dsn) as query:
+            for sql in SQL_CREATE_TABLES_V5:
+                query.execute(sql)
+            for node in nodes:
+                insert_v5_node(query, node)
+
+        initialize(self._dsn)
+
+        with read_only(self._dsn) as query:
+            for node in nodes:
+                self.assertEqual(inner_get_node_by_id(query, node.id), node)
+            query.execute("SELECT COUNT(*) FROM nodes;")
+            self.assertEqual(query.fetchone()[0], len(nodes))
+            # the journal starts empty rather than replaying the old nodes
+            query.execute("SELECT COUNT(*) FROM changes;")
+            self.assertEqual(query.fetchone()[0], 0)
+        self.assertEqual(self._version(), CURRENT_SCHEMA_VERSION)
+
+    def testTooOld(self):
+        with read_write(self._dsn) as query:
+            query.execute("CREATE TABLE nodes (id TEXT);")
+            query.execute(f"PRAGMA user_version = {min(SQL_MIGRATIONS) - 2};")
+
+        with self.assertRaises(SqliteSnapshotError):
+            initialize(self._dsn)
+
+    def testTooNew(self):
+        with read_write(self._dsn) as query:
+            query.execute("CREATE TABLE nodes (id TEXT);")
+            query.execute(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION + 1};")
+
+        with self.assertRaises(SqliteSnapshotError):
+            initialize(self._dsn)
+
+    def _version(self) -> int:
+        with read_only(self._dsn) as query:
+            return inner_get_schema_version(query)
@@ -1,20 +1,37 @@
+from asyncio import TaskGroup, all_tasks, create_task, gather, sleep, timeout
+from contextlib import aclosing
 from dataclasses import replace
-from datetime import datetime, UTC
 from pathlib import PurePath
+from sqlite3 import OperationalError
 from tempfile import NamedTemporaryFile
+from traceback import clear_frames
+from types import NoneType
 from unittest import IsolatedAsyncioTestCase
 
 from wcpan.drive.core.exceptions import NodeNotFoundError
 from wcpan.drive.core.types import Node, ChangeAction
 from wcpan.drive.sqlite._service import create_service
+from wcpan.drive.sqlite.exceptions import SqliteSnapshotError
+from wcpan.drive.sqlite.lib import TimingRegistry
+from wcpan.drive.sqlite.types import CallTimings
 from wcpan.drive.sqlite._lib import read_only, read_write
 from wcpan.drive.sqlite._outer import (
+    inner_get_metadata,
     inner_get_node_by_id,
     inner_insert_node,
     inner_set_metadata,
     KEY_CURSOR,
 )
 
+from ._lib import (
+    count_forever,
+    make_dir,
+    make_file,
+    make_image,
+    make_root,
+    make_video,
+)
+
 
 class GetCurrentCursorTestCase(IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
@@ -45,7 +62,7 @@ class RootTestCase(IsolatedAsyncioTestCase):
             await self._ss.get_root()
 
     async def testSetRoot(self):
-        node = _make_root("123")
+        node = make_root("123")
         await self._ss.set_root(node)
 
         with read_only(self._dsn) as query:
@@ -54,7 +71,7 @@ class RootTestCase(IsolatedAsyncioTestCase):
         self.assertIsNotNone(rv)
 
     async def testGetRoot(self):
-        node = _make_root("123")
+        node = make_root("123")
         await self._ss.set_root(node)
         rv = await self._ss.get_root()
 
@@ -82,26 +99,26 @@ class GetNodeTestCase(IsolatedAsyncioTestCase):
             await self._ss.get_node_by_path(PurePath("123"))
 
     async def testRootPath(self):
-        node = _make_root("root")
+        node = make_root("root")
         await self._ss.set_root(node)
 
         rv = await self._ss.get_node_by_path(PurePath("/"))
         self.assertEqual(rv, node)
 
     async def testGetByPath(self):
-        node = _make_root("1")
+        node = make_root("1")
         await self._ss.set_root(node)
         with read_write(self._dsn) as query:
-            node = _make_dir("2", "1", "a")
+            node = make_dir("2", "1", "a")
             inner_insert_node(query, node)
-            node = _make_file("3", "2", "b")
+            node = make_file("3", "2", "b")
             inner_insert_node(query, node)
 
         rv = await self._ss.get_node_by_path(PurePath("/a/b"))
         self.assertEqual(rv, node)
 
     async def testGetById(self):
-        node = _make_root("root")
+        node = make_root("root")
         await self._ss.set_root(node)
 
         rv = await self._ss.get_node_by_id("root")
@@ -115,31 +132,31 @@ class ResolvePathTestCase(IsolatedAsyncioTestCase):
         self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
 
     async def testGoodId(self):
-        node = _make_root("1")
+        node = make_root("1")
         await self._ss.set_root(node)
         with read_write(self._dsn) as query:
-            node = _make_dir("2", "1", "a")
+            node = make_dir("2", "1", "a")
             inner_insert_node(query, node)
-            node = _make_file("3", "2", "b")
+            node = make_file("3", "2", "b")
             inner_insert_node(query, node)
 
         rv = await self._ss.resolve_path_by_id("3")
         self.assertEqual(rv, PurePath("/a/b"))
 
     async def testRootId(self):
-        node = _make_root("1")
+        node = make_root("1")
         await self._ss.set_root(node)
 
         rv = await self._ss.resolve_path_by_id("1")
         self.assertEqual(rv, PurePath("/"))
 
     async def testBadId(self):
-        node = _make_root("1")
+        node = make_root("1")
         await self._ss.set_root(node)
         with read_write(self._dsn) as query:
-            node = _make_dir("2", "1", "a")
+            node = make_dir("2", "1", "a")
             inner_insert_node(query, node)
-            node = _make_file("3", "2", "b")
+            node = make_file("3", "2", "b")
             inner_insert_node(query, node)
 
         with self.assertRaises(NodeNotFoundError):
@@ -153,50 +170,50 @@ class GetChildrenTestCase(IsolatedAsyncioTestCase):
         self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
 
     async def testGetChild(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             inner_insert_node(query, a)
-            b = _make_file("3", "2", "b")
+            b = make_file("3", "2", "b")
             inner_insert_node(query, b)
 
         rv = await self._ss.get_child_by_name("b", "2")
         self.assertEqual(rv, b)
 
     async def testGetChildFromWrongParent(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             inner_insert_node(query, a)
-            b = _make_file("3", "2", "b")
+            b = make_file("3", "2", "b")
             inner_insert_node(query, b)
 
         with self.assertRaises(NodeNotFoundError):
             await self._ss.get_child_by_name("b", "1")
 
     async def testGetChildWithNoNode(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             inner_insert_node(query, a)
-            b = _make_file("3", "2", "b")
+            b = make_file("3", "2", "b")
             inner_insert_node(query, b)
 
         with self.assertRaises(NodeNotFoundError):
             await self._ss.get_child_by_name("b", "4")
 
     async def testGetChildren(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             inner_insert_node(query, a)
-            b = _make_file("3", "2", "b")
+            b = make_file("3", "2", "b")
             inner_insert_node(query, b)
-            c = _make_file("4", "2", "c")
+            c = make_file("4", "2", "c")
             inner_insert_node(query, c)
 
         rv = await self._ss.get_children_by_id("2")
@@ -204,14 +221,14 @@ class GetChildrenTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv, [b, c])
 
     async def testGetNoChildren(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
 
         rv = await self._ss.get_children_by_id("1")
         self.assertEqual(rv, [])
 
     async def testGetChildrenWithWrongId(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
 
         # TODO maybe should raise exception
@@ -219,6 +236,168 @@ class GetChildrenTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv, [])
 
 
+class BulkLookupTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+
+    async def testGetNodes(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            a = make_dir("2", "1", "a")
+            inner_insert_node(query, a)
+            b = make_file("3", "2", "b")
+            inner_insert_node(query, b)
+
+        rv = await self._ss.get_nodes_by_ids(["1", "3", "4"])
+        self.assertEqual(rv, {"1": root, "3": b})
+
+    async def testGetChildren(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            a = make_dir("2", "1", "a")
+            inner_insert_node(query, a)
+            b = make_file("3", "2", "b")
+            inner_insert_node(query, b)
+            c = make_file("4", "2", "c")
+            inner_insert_node(query, c)
+
+        rv = await self._ss.get_children_by_ids(["1", "2", "3"])
+        rv = {k: sorted(v, key=lambda x: x.name) for k, v in rv.items()}
+        self.assertEqual(rv, {"1": [a], "2": [b, c], "3": []})
+
+    async def testManyIds(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            for i in range(2, 2002):
+                inner_insert_node(query, make_file(str(i), "1", str(i)))
+
+        ids = [str(_) for _ in range(2, 2002)]
+        rv = await self._ss.get_nodes_by_ids(ids)
+        self.assertEqual(sorted(rv.keys()), sorted(ids))
+        rv = await self._ss.get_children_by_ids(["1"])
+        self.assertEqual(len(rv["1"]), 2000)
+
+
+class WalkTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+
+    async def testWalk(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            a = make_dir("2", "1", "a")
+            inner_insert_node(query, a)
+            b = make_file("3", "1", "b")
+            inner_insert_node(query, b)
+            c = make_dir("4", "2", "c")
+            inner_insert_node(query, c)
+            d = make_file("5", "2", "d")
+            inner_insert_node(query, d)
+            e = make_dir("6", "1", "e")
+            inner_insert_node(query, e)
+
+        rv = [_ async for _ in self._ss.walk("1")]
+        rv = [(p, _sorted(d), _sorted(f)) for p, d, f in rv]
+        self.assertEqual(
+            rv,
+            [
+                (PurePath("/"), [a, e], [b]),
+                (PurePath("/a"), [c], [d]),
+                (PurePath("/e"), [], []),
+                (PurePath("/a/c"), [], []),
+            ],
+        )
+
+    async def testWalkSubtree(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            a = make_dir("2", "1", "a")
+            inner_insert_node(query, a)
+            b = make_file("3", "2", "b")
+            inner_insert_node(query, b)
+
+        rv = [_ async for _ in self._ss.walk("2")]
+        self.assertEqual(rv, [(PurePath("/a"), [], [b])])
+
+    async def testWalkFile(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        with read_write(self._dsn) as query:
+            a = make_file("2", "1", "a")
+            inner_insert_node(query, a)
+
+        rv = [_ async for _ in self._ss.walk("2")]
+        self.assertEqual(rv, [])
+
+    async def testWalkNotFound(self):
+        rv = [_ async for _ in self._ss.walk("1")]
+        self.assertEqual(rv, [])
+
+    async def testWalkLargeTree(self):
+        root = make_root("1")
+        await self._ss.set_root(root)
+        expected: dict[PurePath, int] = {PurePath("/"): 0}
+        with read_write(self._dsn) as query:
+            for i in range(50):
+                inner_insert_node(query, make_dir(f"d{i}", "1", f"d{i}"))
+                expected[PurePath(f"/d{i}")] = 50
+                for j in range(50):
+                    inner_insert_node(query, make_file(f"f{i}-{j}", f"d{i}", str(j)))
+
+        rv = {p: len(f) async for p, _, f in self._ss.walk("1")}
+        self.assertEqual(rv, expected)
+
+        # stopping early stops the worker
+        async with timeout(5):
+            for _ in range(20):
+                async for _ in self._ss.walk("1"):
+                    break
+        rv = [_ async for _ in self._ss.walk("d0")]
+        self.assertEqual(len(rv[0][2]), 50)
+
+    async def testClose(self):
+        await self._ss.set_root(make_root("1"))
+        with read_write(self._dsn) as query:
+            for i in range(50):
+                inner_insert_node(query, make_dir(f"d{i}", "1", f"d{i}"))
+
+        before = all_tasks()
+        entries = self._ss.walk("1")
+        await anext(entries)
+        await entries.aclose()
+        # a stream left to the GC would be closed later by a task
+        await sleep(0)
+        self.assertEqual(all_tasks(), before)
+
+    async def testStopFirstCall(self):
+        await self._ss.set_root(make_root("1"))
+        # more than the pipe holds
+        with read_write(self._dsn) as query:
+            for i in range(500):
+                inner_insert_node(query, make_dir(f"d{i}", "1", f"d{i}"))
+                for j in range(20):
+                    name = str(j) * 50
+                    inner_insert_node(query, make_file(f"f{i}-{j}", f"d{i}", name))
+
+        async with create_service(dsn=self._dsn) as ss:
+            # the workers are forked now, while the pipe is open
+            async with aclosing(ss.walk("1")) as entries:
+                async for _ in entries:
+                    break
+            async with timeout(10):
+                rv = await ss.get_children_by_id("d0")
+            self.assertEqual(len(rv), 20)
+
+
 class SearchNodesTestCase(IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         tmp = self.enterContext(NamedTemporaryFile())
@@ -226,13 +405,13 @@ class SearchNodesTestCase(IsolatedAsyncioTestCase):
         self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
 
     async def testGetTrashedNode(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             a = replace(a, is_trashed=True)
             inner_insert_node(query, a)
-            b = _make_file("3", "1", "b")
+            b = make_file("3", "1", "b")
             b = replace(b, is_trashed=True)
             inner_insert_node(query, b)
 
@@ -241,14 +420,14 @@ class SearchNodesTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv, [a, b])
 
     async def testSearchByRegex(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         with read_write(self._dsn) as query:
-            a = _make_dir("2", "1", "a")
+            a = make_dir("2", "1", "a")
             inner_insert_node(query, a)
-            b = _make_file("3", "1", "b")
+            b = make_file("3", "1", "b")
             inner_insert_node(query, b)
-            c = _make_file("4", "1", "c")
+            c = make_file("4", "1", "c")
             inner_insert_node(query, c)
 
         rv = await self._ss.find_nodes_by_regex(r"a|b")
@@ -256,6 +435,149 @@ class SearchNodesTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv, [a, b])
 
 
+class FindMediaTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._ss = await self.enterAsyncContext(create_service(dsn=tmp.name))
+        await self._ss.set_root(make_root("1"))
+        changes: list[ChangeAction] = []
+        for i in range(10):
+            changes.append((False, make_video(f"v{i}", "1", i * 60_000)))
+            changes.append((False, make_image(f"i{i}", "1", i * 1000)))
+        await self._ss.apply_changes(changes, "1")
+
+    async def _ids(self, *args, **kwargs) -> list[str]:
+        return [_.id async for _ in self._ss.find_media(*args, **kwargs)]
+
+    async def testLongVideos(self):
+        rv = await self._ids("video", min_duration=7 * 60_000, order_by="duration")
+        self.assertEqual(rv, ["v9", "v8", "v7"])
+
+    async def testWideImages(self):
+        rv = await self._ids(
+            "image", min_width=4000, order_by="width", descending=False
+        )
+        self.assertEqual(rv, ["i4", "i5", "i6", "i7", "i8", "i9"])
+
+    async def testPages(self):
+        pages: list[list[str]] = []
+        after = None
+        while True:
+            page = [
+                _
+                async for _ in self._ss.find_media(
+                    "video", order_by="duration", after=after, limit=4
+                )
+            ]
+            if not page:
+                break
+            pages.append([_.id for _ in page])
+            after = page[-1]
+        self.assertEqual(
+            pages,
+            [["v9", "v8", "v7", "v6"], ["v5", "v4", "v3", "v2"], ["v1", "v0"]],
+        )
+
+    async def testAfterRemoved(self):
+        # every video has the same width
+        page = [
+            _ async for _ in self._ss.find_media("video", order_by="width", limit=4)
+        ]
+        await self._ss.apply_changes([(True, page[-1].id)], "2")
+
+        rv = await self._ids("video", order_by="width", after=page[-1])
+        # the ties are repeated rather than skipped
+        self.assertEqual(
+            {_.id for _ in page[:-1]} | set(rv),
+            {f"v{_}" for _ in range(10)} - {page[-1].id},
+        )
+
+    async def testImageDuration(self):
+        with self.assertRaises(ValueError):
+            await self._ids("image", order_by="duration")
+        with self.assertRaises(ValueError):
+            await self._ids("image", min_duration=1)
+
+
+class MaintenanceTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+        await self._ss.set_root(make_root("1"))
+
+    async def testShrink(self):
+        files = [make_file(f"f{i}", "1", f"{i}" * 200) for i in range(500)]
+        await self._ss.apply_changes([(False, _) for _ in files], "1")
+        await self._ss.apply_changes([(True, _.id) for _ in files], "2")
+
+        rv = await self._ss.maintain()
+        self.assertGreater(rv["vacuumed_pages"], 0)
+
+        with read_only(self._dsn) as query:
+            query.execute("SELECT COUNT(*) FROM sqlite_stat1;")
+            self.assertGreater(query.fetchone()[0], 0)
+
+    async def testInvalidModes(self):
+        for mode in ("in_memory", "immutable"):
+            with self.subTest(mode=mode), self.assertRaises(ValueError):
+                async with create_service(
+                    dsn=self._dsn, maintenance_interval=60, **{mode: True}
+                ):
+                    pass
+
+
+class StatisticsTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._ss = await self.enterAsyncContext(create_service(dsn=tmp.name))
+        await self._ss.set_root(make_root("1"))
+
+    async def testFacets(self):
+        image = replace(
+            make_file("3", "2", "a.png"),
+            mime_type="image/png",
+            size=2,
+            is_image=True,
+            width=1,
+            height=1,
+        )
+        video = replace(
+            make_file("4", "2", "a.mp4"),
+            mime_type="video/mp4",
+            size=4,
+            is_trashed=True,
+            is_video=True,
+            width=1,
+            height=1,
+            ms_duration=1,
+        )
+        plain = replace(make_file("5", "2", "a.txt"), mime_type="text/plain", size=8)
+        changes: list[ChangeAction] = [
+            (False, make_dir("2", "1", "a")),
+            (False, image),
+            (False, video),
+            (False, plain),
+        ]
+        await self._ss.apply_changes(changes, "1")
+
+        rv = await self._ss.get_statistics()
+        self.assertEqual(rv["nodes"], {"count": 5, "size": 14})
+        self.assertEqual(rv["directories"], {"count": 2, "size": 0})
+        self.assertEqual(rv["files"], {"count": 3, "size": 14})
+        self.assertEqual(rv["images"], {"count": 1, "size": 2})
+        self.assertEqual(rv["videos"], {"count": 1, "size": 4})
+        self.assertEqual(rv["trashed"], {"count": 1, "size": 4})
+        self.assertEqual(
+            rv["mime_types"],
+            {
+                "image/png": {"count": 1, "size": 2},
+                "video/mp4": {"count": 1, "size": 4},
+                "text/plain": {"count": 1, "size": 8},
+            },
+        )
+
+
 class ApplyChangesTestCase(IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         tmp = self.enterContext(NamedTemporaryFile())
@@ -263,12 +585,12 @@ class ApplyChangesTestCase(IsolatedAsyncioTestCase):
         self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
 
     async def testPatches(self):
-        root = _make_root("1")
+        root = make_root("1")
         await self._ss.set_root(root)
         change_list: list[ChangeAction] = [
-            (False, _make_dir("2", "1", "a")),
-            (False, _make_file("3", "2", "b")),
-            (False, _make_file("4", "2", "c")),
+            (False, make_dir("2", "1", "a")),
+            (False, make_file("3", "2", "b")),
+            (False, make_file("4", "2", "c")),
             (True, "3"),
         ]
         await self._ss.apply_changes(change_list, "point")
@@ -280,67 +602,514 @@ class ApplyChangesTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(rv.id, "4")
 
 
-def _make_root(id: str) -> Node:
-    now = datetime.now(UTC)
-    return Node(
-        id=id,
-        parent_id=None,
-        name="",
-        is_directory=True,
-        is_trashed=False,
-        ctime=now,
-        mtime=now,
-        mime_type="",
-        hash="",
-        size=0,
-        is_image=False,
-        is_video=False,
-        width=0,
-        height=0,
-        ms_duration=0,
-        private=None,
-    )
-
-
-def _make_dir(id: str, parent_id: str, name: str) -> Node:
-    now = datetime.now(UTC)
-    return Node(
-        id=id,
-        parent_id=parent_id,
-        name=name,
-        is_directory=True,
-        is_trashed=False,
-        ctime=now,
-        mtime=now,
-        mime_type="",
-        hash="",
-        size=0,
-        is_image=False,
-        is_video=False,
-        width=0,
-        height=0,
-        ms_duration=0,
-        private=None,
-    )
-
-
-def _make_file(id: str, parent_id: str, name: str) -> Node:
-    now = datetime.now(UTC)
-    return Node(
-        id=id,
-        parent_id=parent_id,
-        name=name,
-        is_directory=False,
-        is_trashed=False,
-        ctime=now,
-        mtime=now,
-        mime_type="application/octet-stream",
-        hash="__hash__",
-        size=42,
-        is_image=False,
-        is_video=False,
-        width=0,
-        height=0,
-        ms_duration=0,
-        private=None,
-    )
+class JournalTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(
+            create_service(dsn=self._dsn, journal=True)
+        )
+        await self._ss.set_root(make_root("1"))
+
+    async def testDisabled(self):
+        async with create_service(dsn=self._dsn) as ss:
+            await ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        self.assertEqual(await self._ss.get_change_seq(), 0)
+
+    async def testChangesSince(self):
+        await self._ss.apply_changes(
+            [
+                (False, make_dir("2", "1", "a")),
+                (False, make_file("3", "2", "b")),
+            ],
+            "1",
+        )
+        seq = await self._ss.get_change_seq()
+        await self._ss.apply_changes([(True, "3")], "2")
+
+        rv = [_ async for _ in self._ss.iter_changes_since(0)]
+        self.assertEqual(rv, [(1, False, "2"), (2, False, "3"), (3, True, "3")])
+        rv = [_ async for _ in self._ss.iter_changes_since(seq)]
+        self.assertEqual(rv, [(3, True, "3")])
+
+    async def testCompact(self):
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        await self._ss.apply_changes([(False, make_dir("2", "1", "b"))], "2")
+        await self._ss.compact_changes()
+
+        rv = [_ async for _ in self._ss.iter_changes_since(0)]
+        self.assertEqual(rv, [(2, False, "2")])
+
+    async def testTrim(self):
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        await self._ss.apply_changes([(False, make_dir("3", "1", "b"))], "2")
+        await self._ss.trim_changes(1)
+
+        rv = [_ async for _ in self._ss.iter_changes_since(1)]
+        self.assertEqual(rv, [(2, False, "3")])
+        with self.assertRaises(SqliteSnapshotError):
+            async for _ in self._ss.iter_changes_since(0):
+                pass
+
+    async def testRetention(self):
+        async with create_service(
+            dsn=self._dsn, journal=True, journal_retention=2
+        ) as ss:
+            await ss.apply_changes(
+                [(False, make_dir(str(_), "1", str(_))) for _ in range(2, 6)], "1"
+            )
+            rv = [_ async for _ in ss.iter_changes_since(2)]
+        self.assertEqual(rv, [(3, False, "4"), (4, False, "5")])
+
+
+class LanesTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._ss = await self.enterAsyncContext(
+            create_service(dsn=tmp.name, bulk_workers=1, query_timeout=5)
+        )
+        await self._ss.set_root(make_root("1"))
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+
+    async def testBothLanes(self):
+        rv = [_ async for _ in self._ss.walk("1")]
+        self.assertEqual(len(rv), 2)
+        rv = await self._ss.find_nodes_by_regex("^a$")
+        self.assertEqual([_.id for _ in rv], ["2"])
+        rv = await self._ss.get_node_by_path(PurePath("/a"))
+        self.assertEqual(rv.id, "2")
+
+
+class ReplicaTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(
+            create_service(dsn=tmp.name, replicas=2, journal=True)
+        )
+        await self._ss.set_root(make_root("1"))
+
+    async def testNeedsJournal(self):
+        with self.assertRaises(ValueError):
+            async with create_service(dsn=self._dsn, replicas=1):
+                pass
+
+    async def testTimeout(self):
+        async with create_service(
+            dsn=self._dsn, replicas=1, journal=True, query_timeout=0.5
+        ) as ss:
+            with self.assertRaises(TimeoutError):
+                await ss._bg(count_forever)
+            # the query has been interrupted, so the replica is free again
+            async with timeout(5):
+                self.assertEqual(await ss.get_current_cursor(), "")
+
+    async def testCloseStream(self):
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        before = all_tasks()
+        entries = self._ss.walk("1")
+        await anext(entries)
+        await entries.aclose()
+        await sleep(0)
+        self.assertEqual(all_tasks(), before)
+
+    async def testReadsSeeWrites(self):
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        rv = await self._ss.get_node_by_path(PurePath("/a"))
+        self.assertEqual(rv.id, "2")
+
+        await self._ss.apply_changes(
+            [(False, make_file("3", "2", "b")), (True, "2")], "2"
+        )
+        # every replica is refreshed, whichever serves the read
+        for _ in range(4):
+            self.assertEqual(await self._ss.get_current_cursor(), "2")
+            with self.assertRaises(NodeNotFoundError):
+                await self._ss.get_node_by_id("2")
+
+    async def testReadd(self):
+        await self._ss.apply_changes(
+            [(False, make_dir("2", "1", "a")), (False, make_file("3", "2", "b"))],
+            "1",
+        )
+        await self._ss.get_children_by_id("2")
+        # removing a directory detaches its children, even if it comes back
+        await self._ss.apply_changes(
+            [(True, "2"), (False, make_dir("2", "1", "a"))], "2"
+        )
+        for _ in range(4):
+            self.assertEqual(await self._ss.get_children_by_id("2"), [])
+
+    async def testJournal(self):
+        for i in range(2, 5):
+            await self._ss.apply_changes([(False, make_dir("2", "1", str(i)))], str(i))
+            await self._ss.get_change_seq()
+        await self._ss.compact_changes()
+        for _ in range(4):
+            rv = [_ async for _ in self._ss.iter_changes_since(0)]
+            self.assertEqual(rv, [(3, False, "2")])
+
+        await self._ss.trim_changes(3)
+        await self._ss.apply_changes([(False, make_dir("3", "1", "b"))], "5")
+        for _ in range(4):
+            rv = [_ async for _ in self._ss.iter_changes_since(3)]
+            self.assertEqual(rv, [(4, False, "3")])
+            self.assertEqual(await self._ss.get_change_seq(), 4)
+
+    async def testDiscarded(self):
+        await self._ss.get_change_seq()
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        await self._ss.apply_changes([(False, make_dir("3", "1", "b"))], "2")
+        # before the replicas have seen them
+        await self._ss.trim_changes(2)
+        for _ in range(4):
+            rv = await self._ss.get_children_by_id("1")
+            self.assertEqual(sorted(_.id for _ in rv), ["2", "3"])
+
+    async def testWalk(self):
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        root = await self._ss.get_root()
+        rv = [_ async for _ in self._ss.walk(root.id)]
+        self.assertEqual(len(rv), 2)
+
+
+class ImmutableTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        async with create_service(dsn=self._dsn) as ss:
+            await ss.set_root(make_root("1"))
+            await ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+
+    async def testRead(self):
+        async with create_service(dsn=self._dsn, immutable=True) as ss:
+            rv = await ss.get_node_by_path(PurePath("/a"))
+            self.assertEqual(rv.id, "2")
+            self.assertEqual(await ss.get_current_cursor(), "1")
+            rv = [_ async for _ in ss.walk("1")]
+            self.assertEqual(len(rv), 2)
+
+    async def testNoWrite(self):
+        async with create_service(dsn=self._dsn, immutable=True) as ss:
+            with self.assertRaises(OperationalError):
+                await ss.apply_changes([(True, "2")], "2")
+
+        with read_only(self._dsn) as query:
+            self.assertIsNotNone(inner_get_node_by_id(query, "2"))
+
+    async def testOldSchema(self):
+        with read_write(self._dsn) as query:
+            query.execute("PRAGMA user_version = 5;")
+        with self.assertRaises(SqliteSnapshotError):
+            async with create_service(dsn=self._dsn, immutable=True):
+                pass
+
+    async def testBulkWorkers(self):
+        with self.assertRaises(ValueError):
+            async with create_service(dsn=self._dsn, immutable=True, bulk_workers=1):
+                pass
+
+
+class InMemoryTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+
+    async def testInvalidOptions(self):
+        with self.assertRaises(ValueError):
+            async with create_service(dsn=self._dsn, in_memory=True, bulk_workers=1):
+                pass
+        with self.assertRaises(ValueError):
+            async with create_service(dsn=self._dsn, in_memory=True, query_timeout=1):
+                pass
+
+    async def testCheckpointOnExit(self):
+        async with create_service(dsn=self._dsn, in_memory=True) as ss:
+            await ss.set_root(make_root("1"))
+            await ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+            rv = await ss.get_node_by_path(PurePath("/a"))
+            self.assertEqual(rv.id, "2")
+
+        async with create_service(dsn=self._dsn) as ss:
+            rv = await ss.get_node_by_path(PurePath("/a"))
+            self.assertEqual(rv.id, "2")
+            self.assertEqual(await ss.get_current_cursor(), "1")
+
+    async def testCheckpointOnInterval(self):
+        async with create_service(
+            dsn=self._dsn, in_memory=True, checkpoint_interval=0.1
+        ) as ss:
+            await ss.set_root(make_root("1"))
+            await ss.apply_changes([], "1")
+            await sleep(0.5)
+            with read_only(self._dsn) as query:
+                rv = inner_get_metadata(query, KEY_CURSOR)
+            self.assertEqual(rv, "1")
+
+
+class InstrumentationTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._timings: list[CallTimings] = []
+        with self.assertLogs("wcpan.drive.sqlite._lib", "WARNING"):
+            self._ss = await self.enterAsyncContext(
+                create_service(
+                    dsn=tmp.name,
+                    timing_sink=self._timings.append,
+                    slow_query_seconds=0,
+                )
+            )
+            await self._ss.set_root(make_root("1"))
+            await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        self._timings.clear()
+
+    async def testPhases(self):
+        with self.assertLogs("wcpan.drive.sqlite._lib", "WARNING"):
+            await self._ss.get_node_by_id("2")
+
+        self.assertEqual(len(self._timings), 1)
+        rv = self._timings[0]
+        self.assertEqual(rv.name, "get_node_by_id")
+        self.assertGreater(rv.connect, 0)
+        self.assertGreater(rv.sql, 0)
+        self.assertGreater(rv.hydrate, 0)
+        self.assertGreater(rv.transfer, 0)
+        self.assertGreaterEqual(rv.total, rv.queue_wait + rv.sql + rv.hydrate)
+
+        self.assertEqual(len(rv.slow_queries), 1)
+        self.assertIn("nodes", rv.slow_queries[0].sql)
+        self.assertTrue(rv.slow_queries[0].plan)
+
+    async def testRegistry(self):
+        registry = TimingRegistry()
+        with self.assertLogs("wcpan.drive.sqlite._lib", "WARNING"):
+            await self._ss.get_node_by_id("2")
+            await self._ss.get_node_by_id("2")
+        for timings in self._timings:
+            registry(timings)
+
+        rv = registry.summary()
+        self.assertEqual(rv["get_node_by_id"]["calls"], 2)
+        self.assertEqual(sum(rv["get_node_by_id"]["sql"]["buckets"]), 2)
+        self.assertEqual(len(registry.slow_queries), 2)
+
+
+class SnapshotTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+        await self._ss.set_root(make_root("1"))
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+
+    async def testPinned(self):
+        async with self._ss.snapshot() as view:
+            node = await view.get_node_by_path(PurePath("/a"))
+            await self._ss.apply_changes(
+                [(False, make_file("3", "2", "b")), (True, "2")], "2"
+            )
+
+            # still the same state as before
+            rv = await view.get_children_by_id(node.id)
+            self.assertEqual(rv, [])
+            rv = await view.resolve_path_by_id(node.id)
+            self.assertEqual(rv, PurePath("/a"))
+            self.assertEqual(await view.get_current_cursor(), "1")
+
+        with self.assertRaises(NodeNotFoundError):
+            await self._ss.get_node_by_id("2")
+        self.assertEqual(await self._ss.get_current_cursor(), "2")
+
+    async def testConcurrent(self):
+        async with self._ss.snapshot() as first:
+            await self._ss.apply_changes([(True, "2")], "2")
+            async with self._ss.snapshot() as second:
+                await self._ss.apply_changes([], "3")
+                self.assertEqual(await first.get_current_cursor(), "1")
+                self.assertEqual(await second.get_current_cursor(), "2")
+                rv = [_ async for _ in first.walk("1")]
+                self.assertEqual(len(rv), 2)
+                with self.assertRaises(RuntimeError):
+                    async with second.snapshot():
+                        pass
+        # the pinned connections have been released
+        async with self._ss.snapshot() as third:
+            self.assertEqual(await third.get_current_cursor(), "3")
+
+    async def testTimeout(self):
+        async with (
+            create_service(dsn=self._dsn, query_timeout=0.5) as ss,
+            ss.snapshot() as view,
+        ):
+            with self.assertRaises(TimeoutError):
+                await view._bg(count_forever)
+            async with timeout(5):
+                self.assertEqual(await view.get_current_cursor(), "1")
+
+
+class WriteQueueTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(
+            create_service(dsn=self._dsn, journal=True)
+        )
+        await self._ss.set_root(make_root("1"))
+
+    async def testParallelWrite(self):
+        async with TaskGroup() as group:
+            for i in range(2, 12):
+                changes: list[ChangeAction] = [(False, make_dir(str(i), "1", str(i)))]
+                group.create_task(self._ss.apply_changes(changes, str(i)))
+
+        rv = await self._ss.get_children_by_id("1")
+        self.assertEqual(len(rv), 10)
+        self.assertEqual(await self._ss.get_current_cursor(), "11")
+
+        with read_only(self._dsn) as query:
+            query.execute("SELECT DISTINCT cursor FROM changes;")
+            rv = [_["cursor"] for _ in query]
+        # queued batches have been committed together
+        self.assertLess(len(rv), 10)
+
+    async def testFailedBatch(self):
+        # sets are not JSON
+        bad = replace(make_dir("3", "1", "b"), private={"a": {1}})
+        batches: list[list[ChangeAction]] = [
+            [(False, make_dir("2", "1", "a"))],
+            [(False, bad)],
+            [(False, make_dir("4", "1", "c"))],
+            [(False, make_dir("5", "1", "d"))],
+        ]
+        results = await gather(
+            *(self._ss.apply_changes(_, str(i)) for i, _ in enumerate(batches)),
+            return_exceptions=True,
+        )
+        self.assertEqual(
+            [type(_) for _ in results], [NoneType, TypeError, NoneType, NoneType]
+        )
+
+        rv = await self._ss.get_children_by_id("1")
+        self.assertEqual(sorted(_.id for _ in rv), ["2", "4", "5"])
+        self.assertEqual(await self._ss.get_current_cursor(), "3")
+
+    async def testFailedWrite(self):
+        with self.assertRaises(ValueError) as context:
+            await self._ss._writes.submit(_fail)
+        # as unittest does with expected errors
+        clear_frames(context.exception.__traceback__)
+
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        self.assertEqual(await self._ss.get_current_cursor(), "1")
+
+
+class IngestTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+        await self._ss.set_root(make_root("1"))
+
+    async def testFeed(self):
+        async with self._ss.ingest(chunk_size=2) as ingest:
+            await ingest.feed(
+                [(False, make_dir(str(_), "1", str(_))) for _ in range(2, 7)], "a"
+            )
+            await ingest.feed([(True, "2")], "b")
+            await ingest.feed([], "c")
+
+        rv = await self._ss.get_children_by_id("1")
+        self.assertEqual(sorted(_.id for _ in rv), ["3", "4", "5", "6"])
+        self.assertEqual(await self._ss.get_current_cursor(), "c")
+
+    async def testCursorFollowsCommits(self):
+        async with create_service(dsn=self._dsn, journal=True) as ss:
+            async with ss.ingest(chunk_size=2) as ingest:
+                await ingest.feed(
+                    [(False, make_dir(str(_), "1", str(_))) for _ in range(2, 7)],
+                    "a",
+                )
+
+        with read_only(self._dsn) as query:
+            query.execute("SELECT cursor FROM changes ORDER BY seq;")
+            rv = [_["cursor"] for _ in query]
+
+        # the cursor only moves once the whole batch is committed
+        self.assertEqual(rv, ["", "", "", "", "a"])
+
+    async def testWriteError(self):
+        # sets are not JSON
+        bad: list[ChangeAction] = [
+            (False, replace(make_dir("2", "1", "a"), private={"a": {1}}))
+        ]
+        good: list[ChangeAction] = [(False, make_dir("3", "1", "b"))]
+        async with timeout(5):
+            with self.assertRaises(TypeError):
+                async with self._ss.ingest(max_pending=1) as ingest:
+                    await ingest.feed(bad, "a")
+                    for _ in range(4):
+                        await ingest.feed(good, "b")
+
+    async def testError(self):
+        with self.assertRaises(ValueError):
+            async with self._ss.ingest() as ingest:
+                await ingest.feed([(False, make_dir("2", "1", "a"))], "a")
+                raise ValueError()
+
+
+class SubscribeTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(NamedTemporaryFile())
+        self._dsn = tmp.name
+        self._ss = await self.enterAsyncContext(create_service(dsn=self._dsn))
+        await self._ss.set_root(make_root("1"))
+
+    async def testSubscribe(self):
+        async def consume(count: int):
+            rv: list[list[str]] = []
+            async for batch in self._ss.subscribe():
+                rv.append(batch)
+                if len(rv) >= count:
+                    break
+            return rv
+
+        task = create_task(consume(2))
+        await sleep(0)
+        await self._ss.apply_changes(
+            [(False, make_dir("2", "1", "a")), (False, make_dir("3", "1", "b"))],
+            "1",
+        )
+        await self._ss.apply_changes([(True, "2")], "2")
+
+        rv = await task
+        self.assertEqual(rv, [["2", "3"], ["2"]])
+
+    async def testDropOldest(self):
+        batches = aiter(self._ss.subscribe(max_size=1))
+        task = create_task(anext(batches))
+        await sleep(0)
+        await self._ss.apply_changes([(False, make_dir("2", "1", "a"))], "1")
+        await self._ss.apply_changes([(False, make_dir("3", "1", "b"))], "2")
+        await self._ss.apply_changes([(False, make_dir("4", "1", "c"))], "3")
+
+        # the first one was taken before the others arrived
+        self.assertEqual(await task, ["2"])
+        self.assertEqual(await anext(batches), ["4"])
+        await batches.aclose()
+
+    async def testClose(self):
+        async def consume():
+            return [_ async for _ in self._ss.subscribe()]
+
+        task = create_task(consume())
+        await sleep(0)
+        await self._ss.close()
+        self.assertEqual(await task, [])
+
+
+def _fail(dsn: str) -> None:
+    raise ValueError(dsn)
+
+
+def _sorted(nodes: list[Node]) -> list[Node]:
+    return sorted(nodes, key=lambda x: x.name)
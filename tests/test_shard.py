@@ -0,0 +1,87 @@
+from asyncio import CancelledError, all_tasks, create_task, sleep, timeout
+from pathlib import Path, PurePath
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase
+
+from wcpan.drive.core.exceptions import NodeNotFoundError
+
+from wcpan.drive.sqlite._shard import create_sharded_service
+
+from ._lib import count_forever, make_dir, make_file, make_root
+
+
+class ShardedServiceTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = self.enterContext(TemporaryDirectory())
+        self._dsns = dsns = {_: str(Path(tmp) / f"{_}.sqlite") for _ in ("a", "b", "c")}
+        self._ss = await self.enterAsyncContext(
+            create_sharded_service(dsns=dsns, max_workers=2)
+        )
+        for name in self._ss.names:
+            shard = self._ss[name]
+            await shard.set_root(make_root(f"{name}0"))
+            await shard.apply_changes(
+                [
+                    (False, make_dir(f"{name}1", f"{name}0", "shared")),
+                    (False, make_file(f"{name}2", f"{name}1", f"only-{name}")),
+                ],
+                "1",
+            )
+
+    async def testShardsAreSeparate(self):
+        rv = await self._ss["a"].get_node_by_path(PurePath("/shared/only-a"))
+        self.assertEqual(rv.id, "a2")
+        with self.assertRaises(NodeNotFoundError):
+            await self._ss["b"].get_node_by_path(PurePath("/shared/only-a"))
+
+    async def testRegex(self):
+        rv = {
+            name: nodes
+            async for name, nodes in self._ss.find_nodes_by_regex("^only-[ab]$")
+        }
+        self.assertEqual(
+            {name: [_.id for _ in nodes] for name, nodes in rv.items()},
+            {"a": ["a2"], "b": ["b2"], "c": []},
+        )
+
+    async def testStopEarly(self):
+        before = all_tasks()
+        searches = self._ss.find_nodes_by_regex("^only-")
+        await anext(searches)
+        await searches.aclose()
+        # the searches of the other shards are not left behind
+        self.assertEqual(all_tasks(), before)
+
+    async def testInterrupt(self):
+        # one reader, so a stuck read would block the others
+        async with create_sharded_service(
+            dsns=self._dsns, max_workers=1, query_timeout=0.5
+        ) as ss:
+            with self.assertRaises(TimeoutError):
+                await ss["a"]._bg(count_forever)
+
+            task = create_task(ss["b"]._bg(count_forever))
+            await sleep(0.1)
+            task.cancel()
+            with self.assertRaises(CancelledError):
+                await task
+
+            async with timeout(5):
+                rv = await ss["c"].get_node_by_id("c2")
+            self.assertEqual(rv.id, "c2")
+
+    async def testHash(self):
+        node = await self._ss["c"].get_node_by_id("c2")
+        rv = {
+            name: [_.id for _ in nodes]
+            async for name, nodes in self._ss.find_nodes_by_hash(node.hash)
+        }
+        self.assertEqual(rv, {"a": ["a2"], "b": ["b2"], "c": ["c2"]})
+
+    async def testSnapshot(self):
+        async with self._ss["a"].snapshot() as a, self._ss["b"].snapshot() as b:
+            await self._ss["a"].apply_changes([(True, "a2")], "2")
+            self.assertEqual((await a.get_node_by_id("a2")).id, "a2")
+            self.assertEqual(await b.get_current_cursor(), "1")
+        with self.assertRaises(NodeNotFoundError):
+            await self._ss["a"].get_node_by_id("a2")
@@ -0,0 +1,112 @@
+from unittest import TestCase
+
+from wcpan.drive.sqlite._lib import read_only
+from wcpan.drive.sqlite._sql import (
+    SQL_JOIN_TABLES,
+    SQL_MEDIA_KINDS,
+    SQL_SELECT_CHILD_BY_NAME,
+    SQL_SELECT_CHILD_KEY_BY_NAME,
+    SQL_SELECT_CHILDREN_BY_ID,
+    SQL_SELECT_CHANGED_NODES,
+    SQL_SELECT_CHILDREN_BY_IDS,
+    SQL_SELECT_NODE_BY_ID,
+    SQL_SELECT_NODE_BY_KEY,
+    SQL_SELECT_NODES_BY_HASH,
+    SQL_SELECT_NODES_BY_IDS,
+    SQL_SELECT_TRASHED_NODES,
+    SQL_SUM_SIZE_BY_CREATED,
+    SQL_WALK_TREE,
+)
+
+from ._lib import create_sandbox
+
+
+# hot query -> sample parameters
+_HOT_QUERIES = {
+    "node_by_id": (SQL_SELECT_NODE_BY_ID, ("x",)),
+    "node_by_key": (SQL_SELECT_NODE_BY_KEY, (1,)),
+    "nodes_by_ids": (SQL_SELECT_NODES_BY_IDS, ('["x"]',)),
+    "nodes_by_hash": (SQL_SELECT_NODES_BY_HASH, ("x",)),
+    "child_by_name": (SQL_SELECT_CHILD_BY_NAME, ("x", "n")),
+    "child_key_by_name": (SQL_SELECT_CHILD_KEY_BY_NAME, (1, "n")),
+    "children_by_id": (SQL_SELECT_CHILDREN_BY_ID, ("x",)),
+    "children_by_ids": (SQL_SELECT_CHILDREN_BY_IDS, ('["x"]',)),
+    "trashed_nodes": (SQL_SELECT_TRASHED_NODES, ()),
+    "walk_tree": (SQL_WALK_TREE, ("x",)),
+    "sum_size_by_created": (SQL_SUM_SIZE_BY_CREATED, (0, 1)),
+    "long_videos": (
+        SQL_JOIN_TABLES
+        + f"WHERE {SQL_MEDIA_KINDS['video']} AND nodes.ms_duration >= ? "
+        + "ORDER BY nodes.ms_duration DESC, nodes.key DESC;",
+        (0,),
+    ),
+    "wide_images": (
+        SQL_JOIN_TABLES
+        + f"WHERE {SQL_MEDIA_KINDS['image']} AND nodes.width >= ? "
+        + "ORDER BY nodes.width DESC, nodes.key DESC;",
+        (0,),
+    ),
+    "recent_videos": (
+        SQL_JOIN_TABLES
+        + f"WHERE {SQL_MEDIA_KINDS['video']} "
+        + "ORDER BY nodes.updated DESC, nodes.key DESC LIMIT ?;",
+        (10,),
+    ),
+}
+# Full scans which are fine: the JSON argument, the recursive queue, and
+# walking recent nodes in order until the limit.
+_ALLOWED_SCANS = (
+    "SCAN json_each",
+    "SCAN tree",
+    "SCAN nodes USING INDEX ix_nodes_updated",
+)
+
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self) -> None:
+        self._dsn, _ = self.enterContext(create_sandbox())
+
+    def _plan(self, sql: str, parameters: tuple[object, ...]) -> list[str]:
+        with read_only(self._dsn) as query:
+            query.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            return [_["detail"] for _ in query]
+
+    def testNoTableScan(self):
+        for name, (sql, parameters) in _HOT_QUERIES.items():
+            with self.subTest(name=name):
+                plan = self._plan(sql, parameters)
+                scans = [
+                    _
+                    for _ in plan
+                    if _.startswith("SCAN") and not _.startswith(_ALLOWED_SCANS)
+                ]
+                self.assertEqual(scans, [], plan)
+
+    def testTrashedUsesPartialIndex(self):
+        plan = self._plan(*_HOT_QUERIES["trashed_nodes"])
+        self.assertIn("SEARCH nodes USING INDEX ix_nodes_trashed (trashed=?)", plan)
+
+    def testSumSizeIsCovered(self):
+        plan = self._plan(*_HOT_QUERIES["sum_size_by_created"])
+        self.assertIn(
+            "SEARCH nodes USING COVERING INDEX ix_nodes_created_size "
+            "(created>? AND created<?)",
+            plan,
+        )
+
+    def testDiffPairsByIndex(self):
+        with read_only(self._dsn) as query:
+            query.execute("ATTACH DATABASE ? AS other;", (self._dsn,))
+            query.execute(f"EXPLAIN QUERY PLAN {SQL_SELECT_CHANGED_NODES}")
+            plan = [_["detail"] for _ in query]
+        # only the nodes of B are scanned, each pair is found by index
+        self.assertEqual([_ for _ in plan if _.startswith("SCAN")], ["SCAN nodes"])
+        self.assertIn("SEARCH a_ids USING COVERING INDEX ux_ids_id (id=?)", plan)
+
+    def testChildrenAreCovered(self):
+        plan = self._plan(*_HOT_QUERIES["children_by_id"])
+        self.assertIn(
+            "SEARCH parents USING COVERING INDEX ix_parents_parent_key "
+            "(parent_key=?)",
+            plan,
+        )
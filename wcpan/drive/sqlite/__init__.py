@@ -1,7 +1,8 @@
 from importlib.metadata import version
 
 from ._service import create_service as create_service
+from ._shard import create_sharded_service as create_sharded_service
 
 
 __version__ = version(__package__ or __name__)
-__all__ = ("create_service",)
+__all__ = ("create_service", "create_sharded_service")
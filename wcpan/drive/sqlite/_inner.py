@@ -1,9 +1,15 @@
 from datetime import datetime, UTC
+from functools import lru_cache
+from pathlib import PurePath
 from sqlite3 import Cursor
+from typing import Any
 import json
 
-from wcpan.drive.core.types import Node
+from wcpan.drive.core.lib import dispatch_change
+from wcpan.drive.core.types import ChangeAction, Node, PrivateDict
 
+from .exceptions import SqliteSnapshotError
+from ._lib import counted_as_hydration
 from ._sql import JoinedDict
 
 
@@ -19,6 +25,30 @@ def inner_get_metadata(query: Cursor, key: str) -> str | None:
     return rv["value"]
 
 
+def inner_get_schema_version(query: Cursor) -> int:
+    query.execute("PRAGMA user_version;")
+    rv = query.fetchone()
+    if not rv:
+        raise SqliteSnapshotError("no user_version")
+    return int(rv[0])
+
+
+def inner_get_key(query: Cursor, node_id: str) -> int | None:
+    query.execute("SELECT key FROM ids WHERE id = ?;", (node_id,))
+    rv = query.fetchone()
+    if not rv:
+        return None
+    return rv["key"]
+
+
+def inner_ensure_key(query: Cursor, node_id: str) -> int:
+    key = inner_get_key(query, node_id)
+    if key is not None:
+        return key
+    query.execute("INSERT INTO ids (id) VALUES (?) RETURNING key;", (node_id,))
+    return query.fetchone()["key"]
+
+
 def inner_get_node_by_id(query: Cursor, node_id: str) -> Node | None:
     from ._sql import SQL_SELECT_NODE_BY_ID
 
@@ -29,84 +59,284 @@ def inner_get_node_by_id(query: Cursor, node_id: str) -> Node | None:
     return node_from_query(rv)
 
 
-def inner_insert_node(query: Cursor, node: Node) -> None:
-    # add this node
+def inner_get_node_by_key(query: Cursor, key: int) -> Node | None:
+    from ._sql import SQL_SELECT_NODE_BY_KEY
+
+    query.execute(SQL_SELECT_NODE_BY_KEY, (key,))
+    rv = query.fetchone()
+    if not rv:
+        return None
+    return node_from_query(rv)
+
+
+def inner_resolve_path_by_id(query: Cursor, node_id: str) -> PurePath | None:
+    key = inner_get_key(query, node_id)
+    if key is None:
+        return None
+
+    parts: list[str] = []
+    while True:
+        query.execute("SELECT name FROM nodes WHERE key=?;", (key,))
+        rv = query.fetchone()
+        if not rv:
+            return None
+
+        name = rv["name"]
+
+        query.execute("SELECT parent_key FROM parents WHERE key=?;", (key,))
+        rv = query.fetchone()
+        if not rv:
+            # reached root
+            parts.insert(0, "/")
+            break
+
+        parts.insert(0, name)
+        key = rv["parent_key"]
+
+    path = PurePath(*parts)
+    return path
+
+
+def inner_insert_node(query: Cursor, node: Node) -> bool:
+    """
+    Store the node. Returns False if it is already stored as is, in which
+    case nothing is written.
+    """
+    key = inner_ensure_key(query, node.id)
+
+    # the file and media columns stay NULL if not applicable
+    values = (
+        node.name,
+        node.is_trashed,
+        int(node.ctime.timestamp() * 1_000_000),
+        int(node.mtime.timestamp() * 1_000_000),
+        None if node.is_directory else node.mime_type,
+        None if node.is_directory else node.hash,
+        None if node.is_directory else node.size,
+        node.width if node.is_image or node.is_video else None,
+        node.height if node.is_image or node.is_video else None,
+        node.ms_duration if node.is_video else None,
+    )
+    extra_json = _dump_private(node.private) if node.private else None
+    parent_key = inner_get_key(query, node.parent_id) if node.parent_id else None
+
     query.execute(
-        "INSERT OR REPLACE INTO nodes "
-        "(id, name, trashed, created, updated) "
-        "VALUES "
-        "(?, ?, ?, ?, ?);",
-        (
-            node.id,
-            node.name,
-            node.is_trashed,
-            int(node.ctime.timestamp() * 1_000_000),
-            int(node.mtime.timestamp() * 1_000_000),
-        ),
+        "SELECT name, trashed, created, updated, "
+        "mime_type, hash, size, width, height, ms_duration, "
+        "extra, extras.json AS json "
+        "FROM nodes "
+        "LEFT JOIN extras ON nodes.extra = extras.key "
+        "WHERE nodes.key=?;",
+        (key,),
+    )
+    old = query.fetchone()
+    query.execute("SELECT parent_key FROM parents WHERE key=?;", (key,))
+    old_parent_keys = [_["parent_key"] for _ in query]
+
+    same_node = old is not None and tuple(old)[:10] == values
+    same_extra = old is not None and old["json"] == extra_json
+    same_parent = (
+        old_parent_keys == [parent_key]
+        if parent_key is not None
+        else not old_parent_keys and not node.parent_id
     )
+    if same_node and same_extra and same_parent:
+        return False
+
+    if not same_extra:
+        # add extra information
+        extra = inner_acquire_extra(query, extra_json) if extra_json else None
+    else:
+        extra = old["extra"]
 
-    # add file information
-    if not node.is_directory:
+    # add this node
+    if not old:
         query.execute(
-            "INSERT OR REPLACE INTO files "
-            "(id, mime_type, hash, size) "
+            "INSERT INTO nodes "
+            "(name, trashed, created, updated, "
+            "mime_type, hash, size, width, height, ms_duration, extra, key) "
             "VALUES "
-            "(?, ?, ?, ?);",
-            (node.id, node.mime_type, node.hash, node.size),
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            values + (extra, key),
         )
-
-    # remove old parentage
-    query.execute("DELETE FROM parents WHERE id=?;", (node.id,))
-    # add parentage if there is any
-    if node.parent_id:
+    elif not same_node or not same_extra:
+        # only indices of changed columns are touched
         query.execute(
-            "INSERT INTO parents (id, parent_id) VALUES (?, ?);",
-            (node.id, node.parent_id),
+            "UPDATE nodes SET "
+            "name=?, trashed=?, created=?, updated=?, "
+            "mime_type=?, hash=?, size=?, width=?, height=?, ms_duration=?, "
+            "extra=? "
+            "WHERE key=?;",
+            values + (extra, key),
         )
 
-    # add image information
-    if node.is_image or node.is_video:
-        query.execute(
-            "INSERT OR REPLACE INTO images (id, width, height) VALUES (?, ?, ?);",
-            (node.id, node.width, node.height),
-        )
+    if old and not same_extra and old["extra"] is not None:
+        inner_release_extra(query, old["extra"])
 
-    # add audio information
-    if node.is_video:
-        query.execute(
-            "INSERT OR REPLACE INTO audios (id, ms_duration) VALUES (?, ?);",
-            (node.id, node.ms_duration),
-        )
+    if not same_parent:
+        # remove old parentage
+        query.execute("DELETE FROM parents WHERE key=?;", (key,))
+        # add parentage if there is any
+        if node.parent_id:
+            if parent_key is None:
+                parent_key = inner_ensure_key(query, node.parent_id)
+            query.execute(
+                "INSERT INTO parents (key, parent_key) VALUES (?, ?);",
+                (key, parent_key),
+            )
 
-    # add extra information
-    if node.private:
-        extra = json.dumps(node.private, separators=(",", ":"))
-        query.execute(
-            "INSERT OR REPLACE INTO extras (id, json) VALUES (?, ?);",
-            (node.id, extra),
-        )
+    return True
+
+
+def inner_delete_node_by_id(query: Cursor, node_id: str) -> bool:
+    """
+    Remove the node. Returns False if there was nothing to remove.
+    """
+    key = inner_get_key(query, node_id)
+    if key is None:
+        return False
 
+    # disconnect parents
+    query.execute("DELETE FROM parents WHERE key=? OR parent_key=?;", (key, key))
+
+    # remove from nodes
+    query.execute("DELETE FROM nodes WHERE key=? RETURNING extra;", (key,))
+    rv = query.fetchone()
 
-def inner_delete_node_by_id(query: Cursor, node_id: str) -> None:
     # remove from extras
-    query.execute("DELETE FROM extras WHERE id=?;", (node_id,))
+    if rv and rv["extra"] is not None:
+        inner_release_extra(query, rv["extra"])
 
-    # remove from audios
-    query.execute("DELETE FROM audios WHERE id=?;", (node_id,))
+    # nothing refers to this key anymore
+    query.execute("DELETE FROM ids WHERE key=?;", (key,))
+    return rv is not None
 
-    # remove from images
-    query.execute("DELETE FROM images WHERE id=?;", (node_id,))
 
-    # disconnect parents
-    query.execute("DELETE FROM parents WHERE id=? OR parent_id=?;", (node_id, node_id))
+def inner_acquire_extra(query: Cursor, extra: str) -> int:
+    query.execute(
+        "INSERT INTO extras (json, refs) VALUES (?, 1) "
+        "ON CONFLICT (json) DO UPDATE SET refs = refs + 1 "
+        "RETURNING key;",
+        (extra,),
+    )
+    return query.fetchone()["key"]
 
-    # remove from files
-    query.execute("DELETE FROM files WHERE id=?;", (node_id,))
 
-    # remove from nodes
-    query.execute("DELETE FROM nodes WHERE id=?;", (node_id,))
+def inner_release_extra(query: Cursor, extra: int) -> None:
+    query.execute(
+        "UPDATE extras SET refs = refs - 1 WHERE key=? RETURNING refs;", (extra,)
+    )
+    rv = query.fetchone()
+    if rv and rv["refs"] <= 0:
+        query.execute("DELETE FROM extras WHERE key=?;", (extra,))
+
+
+def inner_append_changes(
+    query: Cursor, changes: list[ChangeAction], cursor: str
+) -> None:
+    query.executemany(
+        "INSERT INTO changes (id, removed, cursor) VALUES (?, ?, ?);",
+        (
+            dispatch_change(
+                _,
+                on_remove=lambda _: (_, True, cursor),
+                on_update=lambda _: (_.id, False, cursor),
+            )
+            for _ in changes
+        ),
+    )
+
+
+def inner_get_change_seq(query: Cursor) -> int:
+    query.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes';")
+    rv = query.fetchone()
+    if not rv:
+        return 0
+    return rv["seq"]
+
+
+def inner_trim_changes(query: Cursor, seq: int) -> None:
+    query.execute("DELETE FROM changes WHERE seq <= ?;", (seq,))
+    floor = inner_get_metadata(query, "journal_floor")
+    if not floor or int(floor) < seq:
+        inner_set_metadata(query, "journal_floor", str(seq))
+
+
+def inner_compact_changes(query: Cursor, seq: int) -> None:
+    """
+    Keep only the latest of the entries up to `seq` for each node.
+    """
+    query.execute(
+        "DELETE FROM changes "
+        "WHERE seq <= ? "
+        "AND seq NOT IN (SELECT MAX(seq) FROM changes WHERE seq <= ? GROUP BY id);",
+        (seq, seq),
+    )
+    # replicas repeat this on their copy of the journal
+    inner_set_metadata(query, "journal_compacted", str(seq))
+
 
+def inner_sync_replica(query: Cursor, seq: int) -> int | None:
+    """
+    Bring an in-memory replica up to date with the file attached to it as
+    "src", by replaying the journal entries after `seq`. Returns the new
+    sequence number, or None if some of those entries have been discarded,
+    in which case the replica has to be copied again.
+    """
+    from ._sql import SQL_SELECT_SOURCE_NODE
 
+    query.execute("SELECT seq FROM src.sqlite_sequence WHERE name = 'changes';")
+    rv = query.fetchone()
+    latest: int = rv["seq"] if rv else 0
+    query.execute("SELECT COUNT(*) FROM src.changes WHERE seq > ?;", (seq,))
+    if query.fetchone()[0] != latest - seq:
+        # trimmed or compacted, so the order of the changes is lost
+        return None
+
+    query.execute(
+        "SELECT id, removed FROM src.changes WHERE seq > ? ORDER BY seq;", (seq,)
+    )
+    for entry in query.fetchall():
+        if not entry["removed"]:
+            # the latest state, since the file has moved on meanwhile
+            query.execute(SQL_SELECT_SOURCE_NODE, (entry["id"],))
+            rv = query.fetchone()
+            if rv:
+                inner_insert_node(query, node_from_query(rv))
+                continue
+        inner_delete_node_by_id(query, entry["id"])
+    query.execute(
+        "INSERT INTO main.changes SELECT * FROM src.changes WHERE seq > ?;", (seq,)
+    )
+
+    query.execute("SELECT value FROM src.metadata WHERE key = 'journal_compacted';")
+    rv = query.fetchone()
+    compacted = rv["value"] if rv else None
+    if compacted and compacted != inner_get_metadata(query, "journal_compacted"):
+        inner_compact_changes(query, int(compacted))
+
+    # the cursor, the root and the journal floor are not journaled
+    query.execute("DELETE FROM main.metadata;")
+    query.execute("INSERT INTO main.metadata SELECT * FROM src.metadata;")
+    floor = inner_get_metadata(query, "journal_floor")
+    if floor:
+        query.execute("DELETE FROM main.changes WHERE seq <= ?;", (int(floor),))
+    root_id = inner_get_metadata(query, "root_id")
+    if root_id:
+        query.execute(SQL_SELECT_SOURCE_NODE, (root_id,))
+        rv = query.fetchone()
+        if rv:
+            inner_insert_node(query, node_from_query(rv))
+
+    query.execute("DELETE FROM main.sqlite_sequence WHERE name = 'changes';")
+    query.execute(
+        "INSERT INTO main.sqlite_sequence (name, seq) VALUES ('changes', ?);",
+        (latest,),
+    )
+    return latest
+
+
+@counted_as_hydration
 def node_from_query(row: JoinedDict) -> Node:
     mime_type = row["mime_type"]
     hash_ = row["hash"]
@@ -119,7 +349,7 @@ def node_from_query(row: JoinedDict) -> Node:
     is_directory = any(_ is None for _ in (mime_type, hash_, size))
     has_image = all(_ is not None for _ in (width, height))
     has_audio = ms_duration is not None
-    private = json.loads(extra) if extra else None
+    private = _load_private(extra) if extra else None
     return Node(
         id=row["id"],
         name=row["name"],
@@ -138,3 +368,27 @@ def node_from_query(row: JoinedDict) -> Node:
         is_image=has_image and not has_audio,
         is_video=has_image and has_audio,
     )
+
+
+def _dump_private(private: PrivateDict) -> str:
+    # sorted keys so equal payloads always intern to the same row
+    return json.dumps(private, separators=(",", ":"), sort_keys=True)
+
+
+def _load_private(extra: str) -> PrivateDict:
+    # every node gets its own copy, which is cheaper than parsing again
+    return _copy_json(_parse_private(extra))
+
+
+# Interned payloads decode to the same text, so each one is only parsed once.
+@lru_cache(maxsize=1024)
+def _parse_private(extra: str) -> PrivateDict:
+    return json.loads(extra)
+
+
+def _copy_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(_) for _ in value]
+    return value
@@ -1,42 +1,762 @@
-from collections.abc import Callable
+from collections.abc import AsyncGenerator, Callable, Iterator
 from concurrent.futures import Executor
-from contextlib import contextmanager, closing
-from sqlite3 import connect, Row
-from typing import Pattern, Concatenate
+from contextlib import contextmanager, closing, nullcontext
+from dataclasses import dataclass, field, fields
+from logging import getLogger
+from sqlite3 import Connection, Cursor, DatabaseError, connect, Row
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, Any, Pattern, Concatenate
+
+if TYPE_CHECKING:
+    from asyncio import Semaphore as AsyncSemaphore
+    from multiprocessing.connection import Connection as PipeConnection
 
 
 type RegexpFunction = Callable[..., bool]
 
 
+@dataclass(kw_only=True)
+class SlowQuery:
+    sql: str
+    seconds: float
+    # detail column of EXPLAIN QUERY PLAN
+    plan: list[str]
+
+
+@dataclass(kw_only=True)
+class CallTimings:
+    """
+    Seconds spent by one call in the pool. `transfer` is the time from the
+    worker returning to the result arriving, mostly pickling.
+    """
+
+    name: str
+    total: float = 0.0
+    queue_wait: float = 0.0
+    connect: float = 0.0
+    sql: float = 0.0
+    hydrate: float = 0.0
+    transfer: float = 0.0
+    slow_queries: list[SlowQuery] = field(default_factory=list)
+
+
+type TimingSink = Callable[[CallTimings], None]
+
+
+# Upper bounds in seconds of the histogram buckets of `TimingRegistry`.
+TIMING_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+
+class TimingRegistry:
+    """
+    A timing sink which counts calls and keeps a histogram of every phase,
+    by function name, and the latest slow queries.
+    """
+
+    def __init__(self, *, slow_query_limit: int = 100) -> None:
+        from collections import deque
+
+        self._calls: dict[str, int] = {}
+        # (name, phase) -> sum of seconds, and count per bucket; the last
+        # bucket is for anything slower than every bound
+        self._sums: dict[tuple[str, str], float] = {}
+        self._buckets: dict[tuple[str, str], list[int]] = {}
+        self.slow_queries: deque[SlowQuery] = deque(maxlen=slow_query_limit)
+
+    def __call__(self, timings: CallTimings) -> None:
+        from bisect import bisect_left
+
+        name = timings.name
+        self._calls[name] = self._calls.get(name, 0) + 1
+        for phase in _PHASES:
+            seconds: float = getattr(timings, phase)
+            key = (name, phase)
+            self._sums[key] = self._sums.get(key, 0.0) + seconds
+            buckets = self._buckets.setdefault(key, [0] * (len(TIMING_BUCKETS) + 1))
+            buckets[bisect_left(TIMING_BUCKETS, seconds)] += 1
+        self.slow_queries.extend(timings.slow_queries)
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        """
+        `{name: {"calls": n, phase: {"seconds": sum, "buckets": [...]}}}`
+        """
+        rv: dict[str, dict[str, Any]] = {}
+        for name, calls in self._calls.items():
+            entry: dict[str, Any] = {"calls": calls}
+            for phase in _PHASES:
+                entry[phase] = {
+                    "seconds": self._sums[(name, phase)],
+                    "buckets": list(self._buckets[(name, phase)]),
+                }
+            rv[name] = entry
+        return rv
+
+
+_PHASES = tuple(
+    _.name for _ in fields(CallTimings) if _.name not in ("name", "slow_queries")
+)
+
+
+DEFAULT_TIMEOUT = 5.0
+# How many calls can be cancellable at once, per set of cancel flags.
+CANCEL_SLOTS = 256
+# SQLite virtual machine steps between checks for cancellation.
+CANCEL_CHECK_STEPS = 10_000
+# Bytes of an immutable database which are memory-mapped.
+IMMUTABLE_MMAP_SIZE = 1 << 34
+# How long the consumer of a stream waits before checking on the worker.
+STREAM_POLL_INTERVAL = 0.1
+
+
+class CancelFlags:
+    """
+    Flags in shared memory by which a call running in a worker is told to
+    stop. Workers must be started with `share_cancel_flags`.
+    """
+
+    def __init__(self, size: int = CANCEL_SLOTS) -> None:
+        from multiprocessing import Array
+
+        self.shared = Array("b", size, lock=False)
+        self._free = list(range(size))
+
+    def acquire(self) -> int | None:
+        if not self._free:
+            return None
+        slot = self._free.pop()
+        self.shared[slot] = 0
+        return slot
+
+    def release(self, slot: int) -> None:
+        self._free.append(slot)
+
+    def cancel(self, slot: int) -> None:
+        self.shared[slot] = 1
+
+
 class OffMainProcess:
-    def __init__(self, *, dsn: str, pool: Executor) -> None:
+    def __init__(
+        self,
+        *,
+        dsn: str,
+        pool: Executor,
+        sink: TimingSink | None = None,
+        slow_query_seconds: float | None = None,
+        slots: "AsyncSemaphore | None" = None,
+        cancel: CancelFlags | None = None,
+        timeout: float | None = None,
+    ) -> None:
         self._dsn = dsn
         self._pool = pool
+        self._sink = sink
+        self._slow_query_seconds = slow_query_seconds
+        # bounds the calls in flight, when the pool is shared
+        self._slots = slots
+        # stops queries of abandoned calls, if the workers share these
+        self._cancel = cancel
+        self._timeout = timeout
 
     async def __call__[
         **A, R
     ](
         self, fn: Callable[Concatenate[str, A], R], *args: A.args, **kwargs: A.kwargs
     ) -> R:
-        from asyncio import get_running_loop
+        from asyncio import timeout
+
+        async with self._slots or nullcontext(), timeout(self._timeout):
+            return await self._call(fn, *args, **kwargs)
+
+    async def _call[
+        **A, R
+    ](
+        self, fn: Callable[Concatenate[str, A], R], *args: A.args, **kwargs: A.kwargs
+    ) -> R:
+        from functools import partial
+
+        if not self._sink:
+            return await self._run(partial(fn, self._dsn, *args, **kwargs))
+
+        submitted = monotonic()
+        bound = partial(
+            _run_timed,
+            self._slow_query_seconds,
+            submitted,
+            fn,
+            self._dsn,
+            *args,
+            **kwargs,
+        )
+        rv, timings, finished = await self._run(bound)
+        received = monotonic()
+        timings.transfer = received - finished
+        timings.total = received - submitted
+        for slow in timings.slow_queries:
+            getLogger(__name__).warning(
+                "slow query in %s (%.3fs): %s plan: %s",
+                timings.name,
+                slow.seconds,
+                slow.sql,
+                slow.plan,
+            )
+        self._sink(timings)
+        return rv
+
+    async def _run[R](self, bound: Callable[[], R]) -> R:
+        from asyncio import CancelledError, wrap_future
         from functools import partial
 
-        bound = partial(fn, self._dsn, *args, **kwargs)
-        loop = get_running_loop()
-        return await loop.run_in_executor(self._pool, bound)
+        slot = self._cancel.acquire() if self._cancel else None
+        if slot is None:
+            return await wrap_future(self._pool.submit(bound))
+
+        assert self._cancel
+        future = self._pool.submit(partial(_run_cancellable, slot, bound))
+        try:
+            return await wrap_future(future)
+        except CancelledError:
+            if not future.cancel():
+                # already running, so tell it to stop, and keep the slot
+                # until it does
+                self._cancel.cancel(slot)
+                future.add_done_callback(partial(_release_slot, self._cancel, slot))
+                slot = None
+            raise
+        finally:
+            if slot is not None:
+                self._cancel.release(slot)
+
+    @property
+    def dsn(self) -> str:
+        return self._dsn
+
+    def with_dsn(self, dsn: str) -> "OffMainProcess":
+        """
+        Same workers, other database, or a snapshot pinned by
+        `pin_snapshot` in them.
+        """
+        return OffMainProcess(
+            dsn=dsn,
+            pool=self._pool,
+            sink=self._sink,
+            slow_query_seconds=self._slow_query_seconds,
+            slots=self._slots,
+            cancel=self._cancel,
+            timeout=self._timeout,
+        )
+
+    async def stream[
+        **A, T
+    ](
+        self,
+        fn: Callable[Concatenate[str, A], Iterator[T]],
+        *args: A.args,
+        **kwargs: A.kwargs,
+    ) -> AsyncGenerator[T, None]:
+        """
+        Run a generator function in the pool and yield its items as they are
+        produced. Items are sent back through a pipe, so the worker blocks
+        when the consumer falls behind. When the consumer stops iterating,
+        or an item takes longer than the timeout, the worker is told to stop
+        through the cancel flags, or runs to the end without them.
+        """
+        from contextlib import aclosing
+
+        async with (
+            self._slots or nullcontext(),
+            aclosing(self._stream(fn, *args, **kwargs)) as items,
+        ):
+            async for item in items:
+                yield item
+
+    async def _stream[
+        **A, T
+    ](
+        self,
+        fn: Callable[Concatenate[str, A], Iterator[T]],
+        *args: A.args,
+        **kwargs: A.kwargs,
+    ) -> AsyncGenerator[T, None]:
+        from asyncio import Task, create_task, shield, timeout, to_thread, wrap_future
+        from contextlib import suppress
+        from functools import partial
+        from multiprocessing import Pipe
+
+        receiver, sender = Pipe(duplex=False)
+        bound = partial(_produce, sender, fn, self._dsn, *args, **kwargs)
+        slot = self._cancel.acquire() if self._cancel else None
+        if slot is None:
+            future = self._pool.submit(bound)
+        else:
+            assert self._cancel
+            future = self._pool.submit(partial(_run_cancellable, slot, bound))
+            future.add_done_callback(partial(_release_slot, self._cancel, slot))
+        # Forked workers may hold the receiving end too, so closing it does
+        # not stop the worker. Only one thread reads the pipe at a time,
+        # even if waiting for a read is cancelled.
+        reading: Task[tuple[bool, Any] | None] | None = None
+
+        async def receive() -> tuple[bool, Any]:
+            nonlocal reading
+            while True:
+                stopped = future.done()
+                if not reading:
+                    reading = create_task(to_thread(_receive, receiver))
+                rv = await shield(reading)
+                reading = None
+                if rv is not None:
+                    return rv
+                if stopped:
+                    # the worker died without reporting back
+                    return True, None
+
+        finished = False
+        try:
+            while True:
+                async with timeout(self._timeout):
+                    done, item = await receive()
+                if done:
+                    break
+                yield item
+            finished = True
+        finally:
+            try:
+                if finished:
+                    # propagates errors from the worker
+                    await wrap_future(future)
+                else:
+                    if slot is not None:
+                        assert self._cancel
+                        self._cancel.cancel(slot)
+                    # it may be blocked sending, until it is read
+                    while not (await receive())[0]:
+                        pass
+                    with suppress(Exception):
+                        await wrap_future(future)
+            finally:
+                receiver.close()
+                sender.close()
+
+
+class LeastBusy:
+    """
+    Spreads calls over several equivalent workers, picking the one with the
+    fewest calls in flight.
+    """
+
+    def __init__(self, members: list[OffMainProcess]) -> None:
+        if not members:
+            raise ValueError("no members")
+        self._busy = {id(_): 0 for _ in members}
+        self._members = members
+
+    async def __call__[
+        **A, R
+    ](
+        self, fn: Callable[Concatenate[str, A], R], *args: A.args, **kwargs: A.kwargs
+    ) -> R:
+        member = self._pick()
+        self._busy[id(member)] += 1
+        try:
+            return await member(fn, *args, **kwargs)
+        finally:
+            self._busy[id(member)] -= 1
+
+    async def stream[
+        **A, T
+    ](
+        self,
+        fn: Callable[Concatenate[str, A], Iterator[T]],
+        *args: A.args,
+        **kwargs: A.kwargs,
+    ) -> AsyncGenerator[T, None]:
+        from contextlib import aclosing
+
+        member = self._pick()
+        self._busy[id(member)] += 1
+        try:
+            async with aclosing(member.stream(fn, *args, **kwargs)) as items:
+                async for item in items:
+                    yield item
+        finally:
+            self._busy[id(member)] -= 1
+
+    def _pick(self) -> OffMainProcess:
+        return min(self._members, key=lambda _: self._busy[id(_)])
+
+
+def _release_slot(flags: CancelFlags, slot: int, _: object) -> None:
+    flags.release(slot)
+
+
+# Cancel flags of this (worker) process, and the slot of the running call.
+_cancel_flags: Any = None
+_cancel_slot: int | None = None
+
+
+def share_cancel_flags(
+    flags: Any, initializer: Callable[..., None] | None = None, *args: Any
+) -> None:
+    """
+    Pool initializer which lets calls in this worker be cancelled through
+    `CancelFlags`, then runs `initializer`.
+    """
+    global _cancel_flags
+    _cancel_flags = flags
+    if initializer:
+        initializer(*args)
+
+
+def _run_cancellable[R](slot: int, bound: Callable[[], R]) -> R:
+    global _cancel_slot
+    _cancel_slot = slot
+    try:
+        return bound()
+    finally:
+        _cancel_slot = None
+
+
+def _is_cancelled() -> bool:
+    # a true return value makes SQLite interrupt the statement
+    return _cancel_slot is not None and bool(_cancel_flags[_cancel_slot])
+
+
+# Timings of the call running in this (worker) process, if it is measured.
+_timings: CallTimings | None = None
+_slow_query_seconds: float | None = None
+
+
+def _run_timed(
+    slow_query_seconds: float | None,
+    submitted: float,
+    fn: Callable[..., Any],
+    dsn: str,
+    *args: Any,
+    **kwargs: Any,
+) -> tuple[Any, CallTimings, float]:
+    global _timings, _slow_query_seconds
+
+    timings = CallTimings(name=fn.__name__, queue_wait=monotonic() - submitted)
+    _timings = timings
+    _slow_query_seconds = slow_query_seconds
+    try:
+        rv = fn(dsn, *args, **kwargs)
+    finally:
+        _timings = None
+        _slow_query_seconds = None
+    return rv, timings, monotonic()
+
+
+def counted_as_hydration[**A, R](fn: Callable[A, R]) -> Callable[A, R]:
+    """
+    Count the time spent in `fn` as row hydration of the measured call.
+    """
+    from functools import wraps
+
+    @wraps(fn)
+    def wrapper(*args: A.args, **kwargs: A.kwargs) -> R:
+        timings = _timings
+        if not timings:
+            return fn(*args, **kwargs)
+        begin = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings.hydrate += perf_counter() - begin
+
+    return wrapper
+
+
+class _TimedCursor(Cursor):
+    """
+    Adds the time spent executing and fetching to the measured call, and
+    keeps slow statements with their query plan.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._statement: tuple[str, Any] | None = None
+        self._seconds = 0.0
+
+    def execute(self, sql: str, parameters: Any = (), /) -> "_TimedCursor":
+        self._finish_statement()
+        self._statement = (sql, parameters)
+        with self._timed():
+            super().execute(sql, parameters)
+        return self
+
+    def executemany(self, sql: str, parameters: Any, /) -> "_TimedCursor":
+        self._finish_statement()
+        self._statement = (sql, ())
+        with self._timed():
+            super().executemany(sql, parameters)
+        return self
+
+    def fetchone(self) -> Any:
+        with self._timed():
+            return super().fetchone()
+
+    def fetchmany(self, size: int = 1) -> list[Any]:
+        with self._timed():
+            return super().fetchmany(size)
+
+    def fetchall(self) -> list[Any]:
+        with self._timed():
+            return super().fetchall()
+
+    def __next__(self) -> Any:
+        with self._timed():
+            return super().__next__()
+
+    def close(self) -> None:
+        self._finish_statement()
+        super().close()
+
+    @contextmanager
+    def _timed(self) -> Iterator[None]:
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self._seconds += perf_counter() - begin
+
+    def _finish_statement(self) -> None:
+        statement, seconds = self._statement, self._seconds
+        self._statement, self._seconds = None, 0.0
+        timings = _timings
+        if not statement or not timings:
+            return
+        timings.sql += seconds
+        if _slow_query_seconds is None or seconds < _slow_query_seconds:
+            return
+        sql, parameters = statement
+        try:
+            rows = self.connection.execute(
+                f"EXPLAIN QUERY PLAN {sql}", parameters
+            ).fetchall()
+            plan = [_["detail"] for _ in rows]
+        except DatabaseError:
+            plan = []
+        timings.slow_queries.append(SlowQuery(sql=sql, seconds=seconds, plan=plan))
+
+
+def _produce(
+    sender: "PipeConnection",
+    fn: Callable[..., Iterator[Any]],
+    dsn: str,
+    *args: Any,
+    **kwargs: Any,
+) -> None:
+    with sender:
+        try:
+            for item in fn(dsn, *args, **kwargs):
+                if _is_cancelled():
+                    break
+                sender.send((False, item))
+        finally:
+            # also after an error, which is raised by the future
+            sender.send((True, None))
+
+
+def _receive(receiver: "PipeConnection") -> tuple[bool, Any] | None:
+    if not receiver.poll(STREAM_POLL_INTERVAL):
+        return None
+    return receiver.recv()
+
+
+# Connections that live as long as this (worker) process, by DSN.
+_kept_connections: dict[str, Connection] = {}
+# Names of kept connections which hold a read transaction open.
+_pinned_dsns: set[str] = set()
+
+
+def keep_connection(dsn: str, /) -> None:
+    """
+    Make every later `read_only`/`read_write` on `dsn` in this process reuse
+    one connection. Meant to be a pool initializer.
+    """
+    from multiprocessing.util import Finalize
+
+    db = _open(dsn, timeout=DEFAULT_TIMEOUT)
+    _kept_connections[dsn] = db
+    # workers do not run finalizers otherwise, and an unclosed connection
+    # leaves its WAL file behind
+    Finalize(None, db.close, exitpriority=10)
+
+
+def keep_connections(dsns: list[str], /) -> None:
+    """
+    `keep_connection` for several databases.
+    """
+    for dsn in dsns:
+        keep_connection(dsn)
+
+
+def pin_snapshot(dsn: str, name: str, /) -> None:
+    """
+    Open a connection to `dsn` in this process which holds a read
+    transaction open, and keep it under `name`: every later read of `name`
+    here sees the same snapshot, until `unpin_snapshot`. Needs WAL,
+    otherwise writers are blocked meanwhile.
+    """
+    db = _open(dsn, timeout=DEFAULT_TIMEOUT)
+    db.execute("BEGIN;")
+    # a deferred transaction only takes its snapshot on the first read
+    db.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+    _kept_connections[name] = db
+    _pinned_dsns.add(name)
+
+
+def unpin_snapshot(name: str, /) -> None:
+    _pinned_dsns.discard(name)
+    db = _kept_connections.pop(name, None)
+    if db:
+        # ends the read transaction
+        db.close()
+
+
+# DSN -> data version of the file and journal sequence number when last
+# synced, for DSNs whose kept connection is an in-memory replica.
+_replica_states: dict[str, tuple[int, int]] = {}
+
+
+def keep_replica(dsn: str, /) -> None:
+    """
+    Like `keep_connection`, but keep an in-memory copy of the database
+    instead. Before a read, if the file has been committed to since, the
+    copy replays the new entries of the change journal, so the journal
+    must be written.
+    """
+    from multiprocessing.util import Finalize
+
+    db = _open(":memory:", timeout=DEFAULT_TIMEOUT)
+    _kept_connections[dsn] = db
+    Finalize(None, db.close, exitpriority=10)
+    _copy_replica(dsn, -1)
+
+
+def _copy_replica(dsn: str, version: int) -> None:
+    db = _kept_connections[dsn]
+    if dsn in _replica_states:
+        db.execute("DETACH DATABASE src;")
+    with closing(_open(dsn, timeout=DEFAULT_TIMEOUT)) as source:
+        source.backup(db)
+    db.execute("ATTACH DATABASE ? AS src;", (dsn,))
+    rv = db.execute(
+        "SELECT seq FROM main.sqlite_sequence WHERE name = 'changes';"
+    ).fetchone()
+    _replica_states[dsn] = (version, rv[0] if rv else 0)
+
+
+def _refresh_replica(dsn: str) -> None:
+    from ._inner import inner_sync_replica
+
+    db = _kept_connections[dsn]
+    synced, seq = _replica_states[dsn]
+    # changes whenever another connection commits to the file
+    version = db.execute("PRAGMA src.data_version;").fetchone()[0]
+    if version == synced:
+        return
+
+    with closing(db.cursor()) as query:
+        # one read transaction, so the file does not change meanwhile
+        query.execute("BEGIN;")
+        try:
+            latest = inner_sync_replica(query, seq)
+        except BaseException:
+            db.rollback()
+            raise
+        if latest is None:
+            db.rollback()
+            getLogger(__name__).info(
+                "journal entries have been discarded, copying %s again", dsn
+            )
+            _copy_replica(dsn, version)
+            return
+        db.commit()
+    _replica_states[dsn] = (version, latest)
+
+
+def load_in_memory(dsn: str, /) -> None:
+    """
+    Like `keep_connection`, but load the whole database into memory and
+    serve every read and write from there. Use `checkpoint` to save it.
+    """
+    from multiprocessing.util import Finalize
+
+    db = _open(":memory:", timeout=DEFAULT_TIMEOUT)
+    with closing(_open(dsn, timeout=DEFAULT_TIMEOUT)) as source:
+        source.backup(db)
+    _kept_connections[dsn] = db
+    Finalize(None, db.close, exitpriority=10)
+
+
+def checkpoint(dsn: str, /) -> None:
+    """
+    Save the in-memory database of `load_in_memory` back to its file.
+    """
+    with closing(_open(dsn, timeout=DEFAULT_TIMEOUT)) as target:
+        _kept_connections[dsn].backup(target)
 
 
 @contextmanager
 def connect_(dsn: str, *, timeout: float | None, regexp: RegexpFunction | None):
     if timeout is None:
-        timeout = 5.0
-    with connect(dsn, timeout=timeout) as db:
-        db.row_factory = Row
-        # FIXME error in the real world
-        # await db.execute("PRAGMA foreign_keys = 1;")
+        timeout = DEFAULT_TIMEOUT
+    if dsn in _replica_states:
+        _refresh_replica(dsn)
+    kept = _kept_connections.get(dsn)
+    if kept:
+        holder = nullcontext(kept)
+    else:
+        begin = perf_counter()
+        holder = closing(_open(dsn, timeout=timeout))
+        if _timings:
+            _timings.connect += perf_counter() - begin
+    with (
+        holder as db,
+        # committing would end the pinned transaction
+        nullcontext() if dsn in _pinned_dsns else db,
+    ):
         if regexp:
             db.create_function("REGEXP", 2, regexp, deterministic=True)
-        yield db
+        if _cancel_slot is None:
+            yield db
+            return
+        db.set_progress_handler(_is_cancelled, CANCEL_CHECK_STEPS)
+        try:
+            yield db
+        finally:
+            db.set_progress_handler(None, 0)
+
+
+def immutable_dsn(path: str, /) -> str:
+    """
+    A DSN which opens the database at `path` read-only, without locking
+    and without checking for changes. Only for files nothing writes to.
+    """
+    from urllib.parse import quote
+
+    if path.startswith("file:"):
+        return path
+    return f"file:{quote(path)}?mode=ro&immutable=1"
+
+
+def _open(dsn: str, *, timeout: float) -> Connection:
+    from urllib.parse import parse_qs, urlsplit
+
+    uri = dsn.startswith("file:")
+    db = connect(dsn, timeout=timeout, uri=uri)
+    db.row_factory = Row
+    if uri and parse_qs(urlsplit(dsn).query).get("immutable") == ["1"]:
+        # pages are read straight from the mapped file
+        db.execute(f"PRAGMA mmap_size = {IMMUTABLE_MMAP_SIZE};")
+    # FIXME error in the real world
+    # await db.execute("PRAGMA foreign_keys = 1;")
+    return db
+
+
+def _cursor(db: Connection) -> Cursor:
+    return db.cursor(_TimedCursor) if _timings else db.cursor()
 
 
 @contextmanager
@@ -45,7 +765,7 @@ def read_only(
 ):
     with (
         connect_(dsn, timeout=timeout, regexp=regexp) as db,
-        closing(db.cursor()) as cursor,
+        closing(_cursor(db)) as cursor,
     ):
         yield cursor
 
@@ -54,7 +774,7 @@ def read_only(
 def read_write(dsn: str, *, timeout: float | None = None):
     with (
         connect_(dsn, timeout=timeout, regexp=None) as db,
-        closing(db.cursor()) as cursor,
+        closing(_cursor(db)) as cursor,
     ):
         try:
             yield cursor
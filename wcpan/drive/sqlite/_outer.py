@@ -1,6 +1,11 @@
-from datetime import datetime
+from collections import deque
+from collections.abc import Iterator
+from contextlib import closing
+from datetime import datetime, UTC
+import json
 from pathlib import PurePath
-from typing import cast
+from typing import Literal, TypedDict, cast
+from urllib.parse import quote
 
 from wcpan.drive.core.lib import dispatch_change
 from wcpan.drive.core.types import Node, ChangeAction
@@ -8,88 +13,257 @@ from wcpan.drive.core.types import Node, ChangeAction
 from .exceptions import SqliteSnapshotError
 from ._lib import read_only, read_write, sqlite3_regexp
 from ._inner import (
+    inner_append_changes,
+    inner_compact_changes,
     inner_delete_node_by_id,
+    inner_get_change_seq,
+    inner_get_key,
     inner_get_metadata,
     inner_get_node_by_id,
+    inner_get_node_by_key,
+    inner_get_schema_version,
     inner_insert_node,
+    inner_resolve_path_by_id,
     inner_set_metadata,
+    inner_trim_changes,
     node_from_query,
 )
 
 
 KEY_ROOT_ID = "root_id"
 KEY_CURSOR = "check_point"
+KEY_JOURNAL_FLOOR = "journal_floor"
+# How many nodes a walk sends back at a time.
+WALK_CHUNK_SIZE = 1000
+# How many journal entries are sent back at a time.
+CHANGES_CHUNK_SIZE = 1000
+# Bounds of one maintenance run: free pages returned to the file system, and
+# rows sampled per index by ANALYZE.
+MAINTENANCE_VACUUM_PAGES = 1000
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+# Larger than any key SQLite assigns.
+MAX_KEY = (1 << 63) - 1
+
+
+type WalkEntry = tuple[PurePath, list[Node], list[Node]]
+type DiffKind = Literal["added", "removed", "changed"]
+# (seq, removed, node_id)
+type JournalEntry = tuple[int, bool, str]
+
+
+class ApplyStats(TypedDict):
+    written: int
+    skipped: int
+
+
+class MaintenanceStats(TypedDict):
+    # free pages returned to the file system, and those still left
+    vacuumed_pages: int
+    free_pages: int
+    # WAL frames, and how many of them are now in the database file
+    wal_frames: int
+    checkpointed_frames: int
+    seconds: float
+
+
+type MediaKind = Literal["image", "video"]
+type MediaOrder = Literal["updated", "created", "width", "duration"]
+
+
+class Facet(TypedDict):
+    count: int
+    size: int
+
+
+class Statistics(TypedDict):
+    # every node, directories included
+    nodes: Facet
+    directories: Facet
+    files: Facet
+    images: Facet
+    videos: Facet
+    trashed: Facet
+    mime_types: dict[str, Facet]
+
+
+type BucketSize = Literal["hour", "day", "month"]
+
+
+class UploadBucket(TypedDict):
+    # start of the bucket, in UTC
+    begin: datetime
+    # only set when grouped by MIME type
+    mime_type: str | None
+    size: int
 
 
 def initialize(dsn: str, /):
     from ._sql import CURRENT_SCHEMA_VERSION, SQL_CREATE_TABLES
 
     with read_write(dsn) as query:
-        # check the schema version
-        query.execute("PRAGMA user_version;")
-        rv = query.fetchone()
-        if not rv:
-            raise SqliteSnapshotError("no user_version")
-        version = int(rv[0])
-
-        if version != 0 and version != CURRENT_SCHEMA_VERSION:
+        query.execute("PRAGMA page_count;")
+        if query.fetchone()[0] == 0:
+            # only possible before anything is written, so files can be
+            # shrunk in small steps by maintain()
+            query.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        # readers and the writer do not block each other
+        query.execute("PRAGMA journal_mode = WAL;")
+
+        version = inner_get_schema_version(query)
+        if version == CURRENT_SCHEMA_VERSION:
+            return
+        if version > CURRENT_SCHEMA_VERSION:
             raise SqliteSnapshotError(
-                "schema has been changed, please rebuild snapshot"
+                f"schema version {version} is newer than this library"
             )
 
-        # initialize table
-        for sql in SQL_CREATE_TABLES:
-            query.execute(sql)
+        if version == 0:
+            query.execute("BEGIN IMMEDIATE;")
+            # another process may have done it while we were waiting
+            if inner_get_schema_version(query) == 0:
+                # initialize table
+                for sql in SQL_CREATE_TABLES:
+                    query.execute(sql)
+            return
+
+    migrate(dsn)
+
+
+def check_schema(dsn: str, /) -> None:
+    """
+    Like `initialize`, but for databases which cannot be written: only
+    make sure the schema is the current one.
+    """
+    from ._sql import CURRENT_SCHEMA_VERSION
+
+    with read_only(dsn) as query:
+        version = inner_get_schema_version(query)
+    if version != CURRENT_SCHEMA_VERSION:
+        raise SqliteSnapshotError(
+            f"schema version {version} is not {CURRENT_SCHEMA_VERSION}, "
+            "please upgrade the snapshot first"
+        )
+
+
+def migrate(dsn: str, /) -> None:
+    from ._sql import CURRENT_SCHEMA_VERSION, SQL_MIGRATIONS
+
+    while True:
+        with read_write(dsn) as query:
+            query.execute("BEGIN IMMEDIATE;")
+            version = inner_get_schema_version(query)
+            if version >= CURRENT_SCHEMA_VERSION:
+                return
+
+            statements = SQL_MIGRATIONS.get(version + 1)
+            if statements is None:
+                raise SqliteSnapshotError(
+                    "schema has been changed, please rebuild snapshot"
+                )
+            for sql in statements:
+                query.execute(sql)
+            query.execute(f"PRAGMA user_version = {version + 1};")
+
+
+def maintain(
+    dsn: str,
+    /,
+    *,
+    vacuum_pages: int = MAINTENANCE_VACUUM_PAGES,
+    analysis_limit: int = MAINTENANCE_ANALYSIS_LIMIT,
+) -> MaintenanceStats:
+    """
+    Refresh planner statistics, give back up to `vacuum_pages` free pages,
+    and checkpoint the WAL without waiting for readers. Every step is
+    bounded, so it is cheap enough to run between writes.
+    """
+    from time import perf_counter
+
+    begin = perf_counter()
+    with read_write(dsn) as query:
+        query.execute(f"PRAGMA analysis_limit = {int(analysis_limit)};")
+        query.execute("ANALYZE;")
+        query.execute("PRAGMA optimize;")
+
+        query.execute("PRAGMA freelist_count;")
+        before = query.fetchone()[0]
+        # does nothing unless auto_vacuum is INCREMENTAL
+        query.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+        query.fetchall()
+        query.execute("PRAGMA freelist_count;")
+        after = query.fetchone()[0]
+
+    with read_write(dsn) as query:
+        query.execute("PRAGMA wal_checkpoint(PASSIVE);")
+        _, frames, checkpointed = query.fetchone()
+
+    return {
+        "vacuumed_pages": before - after,
+        "free_pages": after,
+        "wal_frames": max(frames, 0),
+        "checkpointed_frames": max(checkpointed, 0),
+        "seconds": perf_counter() - begin,
+    }
+
+
+def export_snapshot(dsn: str, dest: str, /) -> None:
+    """
+    Write a compacted copy of the snapshot to the new file `dest`. The copy
+    is one consistent read, so writers are not blocked in WAL mode.
+    """
+    with read_only(dsn) as query:
+        query.execute("VACUUM INTO ?;", (dest,))
+
+
+def import_snapshot(src: str, dsn: str, /) -> None:
+    """
+    Replace the snapshot at `dsn` with the one exported to `src`, then
+    upgrade it if it was exported by an older version.
+    """
+    from sqlite3 import connect
+
+    from ._sql import CURRENT_SCHEMA_VERSION
+
+    with closing(connect(f"file:{quote(src)}?mode=ro", uri=True)) as source:
+        version = source.execute("PRAGMA user_version;").fetchone()[0]
+        if version == 0:
+            raise SqliteSnapshotError(f"{src} is not a snapshot")
+        if version > CURRENT_SCHEMA_VERSION:
+            raise SqliteSnapshotError(
+                f"schema version {version} is newer than this library"
+            )
+        with closing(connect(dsn)) as target:
+            source.backup(target)
+    initialize(dsn)
 
 
 def get_node_by_path(dsn: str, path: PurePath, /) -> Node | None:
+    from ._sql import SQL_SELECT_CHILD_KEY_BY_NAME
+
     # the first part is "/"
     parts = path.parts[1:]
     with read_only(dsn) as query:
-        node_id = inner_get_metadata(query, "root_id")
-        if not node_id:
+        root_id = inner_get_metadata(query, KEY_ROOT_ID)
+        if not root_id:
+            return None
+        key = inner_get_key(query, root_id)
+        if key is None:
             return None
 
         for part in parts:
-            query.execute(
-                "SELECT nodes.id AS id "
-                "FROM parents "
-                "INNER JOIN nodes ON parents.id = nodes.id "
-                "WHERE parents.parent_id=? AND nodes.name=?;",
-                (node_id, part),
-            )
+            query.execute(SQL_SELECT_CHILD_KEY_BY_NAME, (key, part))
             rv = query.fetchone()
             if not rv:
                 return None
-            node_id = cast(str, rv["id"])
+            key = cast(int, rv["key"])
 
-        node = inner_get_node_by_id(query, node_id)
+        node = inner_get_node_by_key(query, key)
     return node
 
 
 def resolve_path_by_id(dsn: str, node_id: str, /) -> PurePath | None:
-    parts: list[str] = []
     with read_only(dsn) as query:
-        while True:
-            query.execute("SELECT name FROM nodes WHERE id=?;", (node_id,))
-            rv = query.fetchone()
-            if not rv:
-                return None
-
-            name = rv["name"]
-
-            query.execute("SELECT parent_id FROM parents WHERE id=?;", (node_id,))
-            rv = query.fetchone()
-            if not rv:
-                # reached root
-                parts.insert(0, "/")
-                break
-
-            parts.insert(0, name)
-            node_id = rv["parent_id"]
-
-    path = PurePath(*parts)
-    return path
+        return inner_resolve_path_by_id(query, node_id)
 
 
 def get_child_by_name(dsn: str, name: str, parent_id: str, /) -> Node | None:
@@ -112,25 +286,230 @@ def get_children_by_id(dsn: str, node_id: str, /) -> list[Node]:
     return nodes
 
 
+def get_nodes_by_ids(dsn: str, node_ids: list[str], /) -> dict[str, Node]:
+    from ._sql import SQL_SELECT_NODES_BY_IDS
+
+    with read_only(dsn) as query:
+        query.execute(SQL_SELECT_NODES_BY_IDS, (json.dumps(node_ids),))
+        nodes = {_.id: _ for _ in (node_from_query(_) for _ in query)}
+    return nodes
+
+
+def get_children_by_ids(dsn: str, parent_ids: list[str], /) -> dict[str, list[Node]]:
+    from ._sql import SQL_SELECT_CHILDREN_BY_IDS
+
+    children: dict[str, list[Node]] = {_: [] for _ in parent_ids}
+    with read_only(dsn) as query:
+        query.execute(SQL_SELECT_CHILDREN_BY_IDS, (json.dumps(parent_ids),))
+        for row in query:
+            node = node_from_query(row)
+            children[cast(str, node.parent_id)].append(node)
+    return children
+
+
+def walk(
+    dsn: str, node_id: str, /, *, chunk_size: int = WALK_CHUNK_SIZE
+) -> Iterator[list[WalkEntry]]:
+    from ._sql import SQL_WALK_TREE
+
+    with read_only(dsn) as query:
+        top = inner_resolve_path_by_id(query, node_id)
+        if not top:
+            return
+
+        query.execute(SQL_WALK_TREE, (node_id,))
+        rv = query.fetchone()
+        if not rv or rv["id"] != node_id or not node_from_query(rv).is_directory:
+            return
+
+        # directories in the same order as their children will arrive
+        pending = deque([(node_id, top)])
+        current: tuple[str, WalkEntry] | None = None
+        chunk: list[WalkEntry] = []
+        size = 0
+        for row in query:
+            node = node_from_query(row)
+            while not current or current[0] != node.parent_id:
+                if current:
+                    chunk.append(current[1])
+                # directories skipped here have no children
+                dir_id, dir_path = pending.popleft()
+                current = (dir_id, (dir_path, [], []))
+
+            dir_path, dirs, files = current[1]
+            if node.is_directory:
+                dirs.append(node)
+                pending.append((node.id, dir_path / node.name))
+            else:
+                files.append(node)
+
+            size += 1
+            # the entry of a large directory is only sent once it is done
+            if size >= chunk_size and chunk:
+                yield chunk
+                chunk = []
+                size = 0
+
+        if current:
+            chunk.append(current[1])
+        chunk.extend((path, [], []) for _, path in pending)
+        if chunk:
+            yield chunk
+
+
+def find_media(
+    dsn: str,
+    kind: MediaKind,
+    /,
+    *,
+    min_width: int | None = None,
+    min_height: int | None = None,
+    min_duration: int | None = None,
+    max_duration: int | None = None,
+    order_by: MediaOrder = "updated",
+    descending: bool = True,
+    after: Node | None = None,
+    limit: int | None = None,
+    chunk_size: int = WALK_CHUNK_SIZE,
+) -> Iterator[list[Node]]:
+    """
+    Images or videos matching the given bounds, sorted by `order_by`, in
+    chunks. Durations are in milliseconds, so they do not apply to images.
+    To get the next page, pass the last node of the previous one as
+    `after`. If it has been removed since, nodes sorted the same as it are
+    all returned again rather than skipped.
+    """
+    from ._sql import SQL_JOIN_TABLES, SQL_MEDIA_KINDS, SQL_MEDIA_ORDERS
+
+    if kind == "image" and (
+        order_by == "duration" or min_duration is not None or max_duration is not None
+    ):
+        raise ValueError("images have no duration")
+
+    column = SQL_MEDIA_ORDERS[order_by]
+    conditions = [SQL_MEDIA_KINDS[kind]]
+    parameters: list[object] = []
+    for value, condition in (
+        (min_width, "nodes.width >= ?"),
+        (min_height, "nodes.height >= ?"),
+        (min_duration, "nodes.ms_duration >= ?"),
+        (max_duration, "nodes.ms_duration <= ?"),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    if after:
+        # the key breaks ties, so a page never repeats or skips a node, and
+        # without it every tie comes after
+        op, no_key = ("<", MAX_KEY) if descending else (">", -1)
+        conditions.append(
+            f"({column}, nodes.key) {op} "
+            "(?, COALESCE((SELECT key FROM ids WHERE id = ?), ?))"
+        )
+        parameters.extend((_media_order_value(after, order_by), after.id, no_key))
+    direction = "DESC" if descending else "ASC"
+    sql = (
+        SQL_JOIN_TABLES
+        + "WHERE "
+        + " AND ".join(conditions)
+        + f" ORDER BY {column} {direction}, nodes.key {direction}"
+    )
+    if limit is not None:
+        sql += " LIMIT ?"
+        parameters.append(limit)
+
+    with read_only(dsn) as query:
+        query.execute(sql + ";", parameters)
+        while rows := query.fetchmany(chunk_size):
+            yield [node_from_query(_) for _ in rows]
+
+
+def _media_order_value(node: Node, order_by: MediaOrder) -> int:
+    match order_by:
+        case "updated":
+            return int(node.mtime.timestamp() * 1_000_000)
+        case "created":
+            return int(node.ctime.timestamp() * 1_000_000)
+        case "width":
+            return node.width
+        case "duration":
+            return node.ms_duration
+
+
 def get_trashed_nodes(dsn: str, /) -> list[Node]:
     from ._sql import SQL_SELECT_TRASHED_NODES
 
     with read_only(dsn) as query:
-        query.execute(SQL_SELECT_TRASHED_NODES, (True,))
+        query.execute(SQL_SELECT_TRASHED_NODES)
         nodes = [node_from_query(_) for _ in query]
     return nodes
 
 
-def apply_changes(dsn: str, changes: list[ChangeAction], cursor: str, /) -> None:
+def apply_changes(
+    dsn: str,
+    changes: list[ChangeAction],
+    cursor: str,
+    /,
+    *,
+    journal: bool = False,
+    journal_retention: int | None = None,
+) -> ApplyStats:
+    # changes that are already in the snapshot are not written again
+    written: list[ChangeAction] = []
     with read_write(dsn) as query:
         for change in changes:
-            dispatch_change(
+            if dispatch_change(
                 change,
                 on_remove=lambda _: inner_delete_node_by_id(query, _),
                 on_update=lambda _: inner_insert_node(query, _),
-            )
+            ):
+                written.append(change)
         inner_set_metadata(query, KEY_CURSOR, cursor)
 
+        if journal:
+            inner_append_changes(query, written, cursor)
+            if journal_retention is not None:
+                seq = inner_get_change_seq(query)
+                if seq > journal_retention:
+                    inner_trim_changes(query, seq - journal_retention)
+
+    return {"written": len(written), "skipped": len(changes) - len(written)}
+
+
+def get_change_seq(dsn: str, /) -> int:
+    with read_only(dsn) as query:
+        return inner_get_change_seq(query)
+
+
+def iter_changes_since(
+    dsn: str, seq: int, /, *, chunk_size: int = CHANGES_CHUNK_SIZE
+) -> Iterator[list[JournalEntry]]:
+    with read_only(dsn) as query:
+        floor = inner_get_metadata(query, KEY_JOURNAL_FLOOR)
+        if floor and seq < int(floor):
+            raise SqliteSnapshotError(
+                f"changes before {floor} have been discarded, please rescan"
+            )
+
+        query.execute(
+            "SELECT seq, removed, id FROM changes WHERE seq > ? ORDER BY seq;",
+            (seq,),
+        )
+        while rv := query.fetchmany(chunk_size):
+            yield [(_["seq"], bool(_["removed"]), _["id"]) for _ in rv]
+
+
+def compact_changes(dsn: str, /) -> None:
+    # Only the latest entry of a node matters, because consumers read the
+    # current state of the node anyway.
+    with read_write(dsn) as query:
+        inner_compact_changes(query, inner_get_change_seq(query))
+
+
+def trim_changes(dsn: str, seq: int, /) -> None:
+    with read_write(dsn) as query:
+        inner_trim_changes(query, seq)
+
 
 def find_nodes_by_regex(dsn: str, pattern: str, /) -> list[Node]:
     from functools import partial
@@ -145,6 +524,15 @@ def find_nodes_by_regex(dsn: str, pattern: str, /) -> list[Node]:
     return rv
 
 
+def find_nodes_by_hash(dsn: str, hash_: str, /) -> list[Node]:
+    from ._sql import SQL_SELECT_NODES_BY_HASH
+
+    with read_only(dsn) as query:
+        query.execute(SQL_SELECT_NODES_BY_HASH, (hash_,))
+        rv = [node_from_query(_) for _ in query]
+    return rv
+
+
 def get_current_cursor(dsn: str, /) -> str | None:
     with read_only(dsn) as query:
         return inner_get_metadata(query, KEY_CURSOR)
@@ -170,16 +558,12 @@ def get_node_by_id(dsn: str, node_id: str, /) -> Node | None:
 
 
 def get_uploaded_size(dsn: str, begin: datetime, end: datetime) -> int:
+    from ._sql import SQL_SUM_SIZE_BY_CREATED
+
     b = int(begin.timestamp() * 1_000_000)
     e = int(end.timestamp() * 1_000_000)
     with read_only(dsn) as query:
-        query.execute(
-            "SELECT SUM(size) AS sum "
-            "FROM files "
-            "INNER JOIN nodes ON files.id = nodes.id "
-            "WHERE created >= ? AND created < ?;",
-            (b, e),
-        )
+        query.execute(SQL_SUM_SIZE_BY_CREATED, (b, e))
         rv = query.fetchone()
         if not rv:
             return 0
@@ -188,6 +572,83 @@ def get_uploaded_size(dsn: str, begin: datetime, end: datetime) -> int:
         return rv["sum"]
 
 
+def get_uploaded_size_histogram(
+    dsn: str,
+    begin: datetime,
+    end: datetime,
+    *,
+    bucket: BucketSize = "day",
+    group_by_mime_type: bool = False,
+) -> list[UploadBucket]:
+    """
+    Like `get_uploaded_size`, but summed per hour, day or month in one
+    query. Empty buckets are left out.
+    """
+    from ._sql import SQL_BUCKET_FORMATS
+
+    b = int(begin.timestamp() * 1_000_000)
+    e = int(end.timestamp() * 1_000_000)
+    fmt = SQL_BUCKET_FORMATS[bucket]
+    mime_type = "mime_type" if group_by_mime_type else "NULL"
+    with read_only(dsn) as query:
+        query.execute(
+            f"SELECT strftime(?, created / 1000000, 'unixepoch') AS bucket, "
+            f"{mime_type} AS mime_type, SUM(size) AS sum "
+            "FROM nodes "
+            "WHERE created >= ? AND created < ? AND size IS NOT NULL "
+            "GROUP BY 1, 2 "
+            "ORDER BY 1, 2;",
+            (fmt, b, e),
+        )
+        return [
+            {
+                "begin": datetime.fromisoformat(_["bucket"]).replace(tzinfo=UTC),
+                "mime_type": _["mime_type"],
+                "size": _["sum"],
+            }
+            for _ in query
+        ]
+
+
+def get_statistics(dsn: str, /) -> Statistics:
+    """
+    Counts and byte totals of the whole snapshot, by kind of node, trashed
+    state and MIME type. Trashed nodes are counted in every facet.
+    """
+    from ._sql import (
+        SQL_SELECT_FACETS,
+        SQL_SELECT_MIME_TYPE_FACETS,
+        SQL_SELECT_TRASHED_FACET,
+    )
+
+    with read_only(dsn) as query:
+        query.execute(SQL_SELECT_FACETS)
+        facets = query.fetchone()
+        query.execute(SQL_SELECT_TRASHED_FACET)
+        trashed = query.fetchone()
+        query.execute(SQL_SELECT_MIME_TYPE_FACETS)
+        mime_types: dict[str, Facet] = {
+            _["mime_type"]: {"count": _["count"], "size": int(_["size"])} for _ in query
+        }
+
+    size = int(facets["size"])
+    return {
+        "nodes": {"count": facets["count"], "size": size},
+        "directories": {"count": facets["directories"] or 0, "size": 0},
+        "files": {"count": facets["files"], "size": size},
+        "images": {
+            "count": facets["images"] or 0,
+            "size": int(facets["images_size"]),
+        },
+        "videos": {
+            "count": facets["videos"] or 0,
+            "size": int(facets["videos_size"]),
+        },
+        "trashed": {"count": trashed["count"], "size": int(trashed["size"])},
+        "mime_types": mime_types,
+    }
+
+
 def find_orphan_nodes(dsn: str) -> list[Node]:
     from ._sql import SQL_SELECT_ORPHAN_NODES
 
@@ -200,12 +661,41 @@ def find_orphan_nodes(dsn: str) -> list[Node]:
 def find_multiple_parents_nodes(dsn: str) -> list[Node]:
     with read_only(dsn) as query:
         query.execute(
-            "SELECT id, COUNT(id) AS parent_count "
+            "SELECT key, COUNT(key) AS parent_count "
             "FROM parents "
-            "GROUP BY id "
+            "GROUP BY key "
             "HAVING parent_count > 1;"
         )
         rv = query.fetchall()
-        raw_query = (inner_get_node_by_id(query, _["id"]) for _ in rv)
+        raw_query = (inner_get_node_by_key(query, _["key"]) for _ in rv)
         nodes = [_ for _ in raw_query if _]
     return nodes
+
+
+def diff_snapshots(dsn_a: str, dsn_b: str) -> Iterator[tuple[DiffKind, Node]]:
+    """
+    Compare two snapshot files and yield what it takes to turn A into B.
+    Removed nodes come from A, added and changed nodes come from B.
+    """
+    from ._sql import (
+        SQL_SELECT_ADDED_NODES,
+        SQL_SELECT_CHANGED_NODES,
+        SQL_SELECT_REMOVED_NODES,
+    )
+
+    steps: list[tuple[DiffKind, str]] = [
+        ("removed", SQL_SELECT_REMOVED_NODES),
+        ("added", SQL_SELECT_ADDED_NODES),
+        ("changed", SQL_SELECT_CHANGED_NODES),
+    ]
+    with read_only(dsn_a) as query:
+        query.execute("ATTACH DATABASE ? AS other;", (dsn_b,))
+        for kind, sql in steps:
+            # nodes with multiple parents span multiple rows
+            seen: set[str] = set()
+            query.execute(sql)
+            for row in query:
+                if row["id"] in seen:
+                    continue
+                seen.add(row["id"])
+                yield kind, node_from_query(row)
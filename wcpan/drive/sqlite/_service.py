@@ -1,38 +1,434 @@
-from contextlib import asynccontextmanager
+from asyncio import (
+    FIRST_COMPLETED,
+    Event,
+    Future,
+    Queue,
+    Task,
+    create_task,
+    get_running_loop,
+    sleep,
+    wait,
+)
+from collections import deque
+from collections.abc import AsyncIterator, Callable
+from contextlib import ExitStack, aclosing, asynccontextmanager
+from copy import copy
+from itertools import count
+from logging import getLogger
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import PurePath
+from time import perf_counter
+from typing import TypedDict
 
 from wcpan.drive.core.exceptions import NodeNotFoundError
+from wcpan.drive.core.lib import dispatch_change
 from wcpan.drive.core.types import ChangeAction, Node, SnapshotService
 
-from ._lib import OffMainProcess
+from ._lib import (
+    CancelFlags,
+    LeastBusy,
+    OffMainProcess,
+    TimingSink,
+    checkpoint,
+    immutable_dsn,
+    keep_connection,
+    keep_replica,
+    load_in_memory,
+    pin_snapshot,
+    share_cancel_flags,
+    unpin_snapshot,
+)
 from ._outer import (
+    ApplyStats,
+    check_schema,
+    MaintenanceStats,
+    MediaKind,
+    MediaOrder,
+    Statistics,
     initialize,
     get_node_by_path,
     resolve_path_by_id,
     get_child_by_name,
     get_children_by_id,
+    get_children_by_ids,
     get_trashed_nodes,
+    find_media,
     apply_changes,
+    compact_changes,
+    get_change_seq,
+    iter_changes_since,
+    trim_changes,
     find_nodes_by_regex,
+    find_nodes_by_hash,
     get_current_cursor,
     get_root,
+    get_statistics,
+    maintain,
     set_root,
     get_node_by_id,
+    get_nodes_by_ids,
+    walk,
 )
 
 
+# Names of pinned snapshots are unique within a process.
+_snapshot_ids = count(1)
+# How long writes must have paused before maintenance runs.
+MAINTENANCE_IDLE_SECONDS = 5.0
+
+
+class _TimingOptions(TypedDict):
+    sink: TimingSink | None
+    slow_query_seconds: float | None
+
+
 @asynccontextmanager
-async def create_service(*, dsn: str):
-    with ProcessPoolExecutor() as pool:
-        bg = OffMainProcess(dsn=dsn, pool=pool)
+async def create_service(
+    *,
+    dsn: str,
+    journal: bool = False,
+    journal_retention: int | None = None,
+    replicas: int = 0,
+    in_memory: bool = False,
+    checkpoint_interval: float = 60.0,
+    timing_sink: TimingSink | None = None,
+    slow_query_seconds: float | None = None,
+    maintenance_interval: float | None = None,
+    immutable: bool = False,
+    query_timeout: float | None = None,
+    bulk_workers: int = 0,
+):
+    """
+    Create a snapshot service backed by the SQLite database at `dsn`.
+
+    With `journal`, every applied change is also appended to a change
+    journal that can be read back with `iter_changes_since`. With
+    `journal_retention`, only that many latest entries are kept.
+
+    With `replicas`, reads are spread over that many workers which each
+    keep an in-memory copy of the database. A copy catches up by replaying
+    the journal, so `journal` is required.
+
+    With `in_memory`, the database is loaded into one worker's memory, which
+    serves every read and write. It is saved back to the file every
+    `checkpoint_interval` seconds and on exit.
+
+    With `timing_sink`, the timings of every call except streaming ones are
+    passed to it, and statements slower than `slow_query_seconds` are
+    logged with their query plan.
+
+    With `maintenance_interval`, `maintain` runs that often in seconds, once
+    writes have paused for a while. Results are logged at info level.
+
+    With `immutable`, the database is opened read-only and without locking,
+    for copies which never change. Nothing is written, so the schema must
+    already be the current one, and writes fail.
+
+    With `query_timeout`, reads taking longer in seconds raise
+    `TimeoutError`. A read which times out or is cancelled is interrupted
+    in its worker, so it does not keep the worker busy.
+
+    With `bulk_workers`, walks, searches and other scans run in a separate
+    pool of that many workers, so point lookups never wait behind them.
+
+    The in-memory mode takes none of `maintenance_interval`, `query_timeout`
+    and `bulk_workers`, and the immutable mode neither `maintenance_interval`
+    nor `bulk_workers`.
+    """
+    timing: _TimingOptions = {
+        "sink": timing_sink,
+        "slow_query_seconds": slow_query_seconds,
+    }
+    if maintenance_interval is not None and (immutable or in_memory):
+        raise ValueError("only the file of the normal mode is maintained")
+    if immutable:
+        if replicas > 0 or in_memory:
+            raise ValueError("immutable mode has no replicas nor memory copy")
+        if bulk_workers > 0:
+            raise ValueError("immutable mode has no bulk workers")
+        async with _create_immutable_service(
+            dsn=immutable_dsn(dsn), timing=timing, query_timeout=query_timeout
+        ) as service:
+            yield service
+        return
+
+    if replicas > 0 and not journal:
+        raise ValueError("replicas are refreshed from the journal")
+
+    if in_memory:
+        if replicas > 0:
+            raise ValueError("in-memory mode has no replicas")
+        if bulk_workers > 0 or query_timeout is not None:
+            raise ValueError("in-memory mode has no bulk workers nor timeout")
+        async with _create_in_memory_service(
+            dsn=dsn,
+            journal=journal,
+            journal_retention=journal_retention,
+            checkpoint_interval=checkpoint_interval,
+            timing=timing,
+        ) as service:
+            yield service
+        return
+
+    with (
+        ExitStack() as stack,
+        # all writes go through one process which keeps its connection
+        ProcessPoolExecutor(
+            max_workers=1, initializer=keep_connection, initargs=(dsn,)
+        ) as writer_pool,
+    ):
+        writer = OffMainProcess(dsn=dsn, pool=writer_pool, **timing)
+        # read workers of both lanes share them
+        cancel = CancelFlags()
+        # replicas copy the database, so it must be ready first
+        await writer(initialize)
+
+        bg: OffMainProcess | LeastBusy
+        if replicas > 0:
+            bg = LeastBusy(
+                [
+                    OffMainProcess(
+                        dsn=dsn,
+                        pool=stack.enter_context(
+                            ProcessPoolExecutor(
+                                max_workers=1,
+                                initializer=share_cancel_flags,
+                                initargs=(cancel.shared, keep_replica, dsn),
+                            )
+                        ),
+                        cancel=cancel,
+                        timeout=query_timeout,
+                        **timing,
+                    )
+                    for _ in range(replicas)
+                ]
+            )
+        else:
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    initializer=share_cancel_flags, initargs=(cancel.shared,)
+                )
+            )
+            bg = OffMainProcess(
+                dsn=dsn,
+                pool=pool,
+                cancel=cancel,
+                timeout=query_timeout,
+                **timing,
+            )
+
+        snapshots = OffMainProcess(
+            dsn=dsn,
+            pool=stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=share_cancel_flags,
+                    initargs=(cancel.shared,),
+                )
+            ),
+            cancel=cancel,
+            timeout=query_timeout,
+            **timing,
+        )
+        # starts the worker now rather than on the first snapshot
+        await snapshots(check_schema)
+
+        bulk: OffMainProcess | None = None
+        if bulk_workers > 0:
+            bulk_pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=bulk_workers,
+                    initializer=share_cancel_flags,
+                    initargs=(cancel.shared,),
+                )
+            )
+            bulk = OffMainProcess(
+                dsn=dsn,
+                pool=bulk_pool,
+                cancel=cancel,
+                timeout=query_timeout,
+                **timing,
+            )
+
+        service = SqliteSnapshotService(
+            bg,
+            bulk=bulk,
+            snapshots=snapshots,
+            writer=writer,
+            journal=journal,
+            journal_retention=journal_retention,
+        )
+        maintainer = (
+            create_task(_maintain_every(service, maintenance_interval))
+            if maintenance_interval
+            else None
+        )
+        try:
+            yield service
+        finally:
+            if maintainer:
+                maintainer.cancel()
+            await service.close()
+
+
+@asynccontextmanager
+async def _create_in_memory_service(
+    *,
+    dsn: str,
+    journal: bool,
+    journal_retention: int | None,
+    checkpoint_interval: float,
+    timing: _TimingOptions,
+):
+    logger = getLogger(__name__)
+    cancel = CancelFlags()
+    with ProcessPoolExecutor(
+        max_workers=1,
+        initializer=share_cancel_flags,
+        initargs=(cancel.shared, load_in_memory, dsn),
+    ) as pool:
+        bg = OffMainProcess(dsn=dsn, pool=pool, **timing)
+        # the same worker, but scans are stopped when they are abandoned
+        bulk = OffMainProcess(dsn=dsn, pool=pool, cancel=cancel, **timing)
+
+        begin = perf_counter()
         await bg(initialize)
-        yield SqliteSnapshotService(bg)
+        logger.info("loaded %s into memory in %.3fs", dsn, perf_counter() - begin)
+
+        # the file is stale until the next checkpoint, so no snapshots
+        service = SqliteSnapshotService(
+            bg, bulk=bulk, journal=journal, journal_retention=journal_retention
+        )
+        saver = create_task(_checkpoint_every(service, checkpoint_interval))
+        try:
+            yield service
+        finally:
+            saver.cancel()
+            await service.close()
+            begin = perf_counter()
+            await bg(checkpoint)
+            logger.info("saved %s to disk in %.3fs", dsn, perf_counter() - begin)
+
+
+async def _checkpoint_every(service: "SqliteSnapshotService", interval: float) -> None:
+    while True:
+        await sleep(interval)
+        # between writes, so no half-applied batch is saved
+        await service._writes.submit(checkpoint)
+
+
+@asynccontextmanager
+async def _create_immutable_service(
+    *, dsn: str, timing: _TimingOptions, query_timeout: float | None
+):
+    cancel = CancelFlags()
+    with (
+        ProcessPoolExecutor(
+            initializer=share_cancel_flags,
+            initargs=(cancel.shared, keep_connection, dsn),
+        ) as pool,
+        ProcessPoolExecutor(
+            max_workers=1, initializer=share_cancel_flags, initargs=(cancel.shared,)
+        ) as snapshot_pool,
+    ):
+        bg = OffMainProcess(
+            dsn=dsn,
+            pool=pool,
+            cancel=cancel,
+            timeout=query_timeout,
+            **timing,
+        )
+        await bg(check_schema)
+        snapshots = OffMainProcess(
+            dsn=dsn,
+            pool=snapshot_pool,
+            cancel=cancel,
+            timeout=query_timeout,
+            **timing,
+        )
+        await snapshots(check_schema)
+        service = SqliteSnapshotService(bg, snapshots=snapshots)
+        try:
+            yield service
+        finally:
+            await service.close()
+
+
+async def _maintain_every(service: "SqliteSnapshotService", interval: float) -> None:
+    logger = getLogger(__name__)
+    while True:
+        await sleep(interval)
+        while service._writes.idle_seconds < MAINTENANCE_IDLE_SECONDS:
+            await sleep(MAINTENANCE_IDLE_SECONDS)
+        try:
+            stats = await service.maintain()
+        except Exception:
+            logger.exception("maintenance failed")
+            continue
+        logger.info(
+            "maintenance took %.3fs, vacuumed %d pages (%d free), "
+            "checkpointed %d of %d WAL frames",
+            stats["seconds"],
+            stats["vacuumed_pages"],
+            stats["free_pages"],
+            stats["checkpointed_frames"],
+            stats["wal_frames"],
+        )
 
 
 class SqliteSnapshotService(SnapshotService):
-    def __init__(self, bg: OffMainProcess) -> None:
+    def __init__(
+        self,
+        bg: OffMainProcess | LeastBusy,
+        *,
+        bulk: OffMainProcess | None = None,
+        snapshots: OffMainProcess | None = None,
+        writer: OffMainProcess | None = None,
+        journal: bool = False,
+        journal_retention: int | None = None,
+    ) -> None:
         self._bg = bg
+        # scans run here, so they do not hold up point lookups
+        self._bulk = bulk or bg
+        # the worker which pins snapshots, if the database is a file
+        self._snapshots = snapshots
+        self._writes = WriteQueue(writer or bg)
+        self._journal = journal
+        self._journal_retention = journal_retention
+        # subscriber queue -> whether publishing blocks when it is full
+        self._subscribers: dict[Queue[list[str] | None], bool] = {}
+
+    async def close(self) -> None:
+        """
+        Finish queued writes and end all subscriptions.
+        """
+        await self._writes.close()
+        for queue in self._subscribers:
+            _put_nowait(queue, None)
+
+    @asynccontextmanager
+    async def snapshot(self):
+        """
+        Yield a view of this service whose reads all see the same state of
+        the snapshot, even if changes are committed meanwhile. The reads run
+        inside one read transaction, in a worker which is shared by all
+        snapshots. Writes made through the view go to this service and are
+        not seen by the view.
+        """
+        if not self._snapshots:
+            # in-memory databases, and views of a snapshot
+            raise RuntimeError("this service cannot pin snapshots")
+        name = f"{self._snapshots.dsn}#snapshot-{next(_snapshot_ids)}"
+        await self._snapshots(pin_snapshot, name)
+        pinned = self._snapshots.with_dsn(name)
+        try:
+            view = copy(self)
+            view._bg = view._bulk = pinned
+            view._snapshots = None
+            view._subscribers = {}
+            yield view
+        finally:
+            await pinned(unpin_snapshot)
 
     @property
     def api_version(self) -> int:
@@ -49,7 +445,7 @@ class SqliteSnapshotService(SnapshotService):
         return root
 
     async def set_root(self, node: Node) -> None:
-        await self._bg(set_root, node)
+        await self._writes.submit(set_root, node)
 
     async def get_node_by_id(self, node_id: str) -> Node:
         node = await self._bg(get_node_by_id, node_id)
@@ -80,15 +476,359 @@ class SqliteSnapshotService(SnapshotService):
     async def get_children_by_id(self, parent_id: str) -> list[Node]:
         return await self._bg(get_children_by_id, parent_id)
 
+    async def get_nodes_by_ids(self, node_ids: list[str]) -> dict[str, Node]:
+        """
+        Get many nodes in one round trip. Missing IDs are absent from the
+        result.
+        """
+        return await self._bg(get_nodes_by_ids, node_ids)
+
+    async def get_children_by_ids(self, parent_ids: list[str]) -> dict[str, list[Node]]:
+        """
+        Get first-level children of many nodes in one round trip. Every
+        requested ID is present in the result.
+        """
+        return await self._bg(get_children_by_ids, parent_ids)
+
+    async def walk(
+        self, node_id: str
+    ) -> AsyncIterator[tuple[PurePath, list[Node], list[Node]]]:
+        """
+        Walk the tree under a directory breadth-first, yielding
+        `(dirpath, dirs, files)` like `os.walk`. The whole walk is one query
+        in one worker, so changing `dirs` does not prune it.
+        """
+        async with aclosing(self._bulk.stream(walk, node_id)) as chunks:
+            async for chunk in chunks:
+                for entry in chunk:
+                    yield entry
+
     async def get_trashed_nodes(self) -> list[Node]:
-        return await self._bg(get_trashed_nodes)
+        return await self._bulk(get_trashed_nodes)
+
+    async def find_media(
+        self,
+        kind: MediaKind,
+        *,
+        min_width: int | None = None,
+        min_height: int | None = None,
+        min_duration: int | None = None,
+        max_duration: int | None = None,
+        order_by: MediaOrder = "updated",
+        descending: bool = True,
+        after: Node | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[Node]:
+        """
+        Stream images or videos matching the given bounds, sorted by
+        `order_by`. Durations are in milliseconds. To get the next page,
+        pass the last node of the previous one as `after`.
+        """
+        chunks = self._bulk.stream(
+            find_media,
+            kind,
+            min_width=min_width,
+            min_height=min_height,
+            min_duration=min_duration,
+            max_duration=max_duration,
+            order_by=order_by,
+            descending=descending,
+            after=after,
+            limit=limit,
+        )
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                for node in chunk:
+                    yield node
+
+    async def maintain(self) -> MaintenanceStats:
+        """
+        Refresh planner statistics, shrink the file a bit and checkpoint the
+        WAL. Runs in the writer between writes; every step is bounded.
+        """
+        return await self._writes.submit(maintain)
+
+    async def get_statistics(self) -> Statistics:
+        return await self._bulk(get_statistics)
 
     async def apply_changes(
         self,
         changes: list[ChangeAction],
         cursor: str,
     ) -> None:
-        return await self._bg(apply_changes, changes, cursor)
+        stats = await self._writes.apply_changes(
+            changes,
+            cursor,
+            journal=self._journal,
+            journal_retention=self._journal_retention,
+        )
+        getLogger(__name__).debug(
+            "applied %d changes, skipped %d unchanged",
+            stats["written"],
+            stats["skipped"],
+        )
+        if self._subscribers:
+            node_ids = [
+                dispatch_change(_, on_remove=lambda _: _, on_update=lambda _: _.id)
+                for _ in changes
+            ]
+            await self._publish(node_ids)
+
+    @asynccontextmanager
+    async def ingest(self, *, chunk_size: int = 1000, max_pending: int = 4):
+        """
+        Apply changes in the background while the caller fetches more.
+
+        Batches given to `feed` are merged or split into transactions of
+        about `chunk_size` changes. A batch's cursor is only stored with its
+        last change, so the stored cursor never runs ahead of the committed
+        changes. `feed` waits when `max_pending` batches are queued.
+
+        Leaving the context normally waits for all batches to be committed.
+        Leaving it with an error discards the uncommitted ones.
+        """
+        cursor = await self.get_current_cursor()
+        ingest = ChangeIngest(
+            self, cursor, chunk_size=chunk_size, max_pending=max_pending
+        )
+        try:
+            yield ingest
+        except BaseException:
+            await ingest.cancel()
+            raise
+        await ingest.flush()
 
     async def find_nodes_by_regex(self, pattern: str) -> list[Node]:
-        return await self._bg(find_nodes_by_regex, pattern)
+        return await self._bulk(find_nodes_by_regex, pattern)
+
+    async def find_nodes_by_hash(self, hash_: str) -> list[Node]:
+        return await self._bg(find_nodes_by_hash, hash_)
+
+    async def get_change_seq(self) -> int:
+        """
+        Get the sequence number of the latest journal entry, or 0.
+        """
+        return await self._bg(get_change_seq)
+
+    async def iter_changes_since(
+        self, seq: int
+    ) -> AsyncIterator[tuple[int, bool, str]]:
+        """
+        Yield `(seq, removed, node_id)` for journal entries after `seq`.
+        Raises `SqliteSnapshotError` if some of them have been discarded.
+        """
+        async with aclosing(self._bulk.stream(iter_changes_since, seq)) as chunks:
+            async for chunk in chunks:
+                for entry in chunk:
+                    yield entry
+
+    async def compact_changes(self) -> None:
+        """
+        Keep only the latest journal entry of each node.
+        """
+        await self._writes.submit(compact_changes)
+
+    async def trim_changes(self, seq: int) -> None:
+        """
+        Discard journal entries up to and including `seq`.
+        """
+        await self._writes.submit(trim_changes, seq)
+
+    async def subscribe(
+        self, *, max_size: int = 16, block: bool = False
+    ) -> AsyncIterator[list[str]]:
+        """
+        Yield the IDs of removed or updated nodes after each committed
+        `apply_changes`, until the service is closed.
+
+        At most `max_size` batches are buffered. When the buffer is full,
+        `block` makes `apply_changes` wait for this subscriber, otherwise
+        the oldest batch is dropped.
+        """
+        queue = Queue[list[str] | None](max_size)
+        self._subscribers[queue] = block
+        try:
+            while (node_ids := await queue.get()) is not None:
+                yield node_ids
+        finally:
+            del self._subscribers[queue]
+
+    async def _publish(self, node_ids: list[str]) -> None:
+        for queue, block in list(self._subscribers.items()):
+            if block:
+                await queue.put(node_ids)
+            else:
+                _put_nowait(queue, node_ids)
+
+
+type _Write = tuple[Callable[..., object], tuple, dict[str, object], Future]
+
+
+class WriteQueue:
+    """
+    Runs writes one at a time in submission order. Consecutive
+    `apply_changes` calls waiting in the queue are committed together.
+    """
+
+    def __init__(self, bg: OffMainProcess | LeastBusy) -> None:
+        self._bg = bg
+        self._queue = deque[_Write]()
+        self._wakeup = Event()
+        self._closed = False
+        # when the last write finished, None while writing
+        self._idle_since: float | None = perf_counter()
+        self._runner = create_task(self._run())
+
+    async def submit[R](self, fn: Callable[..., R], *args, **kwargs) -> R:
+        if self._closed:
+            raise RuntimeError("write queue has been closed")
+        future = get_running_loop().create_future()
+        self._queue.append((fn, args, kwargs, future))
+        self._idle_since = None
+        self._wakeup.set()
+        return await future
+
+    @property
+    def idle_seconds(self) -> float:
+        if self._idle_since is None:
+            return 0.0
+        return perf_counter() - self._idle_since
+
+    async def apply_changes(
+        self, changes: list[ChangeAction], cursor: str, **kwargs
+    ) -> ApplyStats:
+        return await self.submit(apply_changes, changes, cursor, **kwargs)
+
+    async def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        await self._runner
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                await self._write(self._take())
+            self._idle_since = perf_counter()
+            if self._closed:
+                return
+
+    async def _write(self, group: list[_Write]) -> None:
+        # failures must not be raised through `_run`: their tracebacks would
+        # hold its frame, and clearing them (as `assertRaises` does) closes it
+        fn, args, kwargs, _ = group[0]
+        if len(group) > 1:
+            changes: list[ChangeAction] = []
+            for _, (batch, _), _, _ in group:
+                changes.extend(batch)
+            # later batches win, so the last cursor is the right one
+            args = (changes, group[-1][1][1])
+        try:
+            rv = await self._bg(fn, *args, **kwargs)
+        except Exception as e:
+            if len(group) > 1:
+                # nothing has been committed, so retry the batches one by
+                # one, and only the callers of bad ones get an error
+                for write in group:
+                    if not write[3].done():
+                        await self._write([write])
+                return
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_result(rv)
+
+    def _take(self) -> list[_Write]:
+        group = [self._queue.popleft()]
+        fn, _, kwargs, _ = group[0]
+        if fn is not apply_changes:
+            return group
+        while self._queue:
+            next_fn, _, next_kwargs, _ = self._queue[0]
+            if next_fn is not apply_changes or next_kwargs != kwargs:
+                break
+            group.append(self._queue.popleft())
+        return group
+
+
+class ChangeIngest:
+    def __init__(
+        self,
+        service: SqliteSnapshotService,
+        cursor: str,
+        *,
+        chunk_size: int,
+        max_pending: int,
+    ) -> None:
+        self._service = service
+        self._cursor = cursor
+        self._chunk_size = chunk_size
+        self._queue = Queue[tuple[list[ChangeAction], str] | None](max_pending)
+        self._writer: Task[None] = create_task(self._write())
+
+    async def feed(self, changes: list[ChangeAction], cursor: str) -> None:
+        """
+        Queue a batch of changes which ends at `cursor`.
+        """
+        await self._put((changes, cursor))
+
+    async def flush(self) -> None:
+        await self._put(None)
+        await self._writer
+
+    async def cancel(self) -> None:
+        self._writer.cancel()
+        try:
+            await self._writer
+        except BaseException:
+            pass
+
+    async def _put(self, item: tuple[list[ChangeAction], str] | None) -> None:
+        # the queue may be full, and a failed writer never takes from it again
+        if not self._writer.done():
+            put = create_task(self._queue.put(item))
+            try:
+                await wait([put, self._writer], return_when=FIRST_COMPLETED)
+            finally:
+                put.cancel()
+            if put.done() and not put.cancelled():
+                return
+        # raises the writer's error, if any
+        self._writer.result()
+        raise RuntimeError("ingest has been closed")
+
+    async def _write(self) -> None:
+        pending: list[ChangeAction] = []
+        cursor = self._cursor
+        dirty = False
+        while (item := await self._queue.get()) is not None:
+            changes, next_cursor = item
+            for offset in range(0, len(changes), self._chunk_size):
+                pending.extend(changes[offset : offset + self._chunk_size])
+                more = offset + self._chunk_size < len(changes)
+                if more and len(pending) >= self._chunk_size:
+                    # the batch is not complete yet, keep the old cursor
+                    await self._service.apply_changes(pending, cursor)
+                    pending = []
+            cursor = next_cursor
+            dirty = True
+
+            # small batches are committed together while more are queued
+            if len(pending) >= self._chunk_size or self._queue.empty():
+                await self._service.apply_changes(pending, cursor)
+                pending = []
+                dirty = False
+
+        if dirty:
+            await self._service.apply_changes(pending, cursor)
+
+
+def _put_nowait[T](queue: Queue[T], item: T) -> None:
+    if queue.full():
+        # drop the oldest one
+        queue.get_nowait()
+    queue.put_nowait(item)
@@ -0,0 +1,133 @@
+from asyncio import Semaphore, as_completed, create_task, gather
+from collections.abc import AsyncIterator, Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from os import cpu_count
+
+from wcpan.drive.core.types import Node
+
+from ._lib import CancelFlags, OffMainProcess, keep_connections, share_cancel_flags
+from ._outer import check_schema, initialize
+from ._service import SqliteSnapshotService
+
+
+@asynccontextmanager
+async def create_sharded_service(
+    *,
+    dsns: dict[str, str],
+    max_workers: int | None = None,
+    writers: int = 1,
+    max_calls_per_shard: int | None = None,
+    journal: bool = False,
+    journal_retention: int | None = None,
+    query_timeout: float | None = None,
+):
+    """
+    Host one snapshot service per named DSN on shared pools: `max_workers`
+    processes for reads, `writers` for writes and one for the snapshots of
+    `SqliteSnapshotService.snapshot`. Every read or write worker keeps one
+    connection to each database. A shard has at most `max_calls_per_shard`
+    reads in flight, half the readers by default, so a busy shard cannot
+    starve the others.
+
+    Reads are bounded by `query_timeout` and interrupted in their worker
+    when they time out or are cancelled, as with `create_service`.
+    """
+    if not dsns:
+        raise ValueError("no shards")
+    workers = max_workers or cpu_count() or 1
+    per_shard = max_calls_per_shard or max(1, workers // 2)
+    all_dsns = list(dsns.values())
+    # readers of every shard share them
+    cancel = CancelFlags()
+    with (
+        ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=share_cancel_flags,
+            initargs=(cancel.shared, keep_connections, all_dsns),
+        ) as pool,
+        # the write queue of each shard keeps its writes in order
+        ProcessPoolExecutor(
+            max_workers=writers, initializer=keep_connections, initargs=(all_dsns,)
+        ) as writer_pool,
+        # pins the snapshots of every shard
+        ProcessPoolExecutor(
+            max_workers=1, initializer=share_cancel_flags, initargs=(cancel.shared,)
+        ) as snapshot_pool,
+    ):
+        shards: dict[str, SqliteSnapshotService] = {}
+        for name, dsn in dsns.items():
+            writer = OffMainProcess(dsn=dsn, pool=writer_pool)
+            await writer(initialize)
+            bg = OffMainProcess(
+                dsn=dsn,
+                pool=pool,
+                slots=Semaphore(per_shard),
+                cancel=cancel,
+                timeout=query_timeout,
+            )
+            snapshots = OffMainProcess(
+                dsn=dsn, pool=snapshot_pool, cancel=cancel, timeout=query_timeout
+            )
+            await snapshots(check_schema)
+            shards[name] = SqliteSnapshotService(
+                bg,
+                snapshots=snapshots,
+                writer=writer,
+                journal=journal,
+                journal_retention=journal_retention,
+            )
+        service = ShardedSnapshotService(shards)
+        try:
+            yield service
+        finally:
+            await service.close()
+
+
+class ShardedSnapshotService:
+    def __init__(self, shards: dict[str, SqliteSnapshotService]) -> None:
+        self._shards = shards
+
+    def __getitem__(self, name: str) -> SqliteSnapshotService:
+        return self._shards[name]
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._shards)
+
+    async def close(self) -> None:
+        for shard in self._shards.values():
+            await shard.close()
+
+    def find_nodes_by_regex(
+        self, pattern: str
+    ) -> AsyncIterator[tuple[str, list[Node]]]:
+        """
+        Search every shard in parallel, yielding `(name, nodes)` as each one
+        finishes.
+        """
+        return self._fan_out(lambda _: _.find_nodes_by_regex(pattern))
+
+    def find_nodes_by_hash(self, hash_: str) -> AsyncIterator[tuple[str, list[Node]]]:
+        """
+        Like `find_nodes_by_regex`, but by content hash.
+        """
+        return self._fan_out(lambda _: _.find_nodes_by_hash(hash_))
+
+    async def _fan_out[
+        R
+    ](self, fn: Callable[[SqliteSnapshotService], Awaitable[R]]) -> AsyncIterator[
+        tuple[str, R]
+    ]:
+        async def run(name: str, shard: SqliteSnapshotService) -> tuple[str, R]:
+            return name, await fn(shard)
+
+        tasks = [create_task(run(name, shard)) for name, shard in self._shards.items()]
+        try:
+            for done in as_completed(tasks):
+                yield await done
+        finally:
+            # the consumer may stop before every shard has answered
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
@@ -17,7 +17,7 @@ class JoinedDict(TypedDict):
     extra: str | None
 
 
-CURRENT_SCHEMA_VERSION = 5
+CURRENT_SCHEMA_VERSION = 11
 
 SQL_CREATE_TABLES = [
     """
@@ -27,97 +27,455 @@ SQL_CREATE_TABLES = [
         PRIMARY KEY (key)
     );
     """,
+    # Remote IDs are long strings, so every table refers to a node by an
+    # integer key instead, and only this table stores the ID itself. A parent
+    # may be referenced before it arrives, so a key can exist without a node.
     """
-    CREATE TABLE IF NOT EXISTS nodes (
+    CREATE TABLE IF NOT EXISTS ids (
+        key INTEGER NOT NULL,
         id TEXT NOT NULL,
+        PRIMARY KEY (key)
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_ids_id ON ids(id);",
+    # Private payloads repeat a lot, so each distinct one is stored once and
+    # counts the nodes referring to it.
+    """
+    CREATE TABLE IF NOT EXISTS extras (
+        key INTEGER NOT NULL,
+        json JSON NOT NULL,
+        refs INTEGER NOT NULL,
+        PRIMARY KEY (key)
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_extras_json ON extras(json);",
+    # Directories have NULL file columns, and only images and videos have
+    # the media columns.
+    """
+    CREATE TABLE IF NOT EXISTS nodes (
+        key INTEGER NOT NULL,
         name TEXT,
         trashed BOOLEAN,
         created INTEGER,
         updated INTEGER,
-        PRIMARY KEY (id)
-    );
-    """,
-    "CREATE INDEX IF NOT EXISTS ix_nodes_names ON nodes(name);",
-    "CREATE INDEX IF NOT EXISTS ix_nodes_trashed ON nodes(trashed);",
-    "CREATE INDEX IF NOT EXISTS ix_nodes_created ON nodes(created);",
-    "CREATE INDEX IF NOT EXISTS ix_nodes_updated ON nodes(updated);",
-    """
-    CREATE TABLE IF NOT EXISTS files (
-        id TEXT NOT NULL,
         mime_type TEXT,
         hash TEXT,
         size INTEGER,
-        PRIMARY KEY (id),
-        FOREIGN KEY (id) REFERENCES nodes (id)
+        width INTEGER,
+        height INTEGER,
+        ms_duration INTEGER,
+        extra INTEGER,
+        PRIMARY KEY (key),
+        FOREIGN KEY (key) REFERENCES ids (key),
+        FOREIGN KEY (extra) REFERENCES extras (key)
     );
     """,
-    "CREATE INDEX IF NOT EXISTS ix_files_mime_type ON files(mime_type);",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_names ON nodes(name);",
+    # few nodes are trashed, and only those are ever looked up
+    "CREATE INDEX IF NOT EXISTS ix_nodes_trashed ON nodes(trashed) WHERE trashed = 1;",
+    # covers summing sizes over a time range
+    "CREATE INDEX IF NOT EXISTS ix_nodes_created_size ON nodes(created, size);",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_updated ON nodes(updated);",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_mime_type ON nodes(mime_type);",
+    # media queries filter and sort on these
+    "CREATE INDEX IF NOT EXISTS ix_nodes_width_height ON nodes(width, height);",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_ms_duration ON nodes(ms_duration);",
+    "CREATE INDEX IF NOT EXISTS ix_nodes_hash ON nodes(hash);",
     """
     CREATE TABLE IF NOT EXISTS parents (
-        id TEXT NOT NULL,
-        parent_id TEXT NOT NULL,
-        PRIMARY KEY (id, parent_id),
-        FOREIGN KEY (id) REFERENCES nodes (id),
-        FOREIGN KEY (parent_id) REFERENCES nodes (id)
-    );
+        key INTEGER NOT NULL,
+        parent_key INTEGER NOT NULL,
+        PRIMARY KEY (key, parent_key),
+        FOREIGN KEY (key) REFERENCES ids (key),
+        FOREIGN KEY (parent_key) REFERENCES ids (key)
+    ) WITHOUT ROWID;
     """,
-    "CREATE INDEX IF NOT EXISTS ix_parents_id ON parents(id);",
-    "CREATE INDEX IF NOT EXISTS ix_parents_parent_id ON parents(parent_id);",
+    # also holds the primary key, so it covers listing children
+    "CREATE INDEX IF NOT EXISTS ix_parents_parent_key ON parents(parent_key);",
     """
-    CREATE TABLE IF NOT EXISTS images (
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
         id TEXT NOT NULL,
-        width INTEGER NOT NULL,
-        height INTEGER NOT NULL,
-        PRIMARY KEY (id),
-        FOREIGN KEY (id) REFERENCES nodes (id)
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS audios (
-        id TEXT NOT NULL,
-        ms_duration INTEGER NOT NULL,
-        PRIMARY KEY (id),
-        FOREIGN KEY (id) REFERENCES nodes (id)
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS extras (
-        id TEXT NOT NULL,
-        json JSON NOT NULL,
-        PRIMARY KEY (id),
-        FOREIGN KEY (id) REFERENCES nodes (id)
+        removed BOOLEAN NOT NULL,
+        cursor TEXT
     );
     """,
     f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION};",
 ]
 
-SQL_JOIN_TABLES = """
+# The schema of version 5, the oldest one that can be migrated. Only for
+# building old snapshots in tests and benchmarks.
+SQL_CREATE_TABLES_V5 = [
+    "CREATE TABLE metadata (key TEXT NOT NULL, value TEXT, PRIMARY KEY (key));",
+    "CREATE TABLE nodes (id TEXT NOT NULL, name TEXT, trashed BOOLEAN, "
+    "created INTEGER, updated INTEGER, PRIMARY KEY (id));",
+    "CREATE INDEX ix_nodes_names ON nodes(name);",
+    "CREATE INDEX ix_nodes_trashed ON nodes(trashed);",
+    "CREATE INDEX ix_nodes_created ON nodes(created);",
+    "CREATE INDEX ix_nodes_updated ON nodes(updated);",
+    "CREATE TABLE files (id TEXT NOT NULL, mime_type TEXT, hash TEXT, "
+    "size INTEGER, PRIMARY KEY (id));",
+    "CREATE INDEX ix_files_mime_type ON files(mime_type);",
+    "CREATE TABLE parents (id TEXT NOT NULL, parent_id TEXT NOT NULL, "
+    "PRIMARY KEY (id, parent_id));",
+    "CREATE INDEX ix_parents_id ON parents(id);",
+    "CREATE INDEX ix_parents_parent_id ON parents(parent_id);",
+    "CREATE TABLE images (id TEXT NOT NULL, width INTEGER NOT NULL, "
+    "height INTEGER NOT NULL, PRIMARY KEY (id));",
+    "CREATE TABLE audios (id TEXT NOT NULL, ms_duration INTEGER NOT NULL, "
+    "PRIMARY KEY (id));",
+    "CREATE TABLE extras (id TEXT NOT NULL, json JSON NOT NULL, PRIMARY KEY (id));",
+    "PRAGMA user_version = 5;",
+]
+
+# Statements that upgrade a snapshot to the keyed version from the one below
+# it. Each version is applied in its own transaction, which also sets
+# user_version, so an interrupted upgrade resumes where it stopped.
+SQL_MIGRATIONS: dict[int, list[str]] = {
+    6: [
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL,
+            removed BOOLEAN NOT NULL,
+            cursor TEXT
+        );
+        """,
+    ],
+    # integer keys, folded file and media tables
+    7: [
+        "CREATE TABLE ids (key INTEGER NOT NULL, id TEXT NOT NULL, PRIMARY KEY (key));",
+        "INSERT INTO ids (id) SELECT id FROM nodes UNION SELECT parent_id FROM parents;",
+        "CREATE UNIQUE INDEX ux_ids_id ON ids(id);",
+        """
+        CREATE TABLE new_nodes (
+            key INTEGER NOT NULL,
+            name TEXT,
+            trashed BOOLEAN,
+            created INTEGER,
+            updated INTEGER,
+            mime_type TEXT,
+            hash TEXT,
+            size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            ms_duration INTEGER,
+            PRIMARY KEY (key),
+            FOREIGN KEY (key) REFERENCES ids (key)
+        );
+        """,
+        """
+        INSERT INTO new_nodes
+        SELECT
+            ids.key,
+            nodes.name,
+            nodes.trashed,
+            nodes.created,
+            nodes.updated,
+            files.mime_type,
+            files.hash,
+            files.size,
+            images.width,
+            images.height,
+            audios.ms_duration
+        FROM nodes
+        INNER JOIN ids ON nodes.id = ids.id
+        LEFT JOIN files ON nodes.id = files.id
+        LEFT JOIN images ON nodes.id = images.id
+        LEFT JOIN audios ON nodes.id = audios.id;
+        """,
+        """
+        CREATE TABLE new_parents (
+            key INTEGER NOT NULL,
+            parent_key INTEGER NOT NULL,
+            PRIMARY KEY (key, parent_key),
+            FOREIGN KEY (key) REFERENCES ids (key),
+            FOREIGN KEY (parent_key) REFERENCES ids (key)
+        ) WITHOUT ROWID;
+        """,
+        """
+        INSERT INTO new_parents
+        SELECT child.key, parent.key
+        FROM parents
+        INNER JOIN ids AS child ON parents.id = child.id
+        INNER JOIN ids AS parent ON parents.parent_id = parent.id;
+        """,
+        """
+        CREATE TABLE new_extras (
+            key INTEGER NOT NULL,
+            json JSON NOT NULL,
+            PRIMARY KEY (key),
+            FOREIGN KEY (key) REFERENCES ids (key)
+        );
+        """,
+        """
+        INSERT INTO new_extras
+        SELECT ids.key, extras.json
+        FROM extras
+        INNER JOIN ids ON extras.id = ids.id;
+        """,
+        "DROP TABLE extras;",
+        "DROP TABLE audios;",
+        "DROP TABLE images;",
+        "DROP TABLE parents;",
+        "DROP TABLE files;",
+        "DROP TABLE nodes;",
+        "ALTER TABLE new_nodes RENAME TO nodes;",
+        "ALTER TABLE new_parents RENAME TO parents;",
+        "ALTER TABLE new_extras RENAME TO extras;",
+        "CREATE INDEX ix_nodes_names ON nodes(name);",
+        "CREATE INDEX ix_nodes_trashed ON nodes(trashed);",
+        "CREATE INDEX ix_nodes_created ON nodes(created);",
+        "CREATE INDEX ix_nodes_updated ON nodes(updated);",
+        "CREATE INDEX ix_nodes_mime_type ON nodes(mime_type);",
+        "CREATE INDEX ix_parents_parent_key ON parents(parent_key);",
+    ],
+    # deduplicated extras
+    8: [
+        """
+        CREATE TABLE new_extras (
+            key INTEGER NOT NULL,
+            json JSON NOT NULL,
+            refs INTEGER NOT NULL,
+            PRIMARY KEY (key)
+        );
+        """,
+        "INSERT INTO new_extras (json, refs) SELECT json, COUNT(*) FROM extras GROUP BY json;",
+        "CREATE UNIQUE INDEX ux_extras_json ON new_extras(json);",
+        "ALTER TABLE nodes ADD COLUMN extra INTEGER REFERENCES extras (key);",
+        """
+        UPDATE nodes
+        SET extra = (
+            SELECT new_extras.key
+            FROM extras
+            INNER JOIN new_extras ON extras.json = new_extras.json
+            WHERE extras.key = nodes.key
+        )
+        WHERE key IN (SELECT key FROM extras);
+        """,
+        "DROP TABLE extras;",
+        "ALTER TABLE new_extras RENAME TO extras;",
+    ],
+    # indexes for the hot queries
+    9: [
+        "DROP INDEX ix_nodes_trashed;",
+        "CREATE INDEX ix_nodes_trashed ON nodes(trashed) WHERE trashed = 1;",
+        "DROP INDEX ix_nodes_created;",
+        "CREATE INDEX ix_nodes_created_size ON nodes(created, size);",
+    ],
+    # media queries
+    10: [
+        "CREATE INDEX ix_nodes_width_height ON nodes(width, height);",
+        "CREATE INDEX ix_nodes_ms_duration ON nodes(ms_duration);",
+    ],
+    # lookups by content hash
+    11: [
+        "CREATE INDEX ix_nodes_hash ON nodes(hash);",
+    ],
+}
+
+
+def _join_tables(schema: str, *, parents: str = "LEFT") -> str:
+    return f"""
 SELECT
-    nodes.id AS id,
+    ids.id AS id,
     nodes.name AS name,
     nodes.trashed AS trashed,
     nodes.created AS created,
     nodes.updated AS updated,
-    parents.parent_id AS parent_id,
-    files.mime_type AS mime_type,
-    files.hash AS hash,
-    files.size AS size,
-    images.width AS width,
-    images.height AS height,
-    audios.ms_duration AS ms_duration,
+    parent_ids.id AS parent_id,
+    nodes.mime_type AS mime_type,
+    nodes.hash AS hash,
+    nodes.size AS size,
+    nodes.width AS width,
+    nodes.height AS height,
+    nodes.ms_duration AS ms_duration,
     extras.json AS extra
-FROM nodes
-LEFT JOIN parents ON nodes.id = parents.id
-LEFT JOIN files ON nodes.id = files.id
-LEFT JOIN images ON nodes.id = images.id
-LEFT JOIN audios ON nodes.id = audios.id
-LEFT JOIN extras ON nodes.id = extras.id
+FROM {schema}.nodes AS nodes
+INNER JOIN {schema}.ids AS ids ON nodes.key = ids.key
+{parents} JOIN {schema}.parents AS parents ON nodes.key = parents.key
+LEFT JOIN {schema}.ids AS parent_ids ON parents.parent_key = parent_ids.key
+LEFT JOIN {schema}.extras AS extras ON nodes.extra = extras.key
 """
-SQL_SELECT_NODE_BY_ID = SQL_JOIN_TABLES + "WHERE nodes.id = ?;"
+
+
+SQL_JOIN_TABLES = _join_tables("main")
+SQL_SELECT_NODE_BY_ID = SQL_JOIN_TABLES + "WHERE ids.id = ?;"
+SQL_SELECT_NODE_BY_KEY = SQL_JOIN_TABLES + "WHERE nodes.key = ?;"
+# The id list is bound as one JSON array, so there is no host parameter limit
+# and the whole lookup is one statement (thus one consistent read).
+SQL_SELECT_NODES_BY_IDS = (
+    SQL_JOIN_TABLES + "WHERE ids.id IN (SELECT value FROM json_each(?));"
+)
 SQL_SELECT_CHILD_BY_NAME = (
-    SQL_JOIN_TABLES + "WHERE parents.parent_id = ? AND nodes.name = ?;"
+    SQL_JOIN_TABLES
+    + "WHERE parents.parent_key = (SELECT key FROM ids WHERE id = ?) "
+    + "AND nodes.name = ?;"
 )
-SQL_SELECT_CHILDREN_BY_ID = SQL_JOIN_TABLES + "WHERE parents.parent_id = ?;"
-SQL_SELECT_TRASHED_NODES = SQL_JOIN_TABLES + "WHERE nodes.trashed = ?;"
+SQL_SELECT_CHILDREN_BY_ID = (
+    SQL_JOIN_TABLES + "WHERE parents.parent_key = (SELECT key FROM ids WHERE id = ?);"
+)
+# Children always have a parent. With a LEFT JOIN the planner cannot start
+# from the parents and scans every node instead.
+SQL_SELECT_CHILDREN_BY_IDS = (
+    _join_tables("main", parents="INNER")
+    + "WHERE parents.parent_key IN "
+    + "(SELECT key FROM ids WHERE id IN (SELECT value FROM json_each(?)));"
+)
+# Must match the condition of ix_nodes_trashed to use it.
+SQL_SELECT_TRASHED_NODES = SQL_JOIN_TABLES + "WHERE nodes.trashed = 1;"
 SQL_SELECT_NODES_BY_REGEX = SQL_JOIN_TABLES + "WHERE nodes.name REGEXP '';"
-SQL_SELECT_ORPHAN_NODES = SQL_JOIN_TABLES + "WHERE parents.parent_id IS NULL;;"
+SQL_SELECT_NODES_BY_HASH = SQL_JOIN_TABLES + "WHERE nodes.hash = ?;"
+SQL_SELECT_ORPHAN_NODES = SQL_JOIN_TABLES + "WHERE parents.parent_key IS NULL;"
+SQL_SELECT_CHILD_KEY_BY_NAME = """
+SELECT nodes.key AS key
+FROM parents
+INNER JOIN nodes ON parents.key = nodes.key
+WHERE parents.parent_key = ? AND nodes.name = ?;
+"""
+# Facets of get_statistics. A node is a directory when it lacks file columns,
+# and the media kind follows from which media columns are set.
+SQL_SELECT_FACETS = """
+SELECT
+    COUNT(*) AS count,
+    TOTAL(size) AS size,
+    SUM(size IS NULL) AS directories,
+    COUNT(size) AS files,
+    SUM(width IS NOT NULL AND ms_duration IS NULL) AS images,
+    TOTAL(CASE WHEN width IS NOT NULL AND ms_duration IS NULL THEN size END)
+        AS images_size,
+    SUM(width IS NOT NULL AND ms_duration IS NOT NULL) AS videos,
+    TOTAL(CASE WHEN width IS NOT NULL AND ms_duration IS NOT NULL THEN size END)
+        AS videos_size
+FROM nodes;
+"""
+SQL_SELECT_TRASHED_FACET = """
+SELECT COUNT(*) AS count, TOTAL(size) AS size
+FROM nodes
+WHERE trashed = 1;
+"""
+SQL_SELECT_MIME_TYPE_FACETS = """
+SELECT mime_type, COUNT(*) AS count, TOTAL(size) AS size
+FROM nodes
+WHERE mime_type IS NOT NULL
+GROUP BY mime_type;
+"""
+# Media queries. Images have dimensions, videos also have a duration. The
+# unary plus keeps these terms off the indexes, which are meant for the
+# bounds and the ordering; "ms_duration IS NULL" alone matches most nodes.
+SQL_MEDIA_KINDS = {
+    "image": "+nodes.width IS NOT NULL AND +nodes.ms_duration IS NULL",
+    "video": "+nodes.width IS NOT NULL AND +nodes.ms_duration IS NOT NULL",
+}
+SQL_MEDIA_ORDERS = {
+    "updated": "nodes.updated",
+    "created": "nodes.created",
+    "width": "nodes.width",
+    "duration": "nodes.ms_duration",
+}
+# strftime formats which truncate a time to the start of its bucket
+SQL_BUCKET_FORMATS = {
+    "hour": "%Y-%m-%dT%H:00:00",
+    "day": "%Y-%m-%dT00:00:00",
+    "month": "%Y-%m-01T00:00:00",
+}
+SQL_SUM_SIZE_BY_CREATED = """
+SELECT SUM(size) AS sum
+FROM nodes
+WHERE created >= ? AND created < ?;
+"""
+
+# Rows come out in breadth-first order, and all children of a directory are
+# contiguous: SQLite runs a recursive CTE without ORDER BY as a FIFO queue,
+# and the CROSS JOIN keeps the CTE as the outer loop.
+SQL_WALK_TREE = """
+WITH RECURSIVE tree(key, parent_key) AS (
+    SELECT key, NULL FROM ids WHERE id = ?
+    UNION ALL
+    SELECT parents.key, parents.parent_key
+    FROM tree
+    INNER JOIN parents ON parents.parent_key = tree.key
+)
+SELECT
+    ids.id AS id,
+    nodes.name AS name,
+    nodes.trashed AS trashed,
+    nodes.created AS created,
+    nodes.updated AS updated,
+    parent_ids.id AS parent_id,
+    nodes.mime_type AS mime_type,
+    nodes.hash AS hash,
+    nodes.size AS size,
+    nodes.width AS width,
+    nodes.height AS height,
+    nodes.ms_duration AS ms_duration,
+    extras.json AS extra
+FROM tree
+CROSS JOIN nodes ON tree.key = nodes.key
+INNER JOIN ids ON nodes.key = ids.key
+LEFT JOIN ids AS parent_ids ON tree.parent_key = parent_ids.key
+LEFT JOIN extras ON nodes.extra = extras.key;
+"""
+
+# Replica refreshes, where the file is attached to its in-memory copy as
+# "src". Keys differ between the two, so nodes are looked up by their IDs.
+SQL_SELECT_SOURCE_NODE = _join_tables("src") + "WHERE ids.id = ?;"
+
+# Snapshot diffing, where the other snapshot is attached as "other". Keys are
+# local to each database, so nodes are matched by their IDs.
+_SQL_EXISTS_IN = """
+EXISTS (
+    SELECT 1
+    FROM {schema}.ids AS x
+    INNER JOIN {schema}.nodes AS y ON x.key = y.key
+    WHERE x.id = ids.id
+)
+"""
+SQL_SELECT_REMOVED_NODES = (
+    _join_tables("main") + "WHERE NOT " + _SQL_EXISTS_IN.format(schema="other") + ";"
+)
+SQL_SELECT_ADDED_NODES = (
+    _join_tables("other") + "WHERE NOT " + _SQL_EXISTS_IN.format(schema="main") + ";"
+)
+# Nodes in both snapshots are paired through the unique index on IDs, and
+# only the columns of each pair are compared. A node with several parents is
+# changed if either snapshot has a parent the other does not have.
+_SQL_NODE_COLUMNS = (
+    "name",
+    "trashed",
+    "created",
+    "updated",
+    "mime_type",
+    "hash",
+    "size",
+    "width",
+    "height",
+    "ms_duration",
+)
+SQL_SELECT_CHANGED_NODES = (
+    _join_tables("other")
+    + """
+INNER JOIN main.ids AS a_ids ON ids.id = a_ids.id
+INNER JOIN main.nodes AS a_nodes ON a_ids.key = a_nodes.key
+LEFT JOIN main.extras AS a_extras ON a_nodes.extra = a_extras.key
+LEFT JOIN main.ids AS a_parent_ids ON parent_ids.id = a_parent_ids.id
+LEFT JOIN main.parents AS a_parents
+    ON a_nodes.key = a_parents.key AND a_parent_ids.key = a_parents.parent_key
+WHERE """
+    + " OR ".join(f"nodes.{_} IS NOT a_nodes.{_}" for _ in _SQL_NODE_COLUMNS)
+    + """
+OR extras.json IS NOT a_extras.json
+OR (parent_ids.id IS NOT NULL AND a_parents.key IS NULL)
+OR EXISTS (
+    SELECT 1
+    FROM main.parents AS x
+    INNER JOIN main.ids AS y ON x.parent_key = y.key
+    WHERE x.key = a_nodes.key AND NOT EXISTS (
+        SELECT 1
+        FROM other.ids AS z
+        INNER JOIN other.parents AS w ON z.key = w.parent_key
+        WHERE z.id = y.id AND w.key = nodes.key
+    )
+);
+"""
+)
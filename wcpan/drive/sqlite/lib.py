@@ -1,8 +1,28 @@
 from ._outer import (
     get_uploaded_size as get_uploaded_size,
+    get_uploaded_size_histogram as get_uploaded_size_histogram,
+    get_statistics as get_statistics,
     find_orphan_nodes as find_orphan_nodes,
     find_multiple_parents_nodes as find_multiple_parents_nodes,
+    diff_snapshots as diff_snapshots,
+    export_snapshot as export_snapshot,
+    import_snapshot as import_snapshot,
+)
+from ._lib import (
+    TimingRegistry as TimingRegistry,
+    immutable_dsn as immutable_dsn,
 )
 
 
-__all__ = ("get_uploaded_size", "find_orphan_nodes", "find_multiple_parents_nodes")
+__all__ = (
+    "get_uploaded_size",
+    "get_uploaded_size_histogram",
+    "get_statistics",
+    "find_orphan_nodes",
+    "find_multiple_parents_nodes",
+    "diff_snapshots",
+    "export_snapshot",
+    "import_snapshot",
+    "TimingRegistry",
+    "immutable_dsn",
+)
@@ -0,0 +1,12 @@
+from ._lib import (
+    CallTimings as CallTimings,
+    SlowQuery as SlowQuery,
+    TimingSink as TimingSink,
+)
+
+
+__all__ = (
+    "CallTimings",
+    "SlowQuery",
+    "TimingSink",
+)